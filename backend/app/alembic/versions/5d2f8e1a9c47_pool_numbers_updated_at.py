@@ -0,0 +1,36 @@
+"""pool_numbers updated_at
+
+Revision ID: 5d2f8e1a9c47
+Revises: c177671d8cc2
+Create Date: 2026-10-17 09:12:40.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5d2f8e1a9c47"
+down_revision = "c177671d8cc2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "pool_numbers",
+        sa.Column(
+            "updated_at",
+            sa.DateTime(),
+            server_default=sa.text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+            nullable=False,
+        ),
+    )
+    op.create_index(
+        op.f("ix_pool_numbers_updated_at"), "pool_numbers", ["updated_at"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_pool_numbers_updated_at"), table_name="pool_numbers")
+    op.drop_column("pool_numbers", "updated_at")
@@ -0,0 +1,49 @@
+"""pool_number_snapshots
+
+Revision ID: 9b3e6f1d4a27
+Revises: 5d2f8e1a9c47
+Create Date: 2026-10-17 11:04:52.607113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9b3e6f1d4a27"
+down_revision = "5d2f8e1a9c47"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "pool_number_snapshots",
+        sa.Column("pool_id", sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column("number", sa.String(length=20), nullable=False),
+        sa.Column("sid", sa.String(length=64), nullable=True),
+        sa.Column("renewed_at", sa.Float(precision=53), nullable=False),
+        sa.Column("context", sa.Text(), nullable=False),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(),
+            server_default=sa.text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("pool_id", "number"),
+        mysql_charset="utf8",
+        mysql_engine="InnoDB",
+    )
+    op.create_index(
+        op.f("ix_pool_number_snapshots_renewed_at"),
+        "pool_number_snapshots",
+        ["renewed_at"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(
+        op.f("ix_pool_number_snapshots_renewed_at"), table_name="pool_number_snapshots"
+    )
+    op.drop_table("pool_number_snapshots")
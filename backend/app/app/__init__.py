@@ -1,4 +1,5 @@
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 
 from fastapi import FastAPI
 import uvicorn.protocols.utils
@@ -7,6 +8,11 @@ from app.core.config import settings
 from app.core.logging import default_logger, dbg, info, warn, error
 from app.db.session import database
 from app.geo import close_maxmind_geoip, init_criteria_area_codes, init_maxmind_geoip
+from app.number_pool_async import close_async_number_pool_conn
+from app.number_pool_reaper import NumberPoolReaper
+from app.number_pool_snapshot import NumberPoolSnapshotter
+from app.track_call_queue import run_workers
+from app.trestle import close_trestle_client
 from app.utils import extract_header_params
 
 
@@ -40,12 +46,28 @@ async def lifespan(app):
         init_criteria_area_codes()
     if settings.MAXMIND_GEOIP_ACCOUNT_ID and settings.MAXMIND_GEOIP_LICENSE_KEY:
         init_maxmind_geoip()
+    reaper_task = None
+    if settings.NUMBER_POOL_ENABLED and settings.NUMBER_POOL_REAPER_ENABLED:
+        reaper_task = asyncio.create_task(NumberPoolReaper().run())
+    snapshot_task = None
+    if settings.NUMBER_POOL_ENABLED and settings.NUMBER_POOL_SNAPSHOT_ENABLED:
+        snapshot_task = asyncio.create_task(NumberPoolSnapshotter().run())
+    track_call_task = None
+    if settings.TRACK_CALL_QUEUE_ENABLED and settings.TRACK_CALL_QUEUE_WORKERS:
+        track_call_task = asyncio.create_task(run_workers())
 
     print("FastAPI app started with async database connection")
     try:
         yield  # Hand control to the app
     finally:
+        for task in (reaper_task, snapshot_task, track_call_task):
+            if task:
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
         close_maxmind_geoip()
+        await close_trestle_client()
+        await close_async_number_pool_conn()
         await database.disconnect()
 
 
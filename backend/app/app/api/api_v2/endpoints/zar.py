@@ -2,15 +2,15 @@
 TODO Check for bots before deps.get_conn
 """
 
+import asyncio
 from functools import wraps
 import time
 from typing import Dict, Any, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Request, Response, Cookie
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import ValidationError
-from sqlalchemy import func, insert
-from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy import insert
 from starlette.concurrency import run_in_threadpool
 from starlette.status import HTTP_204_NO_CONTENT
 from tlbx import st, json, dbg, info, warn
@@ -26,11 +26,14 @@ from app.schemas.zar import (
     UpdateUserContextRequestBody,
     GetStaticNumberContextRequestParams,
     SetStaticNumberContextsRequestBody,
+    TrackCallResultRequestParams,
     NumberPoolRequestBody,
     UpdateNumberRequestBody,
 )
 from app.api import deps
+from app.circuit_breaker import get_circuit_breaker_stats
 from app.core.config import settings
+from app.db.redis_session import RedisFamilies
 from app.db.session import database
 from app.geo import (
     CRITERIA_AREA_CODES,
@@ -47,7 +50,15 @@ from app.number_pool import (
     NumberMaxRenewalExceeded,
     SessionNumberUnavailable,
 )
-from app.trestle import get_trestle_enrichment
+from app.number_pool_async import AsyncNumberPoolAPI, get_async_redis_family_conn
+from app.track_call_queue import (
+    TRACK_CALL_PENDING,
+    add_trestle_enrichment,
+    enqueue_track_call,
+    get_track_call_response,
+    get_track_call_result,
+    save_track_call,
+)
 from app.utils import (
     print_request,
     extract_header_params,
@@ -77,10 +88,14 @@ FLAG_CONTEXT_AGE_LIMIT = 1 * DAYS
 
 router = APIRouter()
 
+# The async API serves the request path. The sync API is kept for the pool
+# maintenance endpoints and as the Redis cache connection for Trestle lookups.
 pool_api = None
+async_pool_api = None
 if settings.NUMBER_POOL_ENABLED:
     try:
         pool_api = NumberPoolAPI()
+        async_pool_api = AsyncNumberPoolAPI()
     except NumberPoolUnavailable as e:
         warn(str(e))
 
@@ -247,11 +262,11 @@ def get_geoip_area_codes_from_context(context):
     return area_codes
 
 
-def get_sid_pool_targeting(pool_api, pool_id, sid):
+async def get_sid_pool_targeting(pool_api, pool_id, sid):
     if not pool_api or not sid:
         return None
 
-    sid_ctx = pool_api.get_user_context("sid", sid) or {}
+    sid_ctx = await pool_api.get_user_context("sid", sid) or {}
     pool_targeting = sid_ctx.get(SID_POOL_TARGETING_KEY, {}) or {}
     if not isinstance(pool_targeting, dict):
         return None
@@ -271,14 +286,14 @@ def get_sid_pool_targeting(pool_api, pool_id, sid):
     )
 
 
-def set_sid_pool_targeting(pool_api, pool_id, sid, target_area_codes, source):
+async def set_sid_pool_targeting(pool_api, pool_id, sid, target_area_codes, source):
     if not pool_api or not sid or not source:
         return
 
     if not target_area_codes:
         return
 
-    sid_ctx = pool_api.get_user_context("sid", sid) or {}
+    sid_ctx = await pool_api.get_user_context("sid", sid) or {}
     pool_targeting = sid_ctx.get(SID_POOL_TARGETING_KEY, {}) or {}
     if not isinstance(pool_targeting, dict):
         pool_targeting = {}
@@ -289,7 +304,7 @@ def set_sid_pool_targeting(pool_api, pool_id, sid, target_area_codes, source):
         updated_at=int(time.time()),
     )
     sid_ctx[SID_POOL_TARGETING_KEY] = pool_targeting
-    pool_api.set_user_context("sid", sid, sid_ctx)
+    await pool_api.set_user_context("sid", sid, sid_ctx)
 
 
 def get_area_code_from_number(number):
@@ -306,20 +321,25 @@ def get_area_code_from_number(number):
     return digits[:3]
 
 
-def get_target_area_codes(pool_api, pool_id, context, number=None):
+async def get_target_area_codes(pool_api, pool_id, context, number=None):
     context_targeting = get_targeting_from_context(context, allow_geoip=False)
     sid_targeting = None
     geoip_targeting = None
 
     if not context_targeting:
-        sid_targeting = get_sid_pool_targeting(pool_api, pool_id, context.get("sid"))
+        sid_targeting = await get_sid_pool_targeting(
+            pool_api, pool_id, context.get("sid")
+        )
         if sid_targeting:
             latest_context = context.get("latest_context", None)
             if isinstance(latest_context, dict):
                 latest_context["area_code_source"] = "sid_cache"
 
     if not context_targeting and not sid_targeting:
-        geoip_targeting = get_targeting_from_context(context, allow_geoip=True)
+        # GeoIP lookups are blocking HTTP calls
+        geoip_targeting = await run_in_threadpool(
+            get_targeting_from_context, context, allow_geoip=True
+        )
         if geoip_targeting and geoip_targeting.get("source") != "geoip":
             geoip_targeting = None
 
@@ -338,7 +358,7 @@ def get_target_area_codes(pool_api, pool_id, context, number=None):
     return (target_area_codes or None), sid_targeting_to_cache
 
 
-def get_pool_number(pool_api, pool_id, context, number=None, request=None):
+async def get_pool_number(pool_api, pool_id, context, number=None, request=None):
     if not pool_api:
         res = dict(
             status=NumberPoolResponseStatus.ERROR,
@@ -351,13 +371,13 @@ def get_pool_number(pool_api, pool_id, context, number=None, request=None):
 
     target_area_codes = None
     sid_targeting_to_cache = None
-    if pool_api.is_area_code_pool(pool_id):
-        target_area_codes, sid_targeting_to_cache = get_target_area_codes(
+    if await pool_api.is_area_code_pool(pool_id):
+        target_area_codes, sid_targeting_to_cache = await get_target_area_codes(
             pool_api, pool_id, context, number=number
         )
 
     try:
-        number_res = pool_api.lease_number(
+        number_res = await pool_api.lease_number(
             pool_id,
             context,
             target_number=number,
@@ -365,7 +385,7 @@ def get_pool_number(pool_api, pool_id, context, number=None, request=None):
             renew=True if number else False,
         )
         if sid_targeting_to_cache:
-            set_sid_pool_targeting(
+            await set_sid_pool_targeting(
                 pool_api,
                 pool_id,
                 context.get("sid", None),
@@ -418,7 +438,7 @@ def set_pool_cookie(response, data, headers, max_age=POOL_COOKIE_MAX_AGE):
     )
 
 
-def handle_pool_request(zar, props, cookie, headers, request, response):
+async def handle_pool_request(zar, props, cookie, headers, request, response):
     start = time.time()
     use_pool = False
     pool_sesh = {}
@@ -469,9 +489,9 @@ def handle_pool_request(zar, props, cookie, headers, request, response):
         headers,
     )
 
-    global pool_api
-    pool_resp = get_pool_number(
-        pool_api, pool_id, request_context, number=pool_number, request=request
+    global async_pool_api
+    pool_resp = await get_pool_number(
+        async_pool_api, pool_id, request_context, number=pool_number, request=request
     )
     dbg(f"{sid}: {pool_resp}")
 
@@ -531,11 +551,11 @@ async def page(
 
     pool_data = None
     try:
-        pool_data = handle_pool_request(
+        pool_data = await handle_pool_request(
             zar, body["properties"], _zar_pool, headers, request, response
         )
-        if pool_data and pool_api:
-            sid_ctx = pool_api.get_user_context("sid", sid)
+        if pool_data and async_pool_api:
+            sid_ctx = await async_pool_api.get_user_context("sid", sid)
             if sid_ctx:
                 pool_data["sid_ctx"] = sid_ctx
             body["properties"]["pool_data"] = pool_data
@@ -681,7 +701,7 @@ async def noscript(
 
 
 @router.post("/number_pool", response_model=Dict[str, Any])
-def number_pool(
+async def number_pool(
     body: NumberPoolRequestBody,
     request: Request,
     response: Response,
@@ -735,9 +755,9 @@ def number_pool(
     origRef = zar["sid"].get("origReferrer", None)
     request_context = get_pool_context(vid, sid, origRef, context, headers)
 
-    global pool_api
-    res = get_pool_number(
-        pool_api, pool_id, request_context, number=number, request=request
+    global async_pool_api
+    res = await get_pool_number(
+        async_pool_api, pool_id, request_context, number=number, request=request
     )
 
     if not renew:
@@ -745,8 +765,8 @@ def number_pool(
         max_age = body["properties"].get("pool_max_age", POOL_COOKIE_MAX_AGE)
         set_pool_cookie(response, pool_sesh, headers, max_age=max_age)
 
-    if pool_api:
-        sid_ctx = pool_api.get_user_context("sid", sid)
+    if async_pool_api:
+        sid_ctx = await async_pool_api.get_user_context("sid", sid)
         if sid_ctx:
             res["sid_ctx"] = sid_ctx
 
@@ -755,7 +775,7 @@ def number_pool(
 
 
 @router.post("/update_number", response_model=Dict[str, Any])
-def update_number(
+async def update_number(
     body: UpdateNumberRequestBody,
     request: Request,
     _zar_sid: Optional[str] = Cookie(None),
@@ -794,8 +814,10 @@ def update_number(
     origRef = zar["sid"].get("origReferrer", None)
     request_context = get_pool_context(vid, sid, origRef, context, headers)
 
-    global pool_api
-    res = pool_api.update_number(pool_id, number, request_context, merge=True)
+    global async_pool_api
+    res = await async_pool_api.update_number(
+        pool_id, number, request_context, merge=True
+    )
 
     info(f"took: {time.time() - start:0.3f}s, {pool_id} / {number}")
     # NOTE: this is inconsistent with other endpoints that return results in the msg
@@ -803,7 +825,7 @@ def update_number(
 
 
 @router.get("/get_user_context", response_model=Dict[str, Any])
-def get_user_context(
+async def get_user_context(
     request: Request, params: GetUserContextRequestParams = Depends()
 ) -> Dict[str, Any]:
     params = dict(params)
@@ -813,8 +835,8 @@ def get_user_context(
     if settings.DEBUG:
         print_request(request.headers, None)
 
-    global pool_api
-    if not pool_api:
+    global async_pool_api
+    if not async_pool_api:
         res = dict(
             status=NumberPoolResponseStatus.ERROR,
             msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
@@ -824,12 +846,12 @@ def get_user_context(
 
     user_id = params["user_id"]
     id_type = params["id_type"]
-    ctx = pool_api.get_user_context(id_type, user_id)
+    ctx = await async_pool_api.get_user_context(id_type, user_id)
     return dict(status=NumberPoolResponseStatus.SUCCESS, msg=ctx)
 
 
 @router.post("/update_user_context", response_model=Dict[str, Any])
-def update_user_context(
+async def update_user_context(
     body: UpdateUserContextRequestBody, request: Request
 ) -> Dict[str, Any]:
     body = dict(body)
@@ -839,8 +861,8 @@ def update_user_context(
     if settings.DEBUG:
         print_request(request.headers, body)
 
-    global pool_api
-    if not pool_api:
+    global async_pool_api
+    if not async_pool_api:
         res = dict(
             status=NumberPoolResponseStatus.ERROR,
             msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
@@ -851,12 +873,12 @@ def update_user_context(
     user_id = body["user_id"]
     id_type = body["id_type"]
     context = body["context"]
-    ctx = pool_api.update_user_context(id_type, user_id, context)
+    ctx = await async_pool_api.update_user_context(id_type, user_id, context)
     return dict(status=NumberPoolResponseStatus.SUCCESS, msg=ctx)
 
 
 @router.get("/remove_user_context", response_model=Dict[str, Any])
-def remove_user_context(
+async def remove_user_context(
     request: Request, params: RemoveUserContextRequestParams = Depends()
 ) -> Dict[str, Any]:
     params = dict(params)
@@ -866,8 +888,8 @@ def remove_user_context(
     if settings.DEBUG:
         print_request(request.headers, None)
 
-    global pool_api
-    if not pool_api:
+    global async_pool_api
+    if not async_pool_api:
         res = dict(
             status=NumberPoolResponseStatus.ERROR,
             msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
@@ -877,12 +899,12 @@ def remove_user_context(
 
     user_id = params["user_id"]
     id_type = params["id_type"]
-    pool_api.remove_user_context(id_type, user_id)
+    await async_pool_api.remove_user_context(id_type, user_id)
     return dict(status=NumberPoolResponseStatus.SUCCESS, msg=None)
 
 
 @router.get("/get_static_number_context", response_model=Dict[str, Any])
-def get_static_number_context(
+async def get_static_number_context(
     request: Request, params: GetStaticNumberContextRequestParams = Depends()
 ) -> Dict[str, Any]:
     params = dict(params)
@@ -892,8 +914,8 @@ def get_static_number_context(
     if settings.DEBUG:
         print_request(request.headers, None)
 
-    global pool_api
-    if not pool_api:
+    global async_pool_api
+    if not async_pool_api:
         res = dict(
             status=NumberPoolResponseStatus.ERROR,
             msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
@@ -902,7 +924,7 @@ def get_static_number_context(
         return res
 
     number = params["number"]
-    ctx = pool_api.get_static_number_context(number)
+    ctx = await async_pool_api.get_static_number_context(number)
     if not ctx:
         res = dict(
             status=NumberPoolResponseStatus.ERROR,
@@ -915,7 +937,7 @@ def get_static_number_context(
 
 
 @router.post("/set_static_number_contexts", response_model=Dict[str, Any])
-def set_static_number_contexts(
+async def set_static_number_contexts(
     body: SetStaticNumberContextsRequestBody, request: Request
 ) -> Dict[str, Any]:
     body = dict(body)
@@ -925,8 +947,8 @@ def set_static_number_contexts(
     if settings.DEBUG:
         print_request(request.headers, body)
 
-    global pool_api
-    if not pool_api:
+    global async_pool_api
+    if not async_pool_api:
         res = dict(
             status=NumberPoolResponseStatus.ERROR,
             msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
@@ -937,104 +959,41 @@ def set_static_number_contexts(
     for ctx in body["contexts"]:
         number = ctx.number
         context = ctx.context
-        pool_api.set_static_number_context(number, context)
+        await async_pool_api.set_static_number_context(number, context)
 
     return dict(status=NumberPoolResponseStatus.SUCCESS, msg=None)
 
 
-async def save_call_enrichment(conn, call_id, call_from, call_to, from_zip, enrichment):
-    trestle_data = enrichment.get("data")
-    values = dict(
-        call_id=call_id,
-        call_from=call_from,
-        call_to=call_to,
-        status=enrichment["status"],
-        from_zip=from_zip,
-        trusted_zip=enrichment.get("trusted_zip"),
-        trust_reason=enrichment.get("trust_reason"),
-        properties=(json.dumps({"trestle": trestle_data}) if trestle_data else None),
-        latency_ms=enrichment.get("latency_ms"),
-        from_cache=bool(enrichment.get("from_cache", False)),
-    )
-    stmt = mysql_insert(models.CallEnrichment).values(**values)
-    stmt = stmt.on_duplicate_key_update(
-        call_from=values["call_from"],
-        call_to=values["call_to"],
-        status=values["status"],
-        from_zip=values["from_zip"],
-        trusted_zip=values["trusted_zip"],
-        trust_reason=values["trust_reason"],
-        properties=values["properties"],
-        latency_ms=values["latency_ms"],
-        from_cache=values["from_cache"],
-        updated_at=func.now(),
-    )
-    try:
-        await conn.execute(query=stmt)
-    except Exception as e:
-        warn(f"Failed to save call enrichment for {call_id}: {str(e)}")
-
-
-async def add_trestle_enrichment(
-    user_ctx,
-    ctx,
-    call_id,
-    call_from,
-    call_to,
-    from_zip,
-    user_area_code,
-    cache_conn,
-    conn,
+async def add_call_enrichment(
+    user_ctx, ctx, body, call_from, call_to, user_area_code, conn
 ):
-    if not settings.TRESTLE_API_KEY:
-        return user_ctx
-
-    existing_user_ctx = user_ctx or (ctx or {}).get("user_context", {})
-    user_zip = None
-    if existing_user_ctx and settings.USER_CONTEXT_ZIP_KEY:
-        user_zip = rgetkey(existing_user_ctx, settings.USER_CONTEXT_ZIP_KEY, None)
-
-    latest_ctx = (ctx or {}).get("request_context", {}).get("latest_context", {})
-    pool_zip = None
-    if latest_ctx and settings.POOL_CONTEXT_ZIP_KEY:
-        pool_zip = rgetkey(latest_ctx, settings.POOL_CONTEXT_ZIP_KEY, None)
-
-    if user_zip or pool_zip:
-        return user_ctx
-
-    try:
-        enrichment = await run_in_threadpool(
-            get_trestle_enrichment,
+    """Enrich a call that has no track_call record, or queue its enrichment
+    if TRACK_CALL_QUEUE_ENABLED"""
+    if settings.TRACK_CALL_QUEUE_ENABLED:
+        await enqueue_track_call(
+            async_pool_api.conn,
+            body["call_id"],
             call_from,
-            from_zip,
-            user_area_code,
-            settings.TRESTLE_API_KEY,
-            cache_conn,
-        )
-    except Exception as e:
-        warn(f"Trestle caller ZIP enrichment failed for {call_from}: {str(e)}")
-        enrichment = dict(
-            data=None,
-            status="internal_error",
-            trusted_zip=None,
-            trust_reason="not_applicable",
-            latency_ms=None,
-            from_cache=False,
+            call_to,
+            ctx,
+            user_ctx=user_ctx,
+            from_zip=body.get("from_zip"),
+            user_area_code=user_area_code,
+            record=False,
         )
-
-    await save_call_enrichment(conn, call_id, call_from, call_to, from_zip, enrichment)
-
-    trestle_data = enrichment.get("data")
-    trestle_zip = enrichment.get("trusted_zip")
-    if trestle_data:
-        ctx["trestle"] = trestle_data
-
-    if not (trestle_zip and settings.USER_CONTEXT_TRESTLE_ZIP_KEY):
         return user_ctx
 
-    user_ctx = dict(user_ctx or {})
-    user_ctx[settings.USER_CONTEXT_TRESTLE_ZIP_KEY] = trestle_zip
-    return user_ctx
+    return await add_trestle_enrichment(
+        user_ctx,
+        ctx,
+        body["call_id"],
+        call_from,
+        call_to,
+        body.get("from_zip"),
+        user_area_code,
+        get_async_redis_family_conn(RedisFamilies.TRESTLE),
+        conn,
+    )
 
 
 @router.post("/track_call", response_model=Dict[str, Any])
@@ -1050,8 +1009,8 @@ async def track_call(
     if settings.DEBUG:
         print_request(request.headers, body)
 
-    global pool_api
-    if not pool_api:
+    global async_pool_api
+    if not async_pool_api:
         res = dict(
             status=NumberPoolResponseStatus.ERROR,
             msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
@@ -1063,9 +1022,16 @@ async def track_call(
     call_from = body["call_from"].lstrip("+1")
     user_area_code = call_from[:3]
 
-    pool_ctx = pool_api.get_pool_number_context(call_to)
-    route_ctx = pool_api.get_cached_route_context(call_from, call_to)
-    user_ctx = pool_api.get_user_context("phone", call_from)
+    # All contexts are read up front in one round trip, the static context is
+    # only used if there is no number or route context.
+    contexts = await async_pool_api.get_call_contexts(call_from, call_to)
+    pool_ctx = contexts["pool"]
+    route_ctx = contexts["route"]
+    user_ctx = contexts["user"]
+    # Attribution is decided on the compact snapshots of the contexts, which
+    # leases and renewals keep for each number
+    pool_attr = contexts["attribution"]
+    route_attr = async_pool_api._get_context_attribution(route_ctx)
     from_route_cache = False
     has_cached_route = True if route_ctx else False
     ctx = None
@@ -1089,19 +1055,11 @@ async def track_call(
 
     if not (pool_ctx or route_ctx):
         # Check if this is a static number with context
-        static_ctx = pool_api.get_static_number_context(call_to)
+        static_ctx = contexts["static"]
         if static_ctx:
             ctx = dict(static_context=static_ctx, has_cached_route=has_cached_route)
-            user_ctx = await add_trestle_enrichment(
-                user_ctx,
-                ctx,
-                body["call_id"],
-                call_from,
-                call_to,
-                body.get("from_zip"),
-                user_area_code,
-                pool_api.conn,
-                conn,
+            user_ctx = await add_call_enrichment(
+                user_ctx, ctx, body, call_from, call_to, user_area_code, conn
             )
             if user_ctx:
                 ctx["user_context"] = user_ctx
@@ -1110,38 +1068,40 @@ async def track_call(
 
     sid = None
     sid_mismatch = False
+    ctx_attr = None
     if (not pool_ctx) and route_ctx:
         # No active context found for this tracking number but we have a cached
         # context from this user calling this number before.
         ctx = route_ctx
+        ctx_attr = route_attr
         from_route_cache = True
     elif pool_ctx and not route_ctx:
         ctx = pool_ctx
-        pool_id = pool_ctx["pool_id"]
-        sid = pool_api._get_session_id(pool_id, pool_ctx["request_context"])
+        ctx_attr = pool_attr
+        sid = pool_attr["sid"]
     elif pool_ctx and route_ctx:
         # There is an active context and a cached context. If the SID of number context
         # and route context match, its the same user and we use the updated context.
-        pool_id = pool_ctx["pool_id"]
-        number_sid = pool_api._get_session_id(pool_id, pool_ctx["request_context"])
-        route_sid = pool_api._get_session_id(pool_id, route_ctx["request_context"])
+        number_sid = pool_attr["sid"]
+        route_sid = route_attr["sid"]
         if number_sid == route_sid:
             # Same session, use direct number ctx since it may be more up to date
             ctx = pool_ctx
+            ctx_attr = pool_attr
             sid = number_sid
         else:
             # Different session...
             sid_mismatch = True
-            if pool_api.is_same_ip_user_agent(
-                pool_id, pool_ctx["request_context"], route_ctx["request_context"]
-            ):
+            if async_pool_api.is_same_attribution_ip_user_agent(pool_attr, route_attr):
                 ctx = pool_ctx
+                ctx_attr = pool_attr
                 sid = number_sid
                 warn(
                     f"{call_from} -> {call_to}: different sid but same IP/user agent, using number context"
                 )
             else:
                 ctx = route_ctx
+                ctx_attr = route_attr
                 from_route_cache = True
                 sid = route_sid
                 warn(
@@ -1151,16 +1111,8 @@ async def track_call(
     if not ctx:
         if user_ctx:
             ctx = dict(has_cached_route=has_cached_route)
-            user_ctx = await add_trestle_enrichment(
-                user_ctx,
-                ctx,
-                body["call_id"],
-                call_from,
-                call_to,
-                body.get("from_zip"),
-                user_area_code,
-                pool_api.conn,
-                conn,
+            user_ctx = await add_call_enrichment(
+                user_ctx, ctx, body, call_from, call_to, user_area_code, conn
             )
             ctx["user_context"] = user_ctx
             res = dict(status=NumberPoolResponseStatus.SUCCESS, msg=ctx)
@@ -1174,13 +1126,9 @@ async def track_call(
         return res
 
     # Populate the final context with the area code distance if possible
-    latest_ctx = ctx.get("request_context", {}).get("latest_context", {})
-    if (
-        latest_ctx
-        and settings.POOL_CONTEXT_ZIP_KEY
-        and rgetkey(latest_ctx, settings.POOL_CONTEXT_ZIP_KEY, None)
-    ):
-        ctx_zip = rgetkey(latest_ctx, settings.POOL_CONTEXT_ZIP_KEY, None)
+    latest_ctx = (ctx.get("request_context", None) or {}).get("latest_context", None)
+    if latest_ctx and ctx_attr["zip"]:
+        ctx_zip = ctx_attr["zip"]
         try:
             ctx_zip_dist = zip_to_area_code_distance(ctx_zip, user_area_code)
             if ctx_zip_dist is not None:
@@ -1191,58 +1139,78 @@ async def track_call(
                 request=request,
             )
 
-    user_ctx = await add_trestle_enrichment(
-        user_ctx,
-        ctx,
-        body["call_id"],
-        call_from,
-        call_to,
-        body.get("from_zip"),
-        user_area_code,
-        pool_api.conn,
-        conn,
-    )
+    # We maintain a separate user context by sid that site sessions can use.
+    # It is read while any enrichment runs and written back with the rest.
+    sid_ctx = None
+    if settings.TRACK_CALL_QUEUE_ENABLED:
+        # Enriched by the track_call workers along with the record
+        if sid:
+            sid_ctx = await async_pool_api.get_user_context("sid", sid)
+    else:
+        enrichment = add_trestle_enrichment(
+            user_ctx,
+            ctx,
+            body["call_id"],
+            call_from,
+            call_to,
+            body.get("from_zip"),
+            user_area_code,
+            get_async_redis_family_conn(RedisFamilies.TRESTLE),
+            conn,
+        )
+        if sid:
+            user_ctx, sid_ctx = await asyncio.gather(
+                enrichment, async_pool_api.get_user_context("sid", sid)
+            )
+        else:
+            user_ctx = await enrichment
 
+    user_contexts = []
     if sid:
-        # We maintain a separate user context by sid that site sessions can use.
-        pool_api.update_user_context(
-            "sid",
-            sid,
+        sid_ctx = async_pool_api._merge_user_context(
+            sid_ctx,
             {
                 "last_called_number": call_to,
                 "last_called_time": int(time.time()),
             },
         )
+        user_contexts.append(("sid", sid, sid_ctx))
 
     if user_ctx:
         ctx["user_context"] = user_ctx
 
     ctx.setdefault("sid_mismatch", sid_mismatch)
-    pool_api.set_cached_route_context(call_from, call_to, ctx)
+    distinct_callers = await async_pool_api.write_call_contexts(
+        call_from, call_to, ctx, user_contexts=user_contexts
+    )
 
     ctx["has_cached_route"] = has_cached_route
-    seconds_since_renewal = pool_api._number_context_age(ctx)
-    distinct_callers = pool_api.track_lease_caller(call_to, ctx, call_from)
+    seconds_since_renewal = async_pool_api._number_context_age(ctx)
     ctx["distinct_lease_callers"] = distinct_callers
     ctx["suspicious_call"] = distinct_callers >= FLAG_DISTINCT_CALLERS_LIMIT or (
         seconds_since_renewal >= FLAG_CONTEXT_AGE_LIMIT and not from_route_cache
     )
-    ctx["context_expired"] = pool_api._number_context_expired(ctx)
+    ctx["context_expired"] = await async_pool_api._number_context_expired(ctx)
     ctx["seconds_since_renewal"] = seconds_since_renewal
     ctx["stir_validation"] = body.get("stir_validation")
-    ctx_json = json.dumps(ctx)
-
-    insert_stmt = insert(models.TrackCall).values(
-        call_id=body["call_id"],
-        sid=ctx.get("request_context", {}).get("sid", None),
-        call_from=call_from,
-        call_to=call_to,
-        number_context=ctx_json,
-        from_route_cache=from_route_cache,
-    )
 
     try:
-        await conn.execute(query=insert_stmt)
+        if settings.TRACK_CALL_QUEUE_ENABLED:
+            await enqueue_track_call(
+                async_pool_api.conn,
+                body["call_id"],
+                call_from,
+                call_to,
+                ctx,
+                user_ctx=user_ctx,
+                from_zip=body.get("from_zip"),
+                user_area_code=user_area_code,
+                from_route_cache=from_route_cache,
+            )
+        else:
+            await save_track_call(
+                conn, body["call_id"], call_from, call_to, ctx, from_route_cache
+            )
     except Exception as e:
         rb_error(f"Failed to save TrackCall record: {str(e)}", request=request)
         return dict(
@@ -1250,13 +1218,45 @@ async def track_call(
             msg=NumberPoolResponseMessages.INTERNAL_ERROR,
         )
 
-    response_ctx = ctx.copy()
-    response_ctx.pop("stir_validation", None)
-    return dict(status=NumberPoolResponseStatus.SUCCESS, msg=response_ctx)
+    return get_track_call_response(ctx)
+
+
+@router.get("/track_call_result", response_model=Dict[str, Any])
+async def track_call_result(
+    request: Request,
+    params: TrackCallResultRequestParams = Depends(),
+    conn=Depends(deps.get_conn),
+) -> Dict[str, Any]:
+    params = dict(params)
+    key = params.get("key", None)
+    if (not settings.DEBUG) and ((not key) or (key != settings.NUMBER_POOL_KEY)):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    if settings.DEBUG:
+        print_request(request.headers, None)
+
+    global async_pool_api
+    if not async_pool_api:
+        res = dict(
+            status=NumberPoolResponseStatus.ERROR,
+            msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
+        )
+        rb_warning(res, request=request)
+        return res
+
+    res = await get_track_call_result(async_pool_api.conn, conn, params["call_id"])
+    if res == TRACK_CALL_PENDING:
+        return dict(status=NumberPoolResponseStatus.PENDING, msg=None)
+    if not res:
+        res = dict(
+            status=NumberPoolResponseStatus.ERROR,
+            msg=NumberPoolResponseMessages.NOT_FOUND,
+        )
+        warn(res)
+    return res
 
 
 @router.get("/refresh_number_pool_conn", response_model=Dict[str, Any])
-def refresh_number_pool_conn(request: Request, key: str = None) -> Dict[str, Any]:
+async def refresh_number_pool_conn(request: Request, key: str = None) -> Dict[str, Any]:
     if (not settings.DEBUG) and ((not key) or (key != settings.NUMBER_POOL_KEY)):
         raise HTTPException(status_code=403, detail="Forbidden")
     global pool_api
@@ -1265,13 +1265,15 @@ def refresh_number_pool_conn(request: Request, key: str = None) -> Dict[str, Any
             status=NumberPoolResponseStatus.ERROR,
             msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
         )
-    pool_api.refresh_conn()
+    # Connecting may retry with a sleep
+    await run_in_threadpool(pool_api.refresh_conn)
+    await async_pool_api.refresh_conn()
     return dict(status=NumberPoolResponseStatus.SUCCESS, msg=None)
 
 
 @router.get("/init_number_pools", response_model=Dict[str, Any])
 def init_number_pools(
-    request: Request, key: str = None, pool_id: int = None
+    request: Request, key: str = None, pool_id: int = None, force: bool = False
 ) -> Dict[str, Any]:
     if (not settings.DEBUG) and ((not key) or (key != settings.NUMBER_POOL_KEY)):
         raise HTTPException(status_code=403, detail="Forbidden")
@@ -1282,7 +1284,7 @@ def init_number_pools(
             msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
         )
     pool_ids = [pool_id] if pool_id else None
-    res = pool_api.init_pools(pool_ids=pool_ids)
+    res = pool_api.init_pools(pool_ids=pool_ids, force=force)
     return dict(status=NumberPoolResponseStatus.SUCCESS, msg=json.dumps(res))
 
 
@@ -1317,6 +1319,41 @@ def number_pool_stats(
     return pool_api.get_all_pool_stats(with_contexts=with_contexts)
 
 
+@router.get("/circuit_breaker_stats", response_model=Dict[str, Any])
+def circuit_breaker_stats(request: Request, key: str = None) -> Dict[str, Any]:
+    """State of the external provider circuit breakers in this process"""
+    if (not settings.DEBUG) and ((not key) or (key != settings.NUMBER_POOL_KEY)):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return get_circuit_breaker_stats()
+
+
+@router.get("/number_pool_contexts")
+def number_pool_contexts(
+    request: Request, key: str = None, pool_id: int = None
+) -> StreamingResponse:
+    """Stream taken number contexts as newline-delimited JSON"""
+    if (not settings.DEBUG) and ((not key) or (key != settings.NUMBER_POOL_KEY)):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    global pool_api
+    if not pool_api:
+        return JSONResponse(
+            dict(
+                status=NumberPoolResponseStatus.ERROR,
+                msg=NumberPoolResponseMessages.POOL_UNAVAILABLE,
+            )
+        )
+
+    def iter_lines():
+        pool_ids = [pool_id] if pool_id else None
+        for ctx_pool_id, number, context in pool_api.iter_number_contexts(
+            pool_ids=pool_ids
+        ):
+            row = dict(pool_id=ctx_pool_id, number=number, context=context)
+            yield json.dumps(row) + "\n"
+
+    return StreamingResponse(iter_lines(), media_type="application/x-ndjson")
+
+
 @router.get("/ok")
 def ok(request: Request) -> str:
     return "OK"
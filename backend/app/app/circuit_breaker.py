@@ -0,0 +1,209 @@
+"""Circuit breakers and adaptive timeouts for external lookup providers.
+
+Each provider has a CircuitBreaker that tracks the outcome and latency of its
+recent calls in this process. It opens when too many of them fail or run slow,
+and callers then skip the provider instead of waiting on it. After
+open_seconds a few probe calls are let through (half-open), and the breaker
+closes again if they all succeed.
+
+While closed, calls get an adaptive timeout: a multiple of a high percentile of
+recent successful latencies, kept between min_timeout and max_timeout, so a
+degraded provider is given up on well before max_timeout.
+
+get_circuit_breaker_stats reports the state of every breaker, see the
+/circuit_breaker_stats endpoint.
+"""
+
+from collections import deque
+from threading import Lock
+import time
+
+from tlbx import ClassValueContainsMeta, info, raiseifnot, warn
+
+CIRCUIT_BREAKER_WINDOW_SIZE = 100
+CIRCUIT_BREAKER_MIN_CALLS = 20
+CIRCUIT_BREAKER_FAILURE_RATE = 0.5
+CIRCUIT_BREAKER_SLOW_CALL_RATE = 0.5
+CIRCUIT_BREAKER_OPEN_SECONDS = 30
+CIRCUIT_BREAKER_HALF_OPEN_CALLS = 3
+CIRCUIT_BREAKER_TIMEOUT_PERCENTILE = 0.99
+CIRCUIT_BREAKER_TIMEOUT_MULTIPLIER = 1.5
+
+CIRCUIT_BREAKERS = {}
+
+
+class CircuitStates(metaclass=ClassValueContainsMeta):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+def get_latency_percentile(latencies, percentile):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(percentile * len(latencies)))]
+
+
+class CircuitBreaker:
+    """Track calls to one provider. Callers check allow() before each call and
+    report its outcome with record_success or record_failure. Safe to share
+    across threads."""
+
+    def __init__(
+        self,
+        name,
+        max_timeout,
+        min_timeout,
+        slow_call_seconds=None,
+        window_size=CIRCUIT_BREAKER_WINDOW_SIZE,
+        min_calls=CIRCUIT_BREAKER_MIN_CALLS,
+        failure_rate=CIRCUIT_BREAKER_FAILURE_RATE,
+        slow_call_rate=CIRCUIT_BREAKER_SLOW_CALL_RATE,
+        open_seconds=CIRCUIT_BREAKER_OPEN_SECONDS,
+        half_open_calls=CIRCUIT_BREAKER_HALF_OPEN_CALLS,
+        timeout_percentile=CIRCUIT_BREAKER_TIMEOUT_PERCENTILE,
+        timeout_multiplier=CIRCUIT_BREAKER_TIMEOUT_MULTIPLIER,
+    ):
+        raiseifnot(
+            0 < min_timeout <= max_timeout,
+            f"Invalid timeouts for {name}: {min_timeout} / {max_timeout}",
+        )
+        self.name = name
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        # By default a call is slow once it takes half the max timeout
+        self.slow_call_seconds = slow_call_seconds or max_timeout / 2
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.timeout_percentile = timeout_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self._lock = Lock()
+        self.reset()
+        CIRCUIT_BREAKERS[name] = self
+
+    def reset(self):
+        with self._lock:
+            self.state = CircuitStates.CLOSED
+            # (succeeded, latency) of the most recent calls
+            self.calls = deque(maxlen=self.window_size)
+            self.opened_at = None
+            self.opened_count = 0
+            self.rejected_count = 0
+            self.probes = 0
+            self.probe_successes = 0
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        msg = f"{self.name} circuit breaker {self.state} -> {state}"
+        if state == CircuitStates.OPEN:
+            warn(msg)
+        else:
+            info(msg)
+        self.state = state
+        if state == CircuitStates.OPEN:
+            self.opened_at = time.monotonic()
+            self.opened_count += 1
+        elif state == CircuitStates.HALF_OPEN:
+            self.probes = 0
+            self.probe_successes = 0
+        else:
+            # Latencies from before the incident would skew the timeout
+            self.calls.clear()
+            self.opened_at = None
+
+    def allow(self):
+        """Whether a call should be made now. In the half-open state only
+        half_open_calls probe calls are allowed until they report back."""
+        with self._lock:
+            if self.state == CircuitStates.OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    self.rejected_count += 1
+                    return False
+                self._set_state(CircuitStates.HALF_OPEN)
+
+            if self.state == CircuitStates.HALF_OPEN:
+                if self.probes >= self.half_open_calls:
+                    self.rejected_count += 1
+                    return False
+                self.probes += 1
+            return True
+
+    def get_timeout(self):
+        """The timeout for the next call, max_timeout until there are enough
+        recent successful calls and for half-open probes"""
+        with self._lock:
+            if self.state != CircuitStates.CLOSED:
+                return self.max_timeout
+            latencies = [latency for ok, latency in self.calls if ok]
+            if len(latencies) < self.min_calls:
+                return self.max_timeout
+            latency = get_latency_percentile(latencies, self.timeout_percentile)
+        timeout = latency * self.timeout_multiplier
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def _record(self, ok, latency):
+        with self._lock:
+            if self.state == CircuitStates.HALF_OPEN:
+                if not ok:
+                    self._set_state(CircuitStates.OPEN)
+                    return
+                self.probe_successes += 1
+                if self.probe_successes >= self.half_open_calls:
+                    self._set_state(CircuitStates.CLOSED)
+                return
+
+            if self.state == CircuitStates.OPEN:
+                # A call that started before the breaker opened
+                return
+
+            self.calls.append((ok, latency))
+            if len(self.calls) < self.min_calls:
+                return
+            failures = sum(1 for ok, _ in self.calls if not ok)
+            slow_calls = sum(
+                1
+                for _, latency in self.calls
+                if latency is not None and latency >= self.slow_call_seconds
+            )
+            if (failures / len(self.calls) >= self.failure_rate) or (
+                slow_calls / len(self.calls) >= self.slow_call_rate
+            ):
+                self._set_state(CircuitStates.OPEN)
+
+    def record_success(self, latency):
+        self._record(True, latency)
+
+    def record_failure(self, latency=None):
+        self._record(False, latency)
+
+    def get_stats(self):
+        timeout = self.get_timeout()
+        with self._lock:
+            calls = len(self.calls)
+            latencies = [latency for _, latency in self.calls if latency is not None]
+            return dict(
+                state=self.state,
+                calls=calls,
+                failures=sum(1 for ok, _ in self.calls if not ok),
+                slow_calls=sum(1 for x in latencies if x >= self.slow_call_seconds),
+                p50_latency=get_latency_percentile(latencies, 0.5),
+                p99_latency=get_latency_percentile(latencies, 0.99),
+                timeout=timeout,
+                opened_count=self.opened_count,
+                rejected_count=self.rejected_count,
+                open_seconds_left=(
+                    max(0, self.open_seconds - (time.monotonic() - self.opened_at))
+                    if self.state == CircuitStates.OPEN
+                    else None
+                ),
+            )
+
+
+def get_circuit_breaker_stats():
+    return {name: breaker.get_stats() for name, breaker in CIRCUIT_BREAKERS.items()}
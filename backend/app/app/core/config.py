@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import Dict, List, Union
 
 from pydantic import AnyHttpUrl, field_validator
 from pydantic_settings import BaseSettings
@@ -31,6 +31,32 @@ class Settings(BaseSettings):
 
     REDIS_HOST: str
     REDIS_PASSWORD: str
+    REDIS_PORT: int = 6379
+    # Per-worker connection cap. Callers wait up to REDIS_POOL_TIMEOUT for a
+    # free connection instead of opening unbounded new ones.
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: float = 5
+    REDIS_SOCKET_TIMEOUT: float = 5
+    REDIS_SOCKET_CONNECT_TIMEOUT: float = 2
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+    REDIS_RETRIES: int = 3
+    REDIS_RETRY_BACKOFF_CAP: float = 1
+    # Comma-separated host:port list. If set, REDIS_HOST/REDIS_PORT are ignored
+    # and the master for REDIS_SENTINEL_SERVICE_NAME is discovered through it.
+    REDIS_SENTINEL_HOSTS: Union[List[str], None] = None
+    REDIS_SENTINEL_SERVICE_NAME: str = "mymaster"
+    REDIS_SENTINEL_PASSWORD: Union[str, None] = None
+    # Comma-separated family=url list of Redis URLs for the data families in
+    # app.db.redis_session.RedisFamilies, e.g. "geoip=redis://cache:6379/1".
+    # Families without a URL share the number pool connection. Keep the "pool"
+    # family on a noeviction instance and caches on allkeys-lru instances.
+    REDIS_FAMILY_URLS: Union[Dict[str, str], None] = None
+    # Encoding of cached route, user, static, GeoIP and Trestle values. "json"
+    # or "msgpack", compressed with "zlib" or "zstd" if at least the threshold
+    # in bytes. Values written with any codec are readable with any other.
+    REDIS_CODEC_SERIALIZER: str = "json"
+    REDIS_CODEC_COMPRESSION: str = "none"
+    REDIS_CODEC_COMPRESSION_THRESHOLD: int = 1024
 
     ROLLBAR_ENABLED: bool = True
     ROLLBAR_ENV: str
@@ -38,6 +64,42 @@ class Settings(BaseSettings):
 
     NUMBER_POOL_ENABLED: bool = False
     NUMBER_POOL_KEY: str
+    # "script" leases numbers with atomic Lua scripts, "lock" uses pool locks
+    NUMBER_POOL_LEASE_MODE: str = "script"
+    # In "lock" mode, "pool" serializes all leases in a pool. "number" renews
+    # numbers the session already owns under a per-number lock instead.
+    NUMBER_POOL_LOCK_SCOPE: str = "pool"
+    # "json" stores number contexts as JSON strings, "hash" as hashes so renewals
+    # only write the changed fields. Either format is read in both modes.
+    NUMBER_POOL_CONTEXT_FORMAT: str = "json"
+    # Default bounds on the visits kept in number contexts, overridable with the
+    # max_visits, max_visits_bytes and visits_summary pool properties. 0 means
+    # unbounded. Visit summaries only keep the url of each visit.
+    NUMBER_POOL_MAX_VISITS: int = 0
+    NUMBER_POOL_MAX_VISITS_BYTES: int = 0
+    NUMBER_POOL_VISITS_SUMMARY: bool = False
+    # Renewals by the owning session within this fraction of the pool's cache
+    # expiration since the last renewal are confirmed without the pool lock or
+    # a context rewrite. 0 disables, overridable with the renewal_throttle pool
+    # property.
+    NUMBER_POOL_RENEWAL_THROTTLE: float = 0
+    # Default number of shards to spread each pool's free/taken structures
+    # across, overridable with the shards pool property. 1 keeps a single set
+    # of keys per pool.
+    NUMBER_POOL_SHARDS: int = 1
+    # "v1" keeps the original key names. "v2" hash tags every number context
+    # and pool structure key with the pool and a shard of the number so all
+    # keys touched by a lease share a Redis Cluster slot. Switch with
+    # app.number_pool_migrate.
+    NUMBER_POOL_KEY_LAYOUT: str = "v1"
+    # Background task that returns expired numbers to the free set
+    NUMBER_POOL_REAPER_ENABLED: bool = False
+    NUMBER_POOL_REAPER_INTERVAL: int = 30
+    # Background task that snapshots the contexts of recently renewed numbers
+    # to the pool_number_snapshots table. init_pools restores missing contexts
+    # from it, such as after a Redis restart or eviction.
+    NUMBER_POOL_SNAPSHOT_ENABLED: bool = False
+    NUMBER_POOL_SNAPSHOT_INTERVAL: int = 60
 
     ALLOW_BOTS: bool = False
 
@@ -45,7 +107,17 @@ class Settings(BaseSettings):
     USER_CONTEXT_ZIP_KEY: Union[str, None] = None
     POOL_CONTEXT_ZIP_KEY: Union[str, None] = None
     TRESTLE_API_KEY: Union[str, None] = None
+    # Connections kept open to Trestle by each app process. Lookups beyond this
+    # wait for a free connection within their deadline.
+    TRESTLE_MAX_CONNECTIONS: int = 20
+    TRESTLE_REQUEST_TIMEOUT: float = 1.0
     USER_CONTEXT_TRESTLE_ZIP_KEY: Union[str, None] = None
+    # Respond to /track_call once the number pool lookups are done, and queue
+    # the Trestle enrichment and database writes for background workers (see
+    # app.track_call_queue). Each app process runs TRACK_CALL_QUEUE_WORKERS
+    # workers, 0 to only run them standalone.
+    TRACK_CALL_QUEUE_ENABLED: bool = False
+    TRACK_CALL_QUEUE_WORKERS: int = 2
 
     CRITERIA_AREA_CODES_PATH: Union[str, None] = None
     LOC_PHYSICAL_URL_PARAM: Union[str, None] = None
@@ -64,6 +136,31 @@ class Settings(BaseSettings):
             return [i.strip() for i in str(v).split(",")]
         raise ValueError(v)
 
+    @field_validator("REDIS_SENTINEL_HOSTS", mode="before")
+    @classmethod
+    def assemble_redis_sentinel_hosts(cls, v: Union[str, List[str], None]):
+        if v is None or isinstance(v, list):
+            return v
+        elif not str(v).startswith("["):
+            return [i.strip() for i in str(v).split(",") if i.strip()] or None
+        raise ValueError(v)
+
+    @field_validator("REDIS_FAMILY_URLS", mode="before")
+    @classmethod
+    def assemble_redis_family_urls(cls, v: Union[str, Dict[str, str], None]):
+        if v is None or isinstance(v, dict):
+            return v
+        elif not str(v).startswith("{"):
+            return (
+                dict(
+                    [part.strip() for part in i.split("=", 1)]
+                    for i in str(v).split(",")
+                    if i.strip()
+                )
+                or None
+            )
+        raise ValueError(v)
+
     model_config = {"case_sensitive": True}
 
 
@@ -0,0 +1,173 @@
+"""Encoding of the values cached in Redis.
+
+JSON is encoded with orjson and written as is, so it stays readable by the Lua
+scripts and by processes still running an older release. Values serialized
+with msgpack, or compressed because they are at least
+REDIS_CODEC_COMPRESSION_THRESHOLD bytes, are written as raw bytes after a
+header:
+
+    ~<version><serializer><compression><payload>
+
+The clients decode responses, so codec values must be read with get_encoded,
+which skips decoding for that one command. Version 1 values, which carried a
+base85 payload to survive decoding at about 25% more bytes, are still read.
+Values without the header are read as JSON, so existing keys stay readable
+whatever the configured codec. Note msgpack keeps non-string dict keys, where
+JSON converts them to strings.
+"""
+
+import base64
+import zlib
+
+import msgpack
+import orjson
+from tlbx import json, ClassValueContainsMeta, raiseifnot
+import zstandard
+
+from app.core.config import settings
+
+
+CODEC_MARKER = "~"
+CODEC_VERSION = "2"
+# Version of the values with a base85 payload
+CODEC_BASE85_VERSION = "1"
+CODEC_HEADER_LENGTH = 4
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+class CodecSerializers(metaclass=ClassValueContainsMeta):
+    JSON = "json"
+    MSGPACK = "msgpack"
+
+
+class CodecCompressions(metaclass=ClassValueContainsMeta):
+    NONE = "none"
+    ZLIB = "zlib"
+    ZSTD = "zstd"
+
+
+SERIALIZER_CODES = {CodecSerializers.JSON: "j", CodecSerializers.MSGPACK: "m"}
+COMPRESSION_CODES = {
+    CodecCompressions.NONE: "-",
+    CodecCompressions.ZLIB: "z",
+    CodecCompressions.ZSTD: "s",
+}
+
+
+def dumps_json(value):
+    """Fast JSON encoding, for values that must stay plain JSON"""
+    try:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    except TypeError:
+        # Types orjson doesn't handle, such as Decimals or huge ints
+        return json.dumps(value)
+
+
+def get_encoded(client, key):
+    """GET a value written with RedisCodec.dumps without decoding the response,
+    so binary payloads survive clients that decode responses. Works on clients
+    and pipelines, sync or async."""
+    return client.execute_command("GET", key, NEVER_DECODE=True)
+
+
+def loads_json(raw):
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # Values orjson rejects but older writers may have produced, e.g. NaN
+        return json.loads(raw)
+
+
+class RedisCodec:
+    """Encode and decode values stored in Redis. Defaults to the REDIS_CODEC_*
+    settings."""
+
+    def __init__(self, serializer=None, compression=None, compression_threshold=None):
+        self.serializer = serializer or settings.REDIS_CODEC_SERIALIZER
+        self.compression = compression or settings.REDIS_CODEC_COMPRESSION
+        if compression_threshold is None:
+            compression_threshold = settings.REDIS_CODEC_COMPRESSION_THRESHOLD
+        self.compression_threshold = compression_threshold
+        raiseifnot(
+            self.serializer in CodecSerializers,
+            f"Invalid Redis codec serializer: {self.serializer}",
+        )
+        raiseifnot(
+            self.compression in CodecCompressions,
+            f"Invalid Redis codec compression: {self.compression}",
+        )
+
+    def dumps(self, value):
+        if self.serializer == CodecSerializers.JSON:
+            raw = dumps_json(value).encode("utf-8")
+        else:
+            raw = msgpack.packb(value)
+
+        compression = CodecCompressions.NONE
+        if (
+            self.compression != CodecCompressions.NONE
+            and len(raw) >= self.compression_threshold
+        ):
+            compression = self.compression
+            raw = self._compress(raw)
+
+        if (
+            self.serializer == CodecSerializers.JSON
+            and compression == CodecCompressions.NONE
+        ):
+            return raw.decode("utf-8")
+
+        header = (
+            CODEC_MARKER
+            + CODEC_VERSION
+            + SERIALIZER_CODES[self.serializer]
+            + COMPRESSION_CODES[compression]
+        )
+        return header.encode("ascii") + raw
+
+    def loads(self, raw):
+        """Decode a value read with get_encoded. Also takes decoded strings,
+        which can only hold JSON or version 1 values."""
+        if raw is None:
+            return None
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        if not raw.startswith(CODEC_MARKER.encode("ascii")):
+            return loads_json(raw)
+
+        header = raw[:CODEC_HEADER_LENGTH].decode("ascii", errors="replace")
+        raiseifnot(
+            len(header) == CODEC_HEADER_LENGTH
+            and header[1] in (CODEC_VERSION, CODEC_BASE85_VERSION),
+            f"Unsupported Redis codec header: {header}",
+            ValueError,
+        )
+        serializer = _lookup_code(SERIALIZER_CODES, header[2])
+        compression = _lookup_code(COMPRESSION_CODES, header[3])
+        data = raw[CODEC_HEADER_LENGTH:]
+        if header[1] == CODEC_BASE85_VERSION:
+            data = base64.b85decode(data)
+        if compression == CodecCompressions.ZLIB:
+            data = zlib.decompress(data)
+        elif compression == CodecCompressions.ZSTD:
+            data = zstandard.decompress(data)
+
+        if serializer == CodecSerializers.MSGPACK:
+            return msgpack.unpackb(data, strict_map_key=False)
+        return loads_json(data)
+
+    def _compress(self, raw):
+        if self.compression == CodecCompressions.ZLIB:
+            return zlib.compress(raw, ZLIB_LEVEL)
+        return zstandard.compress(raw, ZSTD_LEVEL)
+
+
+def _lookup_code(codes, code):
+    for name, value in codes.items():
+        if value == code:
+            return name
+    raise ValueError(f"Unsupported Redis codec code: {code}")
+
+
+redis_codec = RedisCodec()
@@ -0,0 +1,148 @@
+"""Redis clients for the number pool and the caches that share its instance.
+
+Keys fall into the data families in RedisFamilies. Any family can be moved to
+its own instance or database with REDIS_FAMILY_URLS, so caches that churn can
+live on an LRU instance without evicting pool state.
+
+Each client gets a bounded connection pool with socket timeouts, periodic
+health checks and retries with exponential backoff. Broken connections are
+dropped and re-established on the next command, so every worker recovers from
+a Redis restart or failover on its own. If REDIS_SENTINEL_HOSTS is set, the
+master is discovered through Sentinel and rediscovered on reconnect.
+"""
+
+import redis
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.asyncio.sentinel import Sentinel as AsyncSentinel
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+from redis.sentinel import Sentinel
+import redis.asyncio as aioredis
+from tlbx import ClassValueContainsMeta
+
+from app.core.config import settings
+
+
+RETRY_ON_ERRORS = [ConnectionError, TimeoutError]
+
+
+class RedisFamilies(metaclass=ClassValueContainsMeta):
+    # Number pool structures, number contexts, pool properties, locks and
+    # static number contexts. Should never be evicted.
+    POOL = "pool"
+    ROUTES = "routes"
+    USER_CONTEXTS = "user_contexts"
+    LEASE_CALLERS = "lease_callers"
+    GEOIP = "geoip"
+    TRESTLE = "trestle"
+
+
+def get_redis_family_url(family):
+    """The Redis URL configured for a data family, or None if it shares the
+    number pool connection"""
+    if family == RedisFamilies.POOL:
+        return None
+    return (settings.REDIS_FAMILY_URLS or {}).get(family, None)
+
+
+def get_sentinel_hosts():
+    hosts = []
+    for host in settings.REDIS_SENTINEL_HOSTS or []:
+        host, _, port = host.partition(":")
+        hosts.append((host, int(port or 26379)))
+    return hosts
+
+
+def get_redis_connection_kwargs():
+    return dict(
+        password=settings.REDIS_PASSWORD,
+        decode_responses=True,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+        retry_on_error=RETRY_ON_ERRORS,
+    )
+
+
+def _get_sentinel_kwargs():
+    return dict(
+        password=settings.REDIS_SENTINEL_PASSWORD,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+    )
+
+
+def create_redis_client(url=None):
+    """Create a client for the number pool instance, or for url if given"""
+    retry = Retry(
+        ExponentialBackoff(cap=settings.REDIS_RETRY_BACKOFF_CAP),
+        settings.REDIS_RETRIES,
+    )
+    kwargs = get_redis_connection_kwargs()
+    if url:
+        pool = redis.BlockingConnectionPool.from_url(
+            url,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            retry=retry,
+            **kwargs,
+        )
+        return redis.Redis(connection_pool=pool)
+    if settings.REDIS_SENTINEL_HOSTS:
+        sentinel = Sentinel(
+            get_sentinel_hosts(), sentinel_kwargs=_get_sentinel_kwargs()
+        )
+        return sentinel.master_for(
+            settings.REDIS_SENTINEL_SERVICE_NAME,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            retry=retry,
+            **kwargs,
+        )
+    pool = redis.BlockingConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        retry=retry,
+        **kwargs,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+def create_async_redis_client(url=None):
+    """Create a client for the number pool instance, or for url if given"""
+    retry = AsyncRetry(
+        ExponentialBackoff(cap=settings.REDIS_RETRY_BACKOFF_CAP),
+        settings.REDIS_RETRIES,
+    )
+    kwargs = get_redis_connection_kwargs()
+    if url:
+        pool = aioredis.BlockingConnectionPool.from_url(
+            url,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            retry=retry,
+            **kwargs,
+        )
+        return aioredis.Redis(connection_pool=pool)
+    if settings.REDIS_SENTINEL_HOSTS:
+        sentinel = AsyncSentinel(
+            get_sentinel_hosts(), sentinel_kwargs=_get_sentinel_kwargs()
+        )
+        return sentinel.master_for(
+            settings.REDIS_SENTINEL_SERVICE_NAME,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            retry=retry,
+            **kwargs,
+        )
+    pool = aioredis.BlockingConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        retry=retry,
+        **kwargs,
+    )
+    return aioredis.Redis(connection_pool=pool)
@@ -1,26 +1,41 @@
 import csv
 import ipaddress
-import json
 import math
 from threading import Lock
+import time
 
 import geoip2.errors
 import geoip2.webservice
 import pgeocode
 from tlbx import info, warn, error, st
 
+from app.circuit_breaker import CircuitBreaker
 from app.core.config import settings
-from app.number_pool import get_number_pool_conn
+from app.db.redis_codec import get_encoded, redis_codec
+from app.db.redis_session import RedisFamilies
+from app.number_pool import get_redis_family_conn
+from app.single_flight import (
+    SingleFlight,
+    claim_in_flight,
+    release_in_flight,
+    wait_in_flight,
+)
 
 nomi = pgeocode.Nominatim("us")
 
 MAXMIND_GEOIP_HOST = "geoip.maxmind.com"
 MAXMIND_GEOIP_TIMEOUT = 1.0
+# Floor of the adaptive timeout, see CircuitBreaker
+MAXMIND_GEOIP_MIN_TIMEOUT = 0.2
+# Adaptive timeouts are rounded up to this step, one client per step
+MAXMIND_GEOIP_TIMEOUT_STEP = 0.1
 MAXMIND_GEOIP_CACHE_TTL_SECONDS = 48 * 60 * 60
 MAXMIND_GEOIP_AREA_CODE_NEAR_LIMIT = 1
 MAXMIND_GEOIP_AREA_CODE_FAR_LIMIT = 3
 MAXMIND_GEOIP_CLOSEST_AREA_CODE_DISTANCE_THRESHOLD_MILES = 50
 MAXMIND_GEOIP_CACHE_KEY_PREFIX = "geoip:area_codes"
+# Covers a lookup that runs to its timeout
+MAXMIND_GEOIP_IN_FLIGHT_TTL = 2 * MAXMIND_GEOIP_TIMEOUT
 
 SUPPORTED_MAXMIND_COUNTRY_CODES = {
     # "CA", # Canada
@@ -29,8 +44,14 @@ SUPPORTED_MAXMIND_COUNTRY_CODES = {
 }
 
 _MAXMIND_GEOIP_CACHE_MISS = object()
-_MAXMIND_GEOIP_CLIENT = None
+_MAXMIND_GEOIP_CLIENTS = {}
 _MAXMIND_GEOIP_CLIENT_LOCK = Lock()
+_MAXMIND_GEOIP_LOOKUPS = SingleFlight()
+MAXMIND_GEOIP_CIRCUIT_BREAKER = CircuitBreaker(
+    "maxmind_geoip",
+    max_timeout=MAXMIND_GEOIP_TIMEOUT,
+    min_timeout=MAXMIND_GEOIP_MIN_TIMEOUT,
+)
 
 
 def init_maxmind_geoip():
@@ -41,29 +62,31 @@ def init_maxmind_geoip():
 
 
 def close_maxmind_geoip():
-    global _MAXMIND_GEOIP_CLIENT
-
     with _MAXMIND_GEOIP_CLIENT_LOCK:
-        if _MAXMIND_GEOIP_CLIENT:
-            _MAXMIND_GEOIP_CLIENT.close()
-            _MAXMIND_GEOIP_CLIENT = None
-
+        for client in _MAXMIND_GEOIP_CLIENTS.values():
+            client.close()
+        _MAXMIND_GEOIP_CLIENTS.clear()
 
-def get_maxmind_geoip_client():
-    global _MAXMIND_GEOIP_CLIENT
 
+def get_maxmind_geoip_client(timeout=MAXMIND_GEOIP_TIMEOUT):
+    """Get the shared client for timeout. geoip2's Client only takes a timeout
+    when it is created, so there is one client per MAXMIND_GEOIP_TIMEOUT_STEP
+    of adaptive timeout."""
     if not (settings.MAXMIND_GEOIP_ACCOUNT_ID and settings.MAXMIND_GEOIP_LICENSE_KEY):
         return None
 
+    steps = math.ceil(round(timeout / MAXMIND_GEOIP_TIMEOUT_STEP, 6))
+    timeout = round(steps * MAXMIND_GEOIP_TIMEOUT_STEP, 6)
     with _MAXMIND_GEOIP_CLIENT_LOCK:
-        if not _MAXMIND_GEOIP_CLIENT:
-            _MAXMIND_GEOIP_CLIENT = geoip2.webservice.Client(
+        client = _MAXMIND_GEOIP_CLIENTS.get(timeout, None)
+        if not client:
+            client = _MAXMIND_GEOIP_CLIENTS[timeout] = geoip2.webservice.Client(
                 settings.MAXMIND_GEOIP_ACCOUNT_ID,
                 settings.MAXMIND_GEOIP_LICENSE_KEY,
                 host=MAXMIND_GEOIP_HOST,
-                timeout=MAXMIND_GEOIP_TIMEOUT,
+                timeout=timeout,
             )
-        return _MAXMIND_GEOIP_CLIENT
+        return client
 
 
 AREA_CODES = {
@@ -2460,21 +2483,25 @@ def zip_to_zip_distance(zip_code1, zip_code2):
     return rounded if math.isfinite(rounded) else None
 
 
+def _get_maxmind_geoip_cache_key(ip):
+    return f"{MAXMIND_GEOIP_CACHE_KEY_PREFIX}:{ip}"
+
+
 def _get_cached_maxmind_geoip_lookup(ip):
     ttl_seconds = MAXMIND_GEOIP_CACHE_TTL_SECONDS
     if ttl_seconds <= 0:
         return _MAXMIND_GEOIP_CACHE_MISS
 
     try:
-        conn = get_number_pool_conn()
+        conn = get_redis_family_conn(RedisFamilies.GEOIP)
         if not conn:
             return _MAXMIND_GEOIP_CACHE_MISS
 
-        cache_value = conn.get(f"{MAXMIND_GEOIP_CACHE_KEY_PREFIX}:{ip}")
+        cache_value = get_encoded(conn, _get_maxmind_geoip_cache_key(ip))
         if cache_value is None:
             return _MAXMIND_GEOIP_CACHE_MISS
 
-        return json.loads(cache_value)
+        return redis_codec.loads(cache_value)
     except Exception as e:
         warn(f"Could not read MaxMind GeoIP cache for {ip}: {str(e)}")
         return _MAXMIND_GEOIP_CACHE_MISS
@@ -2486,14 +2513,14 @@ def _set_cached_maxmind_geoip_lookup(ip, area_codes):
         return
 
     try:
-        conn = get_number_pool_conn()
+        conn = get_redis_family_conn(RedisFamilies.GEOIP)
         if not conn:
             return
 
         conn.setex(
-            f"{MAXMIND_GEOIP_CACHE_KEY_PREFIX}:{ip}",
+            _get_maxmind_geoip_cache_key(ip),
             ttl_seconds,
-            json.dumps(area_codes or []),
+            redis_codec.dumps(area_codes or []),
         )
     except Exception as e:
         warn(f"Could not write MaxMind GeoIP cache for {ip}: {str(e)}")
@@ -2572,13 +2599,50 @@ def geoip_area_codes_from_ip(ip):
     if cached is not _MAXMIND_GEOIP_CACHE_MISS:
         return cached
 
-    client = get_maxmind_geoip_client()
+    # Concurrent requests from the same visitor share one MaxMind lookup
+    return _MAXMIND_GEOIP_LOOKUPS.do(ip, _coalesced_geoip_area_codes_from_ip, ip)
+
+
+def _coalesced_geoip_area_codes_from_ip(ip):
+    timeout = MAXMIND_GEOIP_CIRCUIT_BREAKER.get_timeout()
+    client = get_maxmind_geoip_client(timeout)
     if not client:
         return None
 
+    conn = get_redis_family_conn(RedisFamilies.GEOIP)
+    cache_key = _get_maxmind_geoip_cache_key(ip)
+    claimed = claim_in_flight(conn, cache_key, MAXMIND_GEOIP_IN_FLIGHT_TTL)
+    try:
+        if claimed:
+            # The result may have been cached since it was last read
+            cached = _get_cached_maxmind_geoip_lookup(ip)
+        else:
+            # Another worker is looking up this IP, wait for it to cache it
+            cached = wait_in_flight(
+                conn,
+                cache_key,
+                lambda: _get_cached_maxmind_geoip_lookup(ip),
+                _MAXMIND_GEOIP_CACHE_MISS,
+                timeout,
+            )
+        if cached is not _MAXMIND_GEOIP_CACHE_MISS:
+            return cached
+        return _lookup_geoip_area_codes(client, ip)
+    finally:
+        if claimed:
+            release_in_flight(conn, cache_key)
+
+
+def _lookup_geoip_area_codes(client, ip):
+    breaker = MAXMIND_GEOIP_CIRCUIT_BREAKER
+    if not breaker.allow():
+        return None
+
+    start = time.perf_counter()
     try:
         response = client.city(ip)
     except geoip2.errors.AddressNotFoundError:
+        breaker.record_success(time.perf_counter() - start)
         info(f"MaxMind GeoIP address not found for {ip}")
         _set_cached_maxmind_geoip_lookup(ip, None)
         return None
@@ -2590,8 +2654,13 @@ def geoip_area_codes_from_ip(ip):
         geoip2.errors.PermissionRequiredError,
         geoip2.errors.GeoIP2Error,
     ) as e:
+        breaker.record_failure(time.perf_counter() - start)
         warn(f"MaxMind GeoIP lookup failed for {ip}: {str(e)}")
         return None
+    except Exception:
+        breaker.record_failure(time.perf_counter() - start)
+        raise
+    breaker.record_success(time.perf_counter() - start)
 
     country_iso_code = (response.country.iso_code or "").upper() or None
     subdivision_iso_code = response.subdivisions.most_specific.iso_code
@@ -1,5 +1,14 @@
-from sqlalchemy import Column, Boolean, BigInteger, Integer, Text, String, DateTime
-from sqlalchemy.sql import func
+from sqlalchemy import (
+    Column,
+    Boolean,
+    BigInteger,
+    Float,
+    Integer,
+    Text,
+    String,
+    DateTime,
+)
+from sqlalchemy.sql import func, text
 
 from app.db.base_class import Base
 
@@ -79,3 +88,29 @@ class PoolNumbers(Base):
     pool_id = Column(BigInteger, primary_key=True, autoincrement=False)
     number = Column(String(20), primary_key=True)
     created_at = Column(DateTime, server_default=func.now(), nullable=False, index=True)
+    # Bumped on insert/update so init_pools can skip pools that haven't changed
+    updated_at = Column(
+        DateTime,
+        server_default=text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+        nullable=False,
+        index=True,
+    )
+
+
+class PoolNumberSnapshots(Base):
+    """Contexts of recently renewed pool numbers, written periodically so they
+    can be restored to Redis"""
+
+    __tablename__ = "pool_number_snapshots"
+
+    pool_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    number = Column(String(20), primary_key=True)
+    sid = Column(String(64), nullable=True)
+    # Double precision for epoch timestamps
+    renewed_at = Column(Float(precision=53), nullable=False, index=True)
+    context = Column(Text, nullable=False)
+    updated_at = Column(
+        DateTime,
+        server_default=text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+        nullable=False,
+    )
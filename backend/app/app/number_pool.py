@@ -1,7 +1,13 @@
+from contextlib import nullcontext
+import hashlib
+from itertools import chain
+import os
+import random
+import threading
 import time
+import zlib
 
-import redis
-from redis.exceptions import LockError
+from redis.exceptions import LockError, ResponseError
 import rollbar
 from tlbx import (
     st,
@@ -18,8 +24,23 @@ from tlbx import (
 )
 
 from app.core.config import settings
+from app.db.redis_codec import dumps_json, get_encoded, loads_json, redis_codec
+from app.db.redis_session import (
+    RedisFamilies,
+    create_redis_client,
+    get_redis_family_url,
+)
 from app.db.session import engine
-from app.schemas.zar import NumberPoolCacheValue, UserIDTypes
+from app.number_pool_scripts import (
+    CONFIRM_RENEWAL_SCRIPT,
+    FREE_NUMBERS_SCRIPT,
+    LEASE_NUMBER_SCRIPT,
+    REAP_EXPIRED_NUMBERS_SCRIPT,
+    REBUILD_TAKEN_AREA_CODE_INDEX_SCRIPT,
+    RENEW_NUMBER_SCRIPT,
+)
+from app.schemas.zar import UserIDTypes
+from app.utils import rgetkey
 
 
 MINUTES = 60
@@ -30,17 +51,67 @@ NUMBER_POOL_CONNECT_TRIES = 5
 # If number hasn't been renewed in this time, mark expired (eligible to be taken)
 NUMBER_POOL_CACHE_EXPIRATION = 5 * MINUTES
 NUMBER_POOL_CACHE_EXPIRATION_PROPERTY = "cache_expiration"
+# Pool properties bounding the visits kept in number contexts. The defaults come
+# from the NUMBER_POOL_MAX_VISITS* and NUMBER_POOL_VISITS_SUMMARY settings.
+NUMBER_POOL_MAX_VISITS_PROPERTY = "max_visits"
+NUMBER_POOL_MAX_VISITS_BYTES_PROPERTY = "max_visits_bytes"
+NUMBER_POOL_VISITS_SUMMARY_PROPERTY = "visits_summary"
+# Page context keys kept per visit when a pool only keeps visit summaries
+VISIT_SUMMARY_KEYS = ("url",)
+# Fraction of the cache expiration after a renewal within which renewals by the
+# owning session are confirmed without rewriting the context. Defaults to the
+# NUMBER_POOL_RENEWAL_THROTTLE setting.
+NUMBER_POOL_RENEWAL_THROTTLE_PROPERTY = "renewal_throttle"
+# Number of shards a pool's free/taken structures are spread across. Defaults to
+# the NUMBER_POOL_SHARDS setting. Changes are applied when the pool is reset.
+NUMBER_POOL_SHARDS_PROPERTY = "shards"
+# Key layout of the keyspace, absent for v1. Written by app.number_pool_migrate
+# and by init_pools for new v2 keyspaces.
+NUMBER_POOL_KEY_LAYOUT_KEY = "number_pool:key_layout"
+# Hash of number -> pool ID, kept in the v2 key layout where number context keys
+# are tagged with the pool
+NUMBER_POOL_IDS_KEY = "number_pool:pool_ids"
+# Request contexts of confirmed renewals kept per number until the next full
+# renewal folds them into the context
+NUMBER_CONTEXT_UPDATES_MAX = 20
+# Cached pool properties are kept until a change is published on this channel.
+# The expiration only applies while the process isn't subscribed.
+POOL_PROPERTIES_CHANNEL = "pool_properties:changes"
+POOL_PROPERTIES_ALL = "*"
 POOL_PROPERTIES_CACHE_EXPIRATION = 2 * MINUTES
+POOL_PROPERTIES_LISTENER_RETRY_INTERVAL = 5
+POOL_LIST_CACHE_EXPIRATION = 1 * MINUTES
 # Numbers can get renewed for this amount of time max
 NUMBER_POOL_MAX_RENEWAL_AGE = 7 * DAYS
 # How long we keep call_from -> call_to route contexts cached
 NUMBER_POOL_ROUTE_CACHE_EXPIRATION = 30 * DAYS
 NUMBER_POOL_USER_CONTEXT_EXPIRATION = 14 * DAYS
 NUMBER_POOL_LEASE_CALLERS_EXPIRATION = 2 * DAYS
+NUMBER_CONTEXT_UPDATES_EXPIRATION = NUMBER_POOL_MAX_RENEWAL_AGE
+# Snapshots re-read numbers renewed this long before the previous snapshot, to
+# catch renewals committed after it read the taken sets
+NUMBER_POOL_SNAPSHOT_OVERLAP = 10
 
 LOCK_WAIT_TIMEOUT = 5
 LOCK_HOLD_TIMEOUT = 5
 INIT_LOCK_TIMEOUT = 2
+# Retries when a scripted renewal loses a race with another writer
+LEASE_SCRIPT_MAX_TRIES = 3
+# Runs of the lease script on one shard to declare the numbers it needs, such as
+# the session's number or a free number it picked
+LEASE_SCRIPT_MAX_DECLARES = 4
+# Free numbers the lease script returns for the next lease on the shard to
+# declare, so it rarely needs a second run to declare the number it picks
+LEASE_SCRIPT_CANDIDATES = 2
+NUMBER_POOL_REAPER_BATCH_SIZE = 100
+# Max keys per MGET when reading number contexts in bulk
+NUMBER_CONTEXT_BATCH_SIZE = 500
+# Fields of number contexts stored in the hash format. request_context is
+# stored as JSON in its own field.
+NUMBER_CONTEXT_HASH_FIELDS = ("pool_id", "leased_at", "renewed_at", "request_context")
+# Request context fields kept in the attribution snapshot of each number,
+# alongside pool_id, leased_at and renewed_at (see get_number_attribution)
+NUMBER_ATTRIBUTION_REQUEST_FIELDS = ("sid", "ip", "user_agent", "zip")
 POOL_SESSION_KEY = "sid"
 POOL_IP_KEY = "ip"
 POOL_USER_AGENT_KEY = "user_agent"
@@ -72,61 +143,1602 @@ class NumberMaxRenewalExceeded(Exception):
     pass
 
 
-class NumberSessionKeyMismatch(Exception):
-    pass
+class NumberSessionKeyMismatch(Exception):
+    pass
+
+
+class NumberStatus(metaclass=ClassValueContainsMeta):
+    FREE = "free"
+    TAKEN = "taken"
+    EXPIRED = "expired"
+
+
+class NumberPoolLeaseModes(metaclass=ClassValueContainsMeta):
+    SCRIPT = "script"
+    LOCK = "lock"
+
+
+class NumberPoolLockScopes(metaclass=ClassValueContainsMeta):
+    POOL = "pool"
+    NUMBER = "number"
+
+
+class NumberContextFormats(metaclass=ClassValueContainsMeta):
+    JSON = "json"
+    HASH = "hash"
+
+
+class NumberPoolKeyLayouts(metaclass=ClassValueContainsMeta):
+    V1 = "v1"
+    V2 = "v2"
+
+
+class LeaseScriptStatus(metaclass=ClassValueContainsMeta):
+    LEASED = "leased"
+    RENEW = "renew"
+    NOT_FOUND = "not_found"
+    MAX_RENEWAL = "max_renewal"
+    EMPTY = "empty"
+    UNDECLARED = "undeclared"
+
+
+class FreeNumbersScriptOps(metaclass=ClassValueContainsMeta):
+    ADD = "add"
+    REMOVE = "remove"
+    REBUILD = "rebuild"
+
+
+class NumberPoolResponseStatus(metaclass=ClassValueContainsMeta):
+    ERROR = "error"
+    SUCCESS = "success"
+    PENDING = "pending"
+
+
+class NumberPoolResponseMessages(metaclass=ClassValueContainsMeta):
+    POOL_UNAVAILABLE = "pool unavailable"
+    NUMBER_UNAVAILABLE = "number unavailable"
+    EMPTY = "pool empty"
+    NO_SID = "no session ID"
+    EXPIRED = "expired"
+    NOT_FOUND = "not found"
+    MAX_RENEWAL = "maximum renewal exceeded"
+    INTERNAL_ERROR = "internal error"
+
+
+number_pool_conn = None
+
+
+def get_number_pool_conn(tries=NUMBER_POOL_CONNECT_TRIES, refresh=False):
+    global number_pool_conn
+    if (not number_pool_conn) or refresh:
+        while True:
+            try:
+                if number_pool_conn:
+                    # Drop the old pool's connections rather than leaking them
+                    number_pool_conn.connection_pool.disconnect()
+                number_pool_conn = create_redis_client()
+                info("Connected to Redis number pool")
+                break
+            except Exception as e:
+                tries -= 1
+                if tries <= 0:
+                    msg = f"Could not connect to Redis number pool: {str(e)}"
+                    error(msg)
+                    rollbar.report_message(dict(msg=msg), "error")
+                    break
+                warn("Retrying Redis number pool connection...")
+                time.sleep(1)
+    return number_pool_conn
+
+
+redis_family_conns = {}
+
+
+def get_redis_family_conn(family, refresh=False):
+    """The client for a data family (see RedisFamilies). Families without
+    their own URL in REDIS_FAMILY_URLS share the number pool client, which is
+    not refreshed here."""
+    url = get_redis_family_url(family)
+    if not url:
+        return get_number_pool_conn()
+    conn = redis_family_conns.get(url, None)
+    if (not conn) or refresh:
+        if conn:
+            conn.connection_pool.disconnect()
+        # Connects lazily, connection errors surface on first use
+        conn = redis_family_conns[url] = create_redis_client(url=url)
+        info(f"Created Redis {family} client")
+    return conn
+
+
+class PoolPropertiesCache:
+    """Per-process cache of pool properties shared by the sync and async pool
+    APIs. set_pool_properties publishes the pool ID on POOL_PROPERTIES_CHANNEL
+    and a listener thread in every process drops that pool's entry, so entries
+    otherwise never expire. Every (re)subscribe also clears the cache, since
+    changes may have been missed while disconnected. Until the listener is
+    subscribed, entries expire after POOL_PROPERTIES_CACHE_EXPIRATION.
+
+    Every invalidation bumps the generation. Readers take the generation
+    before reading Redis and pass it to set, which skips caching a value that
+    an invalidation may have made stale in the meantime.
+
+    The pool ID of each number looked up in the v2 key layout is cached here
+    too, while subscribed. Invalidating a pool drops its numbers and the
+    numbers found in no pool, since a reset of the pool may have moved them."""
+
+    def __init__(self):
+        self.properties = {}
+        self.updated_at = {}
+        self.number_pool_ids = {}
+        self.generation = 0
+        self.subscribed = False
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+
+    def get(self, pool_id):
+        if pool_id not in self.properties:
+            return None
+        if not self.subscribed:
+            cache_age = time.monotonic() - self.updated_at.get(pool_id, 0)
+            if cache_age >= POOL_PROPERTIES_CACHE_EXPIRATION:
+                return None
+        return self.properties[pool_id]
+
+    def set(self, pool_id, properties, generation=None):
+        """Cache properties read at generation, or unconditionally if None.
+        Returns False if they were not cached."""
+        with self._cache_lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self.properties[pool_id] = properties
+            self.updated_at[pool_id] = time.monotonic()
+            return True
+
+    def get_number_pool_id(self, number):
+        """The cached pool ID of a number, False if it is in no pool, or None
+        if not cached"""
+        return self.number_pool_ids.get(number, None)
+
+    def set_number_pool_id(self, number, pool_id, generation=None):
+        """Cache the pool ID of a number, or False if it is in no pool. See
+        set for generation."""
+        with self._cache_lock:
+            if not self.subscribed:
+                return False
+            if generation is not None and generation != self.generation:
+                return False
+            self.number_pool_ids[number] = pool_id
+            return True
+
+    def invalidate(self, pool_id=None):
+        with self._cache_lock:
+            self.generation += 1
+            if pool_id is None:
+                self.properties.clear()
+                self.updated_at.clear()
+                self.number_pool_ids.clear()
+                return
+            self.properties.pop(pool_id, None)
+            self.updated_at.pop(pool_id, None)
+            self.number_pool_ids = {
+                number: number_pool_id
+                for number, number_pool_id in self.number_pool_ids.items()
+                if number_pool_id not in (pool_id, False)
+            }
+
+    def start_listener(self, conn):
+        """Start the listener thread for this process if not running. Safe to
+        call repeatedly and after a fork, where the parent's thread is gone."""
+        if conn is None:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._listener.is_alive():
+                return
+            self._pid = os.getpid()
+            self.subscribed = False
+            self.invalidate()
+            self._listener = threading.Thread(
+                target=self._listen,
+                args=(conn,),
+                name="pool-properties-listener",
+                daemon=True,
+            )
+            self._listener.start()
+
+    def _listen(self, conn):
+        pubsub = None
+        while True:
+            try:
+                if not pubsub:
+                    pubsub = conn.pubsub()
+                    pubsub.subscribe(POOL_PROPERTIES_CHANNEL)
+                message = pubsub.get_message(timeout=1)
+                if message:
+                    self._handle_message(message)
+            except Exception as e:
+                warn(f"Pool properties listener error: {e}")
+                self.subscribed = False
+                if pubsub:
+                    pubsub.close()
+                    pubsub = None
+                time.sleep(POOL_PROPERTIES_LISTENER_RETRY_INTERVAL)
+
+    def _handle_message(self, message):
+        if message["type"] == "subscribe":
+            # Also sent when the client resubscribes after reconnecting
+            self.invalidate()
+            self.subscribed = True
+        elif message["type"] == "message":
+            data = message["data"]
+            if data == POOL_PROPERTIES_ALL:
+                self.invalidate()
+                return
+            dbg(f"Pool properties changed for pool {data}")
+            self.invalidate(int(data) if data.isdigit() else data)
+
+
+pool_properties_cache = PoolPropertiesCache()
+
+
+class NumberPoolAPIBase:
+    """Key names and context helpers shared by NumberPoolAPI and
+    AsyncNumberPoolAPI. None of these talk to Redis, see NumberPoolAPI for a
+    description of the data structures."""
+
+    def _get_pool_properties_key(self, pool_id):
+        return f"pool_properties:{pool_id}"
+
+    def get_cached_route_key(self, call_from, call_to):
+        return f"{call_from}->{call_to}"
+
+    def _is_ignored_phone_user_id(self, user_id):
+        if user_id is None:
+            return False
+        return user_id.lower().lstrip("+") in IGNORED_USER_CONTEXT_CALLER_IDS
+
+    def get_user_context_key(self, id_type, user_id):
+        return f"{id_type}:{user_id}"
+
+    def get_static_number_key(self, number):
+        return f"static:{number}"
+
+    def is_same_ip_user_agent(self, pool_id, req_ctx1, req_ctx2):
+        return self.is_same_attribution_ip_user_agent(
+            self._get_request_attribution(pool_id, req_ctx1),
+            self._get_request_attribution(pool_id, req_ctx2),
+        )
+
+    def is_same_attribution_ip_user_agent(self, attribution1, attribution2):
+        """Compare the IP and user agent of two attribution snapshots, see
+        get_number_attribution"""
+        ip1, ip2 = attribution1.get("ip", None), attribution2.get("ip", None)
+        ua1 = attribution1.get("user_agent", None)
+        ua2 = attribution2.get("user_agent", None)
+        if not (ip1 and ip2 and ua1 and ua2):
+            return False
+        return (ip1 == ip2) and (ua1 == ua2)
+
+    def _check_key_layout(self, key_layout):
+        key_layout = key_layout or settings.NUMBER_POOL_KEY_LAYOUT
+        raiseifnot(
+            key_layout in NumberPoolKeyLayouts, f"Invalid key layout: {key_layout}"
+        )
+        return key_layout
+
+    def _is_v2_key_layout(self):
+        return self.key_layout == NumberPoolKeyLayouts.V2
+
+    def _get_pool_tag(self, pool_id, shard):
+        """The hash tag of a pool shard's keys, so they land in the same cluster
+        slot"""
+        raiseif(pool_id is None, "Pool ID required for tagged keys")
+        return f"{{{pool_id}:{shard or 0}}}"
+
+    def _get_pool_key_id(self, pool_id, shard=None):
+        """The pool ID in the v1 names of a pool's free/taken structures. Shards
+        are hash tagged so all keys of a shard land in the same cluster slot."""
+        if shard is None:
+            return pool_id
+        return self._get_pool_tag(pool_id, shard)
+
+    def _get_pool_structure_name(self, pool_id, shard, name, v1_name):
+        """The name of one of a shard's free/taken structures. v2 names are
+        hash tagged with the pool and shard, so they share a slot with the
+        number contexts of the shard."""
+        if self._is_v2_key_layout():
+            return f"pool:{self._get_pool_tag(pool_id, shard)}:{name}"
+        return f"Pool: {self._get_pool_key_id(pool_id, shard)} / {v1_name}"
+
+    def _get_free_pool_name(self, pool_id, shard=None):
+        return self._get_pool_structure_name(pool_id, shard, "free", "Free")
+
+    def _get_taken_pool_name(self, pool_id, shard=None):
+        return self._get_pool_structure_name(pool_id, shard, "taken", "Taken")
+
+    def _get_free_area_code_pool_name(self, pool_id, area_code, shard=None):
+        return self._get_pool_structure_name(
+            pool_id, shard, f"free:{area_code}", f"Free / {area_code}"
+        )
+
+    def _get_free_area_code_counts_name(self, pool_id, shard=None):
+        return self._get_pool_structure_name(
+            pool_id, shard, "free_counts", "Free Area Code Counts"
+        )
+
+    def _get_taken_area_code_pool_name(self, pool_id, area_code, shard=None):
+        return self._get_pool_structure_name(
+            pool_id, shard, f"taken:{area_code}", f"Taken / {area_code}"
+        )
+
+    def _get_confirmed_pool_name(self, pool_id, shard=None):
+        """Sorted set of the numbers with confirmed renewals, scored by the
+        time of the last one, so snapshots can find them"""
+        return self._get_pool_structure_name(pool_id, shard, "confirmed", "Confirmed")
+
+    def _get_number_area_code(self, number):
+        return number[:3]
+
+    def _get_session_number_hash_name(self, pool_id, shard=None):
+        return self._get_pool_structure_name(pool_id, shard, "sids", "SID Number Hash")
+
+    def _get_pool_version_key(self, pool_id):
+        return f"Pool: {pool_id} / Version"
+
+    def _get_pool_shards_key(self, pool_id):
+        return f"Pool: {pool_id} / Shards"
+
+    def _get_pool_snapshot_key(self, pool_id):
+        return f"Pool: {pool_id} / Snapshot At"
+
+    def _get_shards(self, shard_count):
+        """The shards of a pool with shard_count shards. Unsharded pools have a
+        single shard of None in the v1 layout, which keeps the unsharded key
+        names."""
+        if shard_count <= 1 and not self._is_v2_key_layout():
+            return [None]
+        return list(range(max(shard_count, 1)))
+
+    def _get_shard(self, value, shard_count):
+        """The shard a number or session ID hashes to"""
+        if shard_count <= 1:
+            return 0 if self._is_v2_key_layout() else None
+        return zlib.crc32(value.encode("utf-8")) % shard_count
+
+    def _group_by_shard(self, numbers, shard_count):
+        res = {}
+        for number in numbers:
+            res.setdefault(self._get_shard(number, shard_count), []).append(number)
+        return res
+
+    def _get_number_key_shard(self, number, shard_count=None):
+        """The shard tagging a number's context keys, given the shard count of
+        its pool. Only used by the v2 layout, see _get_number_shard_count."""
+        if not self._is_v2_key_layout():
+            return None
+        raiseif(shard_count is None, "v2 number keys need their pool's shard count")
+        return self._get_shard(number, shard_count)
+
+    def _get_number_key_prefix(self, pool_id=None, shard=None):
+        """Prefix of the number context keys of a pool shard. v1 contexts are
+        keyed by the bare number, in any pool."""
+        if self._is_v2_key_layout():
+            return f"number:{self._get_pool_tag(pool_id, shard)}:"
+        return ""
+
+    def _get_number_key(self, number, pool_id=None, shard_count=None):
+        """The context key of a number. The pool ID is only needed in the v2
+        layout, see _get_number_pool_id."""
+        shard = self._get_number_key_shard(number, shard_count=shard_count)
+        return self._get_number_key_prefix(pool_id, shard) + number
+
+    def _get_context_updates_prefix(self, pool_id=None, shard=None):
+        if self._is_v2_key_layout():
+            return f"context_updates:{self._get_pool_tag(pool_id, shard)}:"
+        return "context_updates:"
+
+    def _get_context_updates_key(self, number, pool_id=None, shard_count=None):
+        shard = self._get_number_key_shard(number, shard_count=shard_count)
+        return self._get_context_updates_prefix(pool_id, shard) + number
+
+    def _get_attribution_prefix(self, pool_id=None, shard=None):
+        if self._is_v2_key_layout():
+            return f"attribution:{self._get_pool_tag(pool_id, shard)}:"
+        return "attribution:"
+
+    def _get_attribution_key(self, number, pool_id=None, shard_count=None):
+        shard = self._get_number_key_shard(number, shard_count=shard_count)
+        return self._get_attribution_prefix(pool_id, shard) + number
+
+    def _group_by_area_code(self, numbers):
+        res = {}
+        for number in numbers:
+            res.setdefault(self._get_number_area_code(number), []).append(number)
+        return res
+
+    def _get_pool_session_key(self, pool_id):
+        # TODO make this configurable per pool
+        return POOL_SESSION_KEY
+
+    def _get_session_id(self, pool_id, request_context):
+        key = self._get_pool_session_key(pool_id)
+        return request_context.get(key, None)
+
+    def _get_pool_ip_key(self, pool_id):
+        # TODO make this configurable per pool
+        return POOL_IP_KEY
+
+    def _get_session_ip(self, pool_id, request_context):
+        key = self._get_pool_ip_key(pool_id)
+        return request_context.get(key, None)
+
+    def _get_pool_user_agent_key(self, pool_id):
+        # TODO make this configurable per pool
+        return POOL_USER_AGENT_KEY
+
+    def _get_session_user_agent(self, pool_id, request_context):
+        key = self._get_pool_user_agent_key(pool_id)
+        return request_context.get(key, None)
+
+    def _get_request_attribution(self, pool_id, request_context):
+        """The attribution fields set in a request context, as strings"""
+        request_context = request_context or {}
+        zip_code = None
+        latest_ctx = request_context.get("latest_context", None)
+        if latest_ctx and settings.POOL_CONTEXT_ZIP_KEY:
+            try:
+                zip_code = rgetkey(latest_ctx, settings.POOL_CONTEXT_ZIP_KEY, None)
+            except TypeError:
+                pass
+        res = dict(
+            sid=self._get_session_id(pool_id, request_context),
+            ip=self._get_session_ip(pool_id, request_context),
+            user_agent=self._get_session_user_agent(pool_id, request_context),
+            zip=zip_code,
+        )
+        return {k: str(v) for k, v in res.items() if v is not None}
+
+    def _get_attribution_fields(self, context):
+        """Get the attribution snapshot hash fields for a number context"""
+        fields = dict(
+            pool_id=str(int(context["pool_id"])),
+            leased_at=repr(float(context["leased_at"])),
+            renewed_at=repr(float(context["renewed_at"])),
+        )
+        fields.update(
+            self._get_request_attribution(
+                context["pool_id"], context.get("request_context", None)
+            )
+        )
+        return fields
+
+    def _get_context_attribution(self, context):
+        """Build the attribution snapshot of a number or route context"""
+        if not context:
+            return None
+        return self._decode_attribution_fields(self._get_attribution_fields(context))
+
+    def _decode_attribution_fields(self, fields):
+        if not fields:
+            return None
+        res = dict(
+            pool_id=int(fields["pool_id"]),
+            leased_at=float(fields["leased_at"]),
+            renewed_at=float(fields["renewed_at"]),
+        )
+        for field in NUMBER_ATTRIBUTION_REQUEST_FIELDS:
+            res[field] = fields.get(field, None)
+        return res
+
+    def _merge_request_context(self, ctx, request_context):
+        """Merge a renewal request context into a number context in place"""
+        # HACK: we can overwrite everything besides these dicts which need to be merged
+        # such that the new request_context values take precedence. We should
+        # probably change this to a more proper dict merge!
+        visits = ctx["request_context"].get("visits", None) or {}
+        for vid, visit in (request_context.get("visits", None) or {}).items():
+            # Move repeat visits to the end so visits stay ordered by recency
+            visits.pop(vid, None)
+            visits[vid] = visit
+        request_context["visits"] = visits
+
+        latest_context = ctx["request_context"].get("latest_context", {}) or {}
+        latest_context.update(request_context.get("latest_context", {}) or {})
+        request_context["latest_context"] = latest_context
+
+        ctx["request_context"].update(request_context)
+
+    def _apply_context_updates(self, ctx, updates):
+        """Fold the request contexts appended by confirmed renewals into a
+        number context in place, oldest first"""
+        if not (ctx and updates):
+            return ctx
+        if ctx.get("request_context", None) is None:
+            ctx["request_context"] = {}
+        for update in updates:
+            self._merge_request_context(ctx, loads_json(update))
+        return ctx
+
+    def _create_number_context(self, pool_id, request_context, pool_props=None):
+        now = time.time()
+        if request_context and request_context.get("visits", None):
+            request_context = dict(request_context)
+            self._apply_visits_policy(pool_id, pool_props, request_context)
+        return dict(
+            pool_id=pool_id,
+            request_context=request_context,
+            leased_at=now,
+            renewed_at=now,
+        )
+
+    def _number_context_age(self, context):
+        renewed_at = context["renewed_at"]
+        return int(time.time() - renewed_at)
+
+    def _get_lease_callers_key(self, number, context):
+        return f"lease_callers:{context['pool_id']}:{number}:{context['leased_at']}"
+
+    def _is_wrong_type_error(self, e):
+        # Errors raised by pipelines are prefixed with the failed command
+        return isinstance(e, ResponseError) and "WRONGTYPE" in str(e)
+
+    def _has_number_keys(self, pool_id):
+        """Whether a number in pool_id, as found by _get_number_pool_id, may have
+        context keys. In the v2 layout numbers in no pool have none."""
+        return pool_id is not None or not self._is_v2_key_layout()
+
+    def _parse_number_pool_id(self, value):
+        """Parse a number's entry in NUMBER_POOL_IDS_KEY, False if none"""
+        return int(value) if value else False
+
+    def _queue_number_context_read(
+        self, pipeline, number, context_format, pool_id, shard_count=None
+    ):
+        key = self._get_number_key(number, pool_id=pool_id, shard_count=shard_count)
+        if context_format == NumberContextFormats.HASH:
+            pipeline.hgetall(key)
+        else:
+            pipeline.get(key)
+        pipeline.lrange(
+            self._get_context_updates_key(
+                number, pool_id=pool_id, shard_count=shard_count
+            ),
+            0,
+            -1,
+        )
+
+    def _parse_number_context(self, context_format, res, updates):
+        """Parse the results of _queue_number_context_read. Returns the context
+        and the stored hash fields, or None for the fields if the context is
+        stored as JSON."""
+        if not res:
+            return None, None
+        if context_format == NumberContextFormats.JSON:
+            return self._apply_context_updates(loads_json(res), updates), None
+        ctx = self._decode_context_fields(res)
+        return self._apply_context_updates(ctx, updates), res
+
+    def _merge_user_context(self, current_ctx, context):
+        if current_ctx:
+            # Second arg overwrites first on conflict
+            return dictmerge(current_ctx, context, overwrite=True)
+        return context
+
+    def _get_call_context_keys(self, call_from, call_to):
+        """The keys of the cached contexts of a call by name, with the client
+        that serves each"""
+        keys = dict(static=(self.conn, self.get_static_number_key(call_to)))
+        if not self._is_ignored_phone_user_id(call_from):
+            keys["route"] = (
+                self.route_conn,
+                self.get_cached_route_key(call_from, call_to),
+            )
+            keys["user"] = (
+                self.user_context_conn,
+                self.get_user_context_key(UserIDTypes.PHONE, call_from),
+            )
+        return keys
+
+    def _queue_call_context_reads(
+        self, call_from, call_to, pool_id=None, shard_count=None
+    ):
+        """Queue the reads of all contexts of a call, one pipeline per client.
+        pool_id is the pool of call_to, see _get_number_pool_id, and
+        shard_count its shard count, see _get_number_shard_count. Returns
+        (pipeline, names) pairs, where names are the context names read by the
+        GETs ending the pipeline. The first pipeline is on the pool client and
+        starts with the number context and attribution snapshot reads, unless
+        the number can't have any (see _has_number_keys). The keys are in
+        different Redis Cluster slots, so each is read with its own GET rather
+        than an MGET."""
+        groups = {id(self.conn): (self.conn, [])}
+        for name, (conn, key) in self._get_call_context_keys(
+            call_from, call_to
+        ).items():
+            groups.setdefault(id(conn), (conn, []))[1].append((name, key))
+
+        res = []
+        for conn, named_keys in groups.values():
+            pipeline = conn.pipeline(transaction=False)
+            if conn is self.conn and self._has_number_keys(pool_id):
+                self._queue_number_context_read(
+                    pipeline, call_to, self.context_format, pool_id, shard_count
+                )
+                pipeline.hgetall(
+                    self._get_attribution_key(
+                        call_to, pool_id=pool_id, shard_count=shard_count
+                    )
+                )
+            for _, key in named_keys:
+                get_encoded(pipeline, key)
+            res.append((pipeline, [name for name, _ in named_keys]))
+        return res
+
+    def _parse_call_contexts(self, results, pool_id=None):
+        """Parse the (names, pipeline results) of _queue_call_context_reads
+        with the same pool_id. Returns the contexts by name, and whether the
+        number context is not in the configured format and must be read
+        again."""
+        contexts = dict(pool=None, attribution=None, route=None, user=None, static=None)
+        reread = False
+        for i, (names, values) in enumerate(results):
+            for value in values:
+                if isinstance(value, Exception) and not (
+                    i == 0 and self._is_wrong_type_error(value)
+                ):
+                    raise value
+            if i == 0 and self._has_number_keys(pool_id):
+                res, updates, attribution = values[:3]
+                if self._is_wrong_type_error(res):
+                    reread = True
+                else:
+                    contexts["pool"], _ = self._parse_number_context(
+                        self.context_format, res, updates
+                    )
+                contexts["attribution"] = self._decode_attribution_fields(attribution)
+            for name, value in zip(names, values[len(values) - len(names) :]):
+                contexts[name] = self.codec.loads(value) if value else None
+        return contexts, reread
+
+    def _queue_call_context_writes(
+        self, call_from, call_to, context, user_contexts=None
+    ):
+        """Queue the write-backs of a call, one pipeline per client.
+        user_contexts is a list of (id_type, user_id, context) to set. Returns
+        the pipelines and the one that ends with the lease callers count. The
+        keys are in different Redis Cluster slots and each write stands on its
+        own, so the pipelines are not transactions."""
+        pipelines = {}
+
+        def get_pipeline(conn):
+            if id(conn) not in pipelines:
+                pipelines[id(conn)] = conn.pipeline(transaction=False)
+            return pipelines[id(conn)]
+
+        for id_type, user_id, user_context in user_contexts or []:
+            if id_type == UserIDTypes.PHONE and self._is_ignored_phone_user_id(user_id):
+                continue
+            get_pipeline(self.user_context_conn).set(
+                self.get_user_context_key(id_type, user_id),
+                self.codec.dumps(user_context),
+                ex=NUMBER_POOL_USER_CONTEXT_EXPIRATION,
+            )
+
+        if not self._is_ignored_phone_user_id(call_from):
+            get_pipeline(self.route_conn).set(
+                self.get_cached_route_key(call_from, call_to),
+                self.codec.dumps(self._number_context_value(context)),
+                ex=NUMBER_POOL_ROUTE_CACHE_EXPIRATION,
+            )
+
+        lease_callers_pipeline = get_pipeline(self.lease_callers_conn)
+        self._queue_lease_caller(lease_callers_pipeline, call_to, context, call_from)
+        return list(pipelines.values()), lease_callers_pipeline
+
+    def _number_context_value(self, context):
+        """Get the stored fields of a number context with their types checked.
+        A cheaper stand-in for NumberPoolCacheValue on the lease path."""
+        request_context = context.get("request_context", None)
+        raiseifnot(
+            request_context is None or isinstance(request_context, dict),
+            f"Invalid request context: {request_context}",
+        )
+        return dict(
+            pool_id=int(context["pool_id"]),
+            leased_at=float(context["leased_at"]),
+            renewed_at=float(context["renewed_at"]),
+            request_context=request_context,
+        )
+
+    def _encode_context_fields(self, context):
+        """Get the hash fields for a number context in the hash format"""
+        context = self._number_context_value(context)
+        return dict(
+            pool_id=str(context["pool_id"]),
+            leased_at=repr(context["leased_at"]),
+            renewed_at=repr(context["renewed_at"]),
+            request_context=dumps_json(context["request_context"]),
+        )
+
+    def _decode_context_fields(self, fields):
+        return dict(
+            pool_id=int(fields["pool_id"]),
+            leased_at=float(fields["leased_at"]),
+            renewed_at=float(fields["renewed_at"]),
+            request_context=loads_json(fields.get("request_context", None) or "null"),
+        )
+
+    def _decode_script_context(self, raw):
+        """Decode a raw context returned by the lease script. Returns the
+        context and the stored hash fields, or None for the fields if the
+        context is stored as JSON."""
+        if raw.startswith('["hash"'):
+            values = loads_json(raw)[1:]
+            fields = {
+                name: value
+                for name, value in zip(NUMBER_CONTEXT_HASH_FIELDS, values)
+                if value is not False
+            }
+            return self._decode_context_fields(fields), fields
+        return loads_json(raw), None
+
+    def _get_context_writes(self, context, stored_fields=None):
+        """Get the hash fields to write for a context in the hash format. If the
+        context is already stored as a hash only the changed fields are
+        returned, and those are safe to write without deleting the key first."""
+        fields = self._encode_context_fields(context)
+        if stored_fields is None:
+            return fields
+        return {k: v for k, v in fields.items() if stored_fields.get(k, None) != v}
+
+    def _queue_number_context(
+        self, pipeline, number, context, stored_fields=None, shard_count=None
+    ):
+        """Queue writing a number context in the configured format. Pass the
+        stored hash fields if the context was read from a hash so only the
+        changed fields are written, and the shard count of the context's pool
+        in the v2 layout. Must be queued on a transaction pipeline."""
+        pool_id = context["pool_id"]
+        keys = dict(pool_id=pool_id, shard_count=shard_count)
+        # Writers read the context with its updates folded in
+        pipeline.delete(self._get_context_updates_key(number, **keys))
+        attribution_key = self._get_attribution_key(number, **keys)
+        pipeline.delete(attribution_key)
+        pipeline.hset(attribution_key, mapping=self._get_attribution_fields(context))
+        key = self._get_number_key(number, **keys)
+        if self.context_format == NumberContextFormats.JSON:
+            pipeline.set(key, dumps_json(self._number_context_value(context)))
+            return
+        fields = self._get_context_writes(context, stored_fields=stored_fields)
+        if stored_fields is None:
+            # May currently be stored as JSON
+            pipeline.delete(key)
+        if fields:
+            pipeline.hset(key, mapping=fields)
+
+    def _queue_taken_number(
+        self,
+        pipeline,
+        pool_id,
+        number,
+        context,
+        sid=None,
+        update=False,
+        stored_fields=None,
+        shard=None,
+        shard_count=None,
+    ):
+        """Queue the taken set entries, context and session mapping for a
+        number on a pipeline. The taken set ZADD is queued first, so its result
+        is the first one returned by the pipeline."""
+        mapping = {number: str(context["renewed_at"])}
+        taken_name = self._get_taken_pool_name(pool_id, shard=shard)
+        if update:
+            # Only update, and return count of changed
+            pipeline.zadd(taken_name, mapping, xx=True, ch=True)
+        else:
+            pipeline.zadd(taken_name, mapping)
+        area_code = self._get_number_area_code(number)
+        pipeline.zadd(
+            self._get_taken_area_code_pool_name(pool_id, area_code, shard=shard),
+            mapping,
+        )
+        self._queue_number_context(
+            pipeline,
+            number,
+            context,
+            stored_fields=stored_fields,
+            shard_count=shard_count,
+        )
+        if sid:
+            pipeline.hset(
+                self._get_session_number_hash_name(pool_id, shard=shard),
+                sid,
+                value=number,
+            )
+
+    def _get_init_lock_name(self):
+        return "Pool Init"
+
+    def _get_pool_lock_name(self, pool_id):
+        return f"Pool: {pool_id} / Lock"
+
+    def _get_number_lock_name(self, pool_id, number):
+        return f"Pool: {pool_id} / Number: {number} / Lock"
+
+    def _is_area_code_pool_properties(self, pool_props):
+        return ((pool_props or {}).get("area_code", None) or "").lower() == "all"
+
+    def _get_cache_expiration_from_properties(self, pool_id, pool_props):
+        expiration = (pool_props or {}).get(
+            NUMBER_POOL_CACHE_EXPIRATION_PROPERTY, NUMBER_POOL_CACHE_EXPIRATION
+        )
+        try:
+            if isinstance(expiration, bool):
+                raise ValueError
+            expiration = int(expiration)
+            if expiration <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            warn(
+                f"Invalid {NUMBER_POOL_CACHE_EXPIRATION_PROPERTY} for pool "
+                f"{pool_id}: {expiration}, using {NUMBER_POOL_CACHE_EXPIRATION}"
+            )
+            return NUMBER_POOL_CACHE_EXPIRATION
+        return expiration
+
+    def _get_visits_policy_from_properties(self, pool_id, pool_props):
+        """Get the max visits, max visits bytes and summary flag for a pool.
+        A limit of 0 means unbounded."""
+        pool_props = pool_props or {}
+        limits = []
+        for prop, default in (
+            (NUMBER_POOL_MAX_VISITS_PROPERTY, settings.NUMBER_POOL_MAX_VISITS),
+            (
+                NUMBER_POOL_MAX_VISITS_BYTES_PROPERTY,
+                settings.NUMBER_POOL_MAX_VISITS_BYTES,
+            ),
+        ):
+            limit = pool_props.get(prop, default)
+            try:
+                if isinstance(limit, bool):
+                    raise ValueError
+                limit = int(limit)
+                if limit < 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                warn(f"Invalid {prop} for pool {pool_id}: {limit}, using {default}")
+                limit = default
+            limits.append(limit)
+        summary = bool(
+            pool_props.get(
+                NUMBER_POOL_VISITS_SUMMARY_PROPERTY, settings.NUMBER_POOL_VISITS_SUMMARY
+            )
+        )
+        return limits[0], limits[1], summary
+
+    def _apply_visits_policy(self, pool_id, pool_props, request_context, recent=None):
+        """Bound the visits of a request context in place according to the
+        pool's visits policy. Visits are assumed ordered oldest first, apart
+        from the vids in recent which are treated as the most recent in that
+        order. The oldest visits are dropped first, but the most recent visit is
+        always kept."""
+        visits = (request_context or {}).get("visits", None)
+        if not visits:
+            return
+        max_visits, max_bytes, summary = self._get_visits_policy_from_properties(
+            pool_id, pool_props
+        )
+        if recent:
+            recent = [vid for vid in recent if vid in visits]
+            recent_vids = set(recent)
+            vids = [vid for vid in visits if vid not in recent_vids] + recent
+        else:
+            vids = list(visits)
+
+        if summary:
+            visits = {
+                vid: (
+                    {k: v for k, v in visit.items() if k in VISIT_SUMMARY_KEYS}
+                    if isinstance(visit, dict)
+                    else visit
+                )
+                for vid, visit in visits.items()
+            }
+
+        if max_visits:
+            vids = vids[-max_visits:]
+
+        if max_bytes:
+            sizes = [len(dumps_json({vid: visits[vid]})) for vid in vids]
+            total = sum(sizes)
+            while len(vids) > 1 and total > max_bytes:
+                total -= sizes.pop(0)
+                vids.pop(0)
+
+        request_context["visits"] = {vid: visits[vid] for vid in vids}
+
+    def _get_renewal_throttle_from_properties(self, pool_id, pool_props):
+        throttle = (pool_props or {}).get(
+            NUMBER_POOL_RENEWAL_THROTTLE_PROPERTY, settings.NUMBER_POOL_RENEWAL_THROTTLE
+        )
+        try:
+            if isinstance(throttle, bool):
+                raise ValueError
+            throttle = float(throttle)
+            if not (0 <= throttle < 1):
+                raise ValueError
+        except (TypeError, ValueError):
+            warn(
+                f"Invalid {NUMBER_POOL_RENEWAL_THROTTLE_PROPERTY} for pool "
+                f"{pool_id}: {throttle}, not throttling renewals"
+            )
+            return 0
+        return throttle
+
+    def _get_shard_count_from_properties(self, pool_id, pool_props):
+        default = settings.NUMBER_POOL_SHARDS
+        shard_count = (pool_props or {}).get(NUMBER_POOL_SHARDS_PROPERTY, default)
+        try:
+            if isinstance(shard_count, bool):
+                raise ValueError
+            shard_count = int(shard_count)
+            if shard_count <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            warn(
+                f"Invalid {NUMBER_POOL_SHARDS_PROPERTY} for pool {pool_id}: "
+                f"{shard_count}, using {default}"
+            )
+            return default
+        return shard_count
+
+    def _get_lease_shards(self, pool_id, pool_props, request_context, target_number):
+        """Get the shards to try in order for a lease: the target number's
+        shard, or else the session's home shard, followed by the others"""
+        shard_count = self._get_shard_count_from_properties(pool_id, pool_props)
+        if shard_count <= 1:
+            return self._get_shards(shard_count)
+        sid = self._get_session_id(pool_id, request_context or {})
+        if target_number:
+            first = self._get_shard(target_number, shard_count)
+        elif sid:
+            first = self._get_shard(str(sid), shard_count)
+        else:
+            first = random.randrange(shard_count)
+        return [(first + i) % shard_count for i in range(shard_count)]
+
+    def _get_lease_passes(self, shards, area_codes):
+        """Get the (area codes, allow expired) passes to run the lease script
+        with over the shards. Sharded pools look for a free number in every
+        shard before taking an expired one, and area code pools try each area
+        code in every shard before moving on to the next one."""
+        if len(shards) == 1:
+            return [(area_codes, True)]
+        passes = []
+        for pass_area_codes in [[area_code] for area_code in area_codes] or [[]]:
+            passes.append((pass_area_codes, False))
+            passes.append((pass_area_codes, True))
+        return passes
+
+    def _queue_oldest_taken(self, pipeline, pool_id, shards, area_codes):
+        """Queue reading the least recently renewed taken number of each
+        shard, or of each of its area code indexes for area code leases"""
+        for shard in shards:
+            if area_codes:
+                for area_code in area_codes:
+                    pipeline.zrange(
+                        self._get_taken_area_code_pool_name(
+                            pool_id, area_code, shard=shard
+                        ),
+                        0,
+                        0,
+                        withscores=True,
+                    )
+            else:
+                pipeline.zrange(
+                    self._get_taken_pool_name(pool_id, shard=shard),
+                    0,
+                    0,
+                    withscores=True,
+                )
+
+    def _get_expired_shards(self, shards, area_codes, oldest_taken, cutoff):
+        """Get the shards with a taken number renewed before cutoff, oldest
+        first, from the results of _queue_oldest_taken"""
+        res = iter(oldest_taken)
+        oldest = {}
+        for shard in shards:
+            scores = []
+            for _ in area_codes or [None]:
+                taken = next(res)
+                if taken:
+                    scores.append(taken[0][1])
+            if scores and min(scores) <= cutoff:
+                oldest[shard] = min(scores)
+        return sorted(oldest, key=lambda shard: oldest[shard])
+
+    def _get_confirm_renewal_params(
+        self,
+        pool_id,
+        request_context,
+        target_number,
+        interval,
+        pool_props=None,
+        session_number=None,
+    ):
+        """Get the keys and args for CONFIRM_RENEWAL_SCRIPT. Without a target
+        number the caller passes the session_number it looked up, if
+        _confirm_needs_session_number."""
+        session_key = self._get_pool_session_key(pool_id)
+        update = {
+            k: v
+            for k, v in request_context.items()
+            if k != session_key and v is not None
+        }
+        number = target_number or session_number
+        shard = self._get_lease_shards(pool_id, pool_props, request_context, number)[0]
+        keys = [
+            self._get_session_number_hash_name(pool_id, shard=shard),
+            self._get_taken_pool_name(pool_id, shard=shard),
+            self._get_confirmed_pool_name(pool_id, shard=shard),
+        ]
+        key_prefixes = self._get_script_key_prefixes(pool_id, shard=shard)
+        if key_prefixes is None:
+            keys.extend(
+                self._get_number_script_keys(
+                    pool_id,
+                    [number],
+                    self._get_shard_count_from_properties(pool_id, pool_props),
+                )
+            )
+        args = [
+            self._get_session_id(pool_id, request_context),
+            number or "",
+            time.time(),
+            interval,
+            session_key,
+            dumps_json(update) if update else "",
+            NUMBER_CONTEXT_UPDATES_MAX,
+            NUMBER_CONTEXT_UPDATES_EXPIRATION,
+            dumps_json(
+                list(
+                    chain.from_iterable(
+                        self._get_request_attribution(pool_id, update).items()
+                    )
+                )
+            ),
+            dumps_json(key_prefixes) if key_prefixes else "",
+        ]
+        return keys, args
+
+    def _confirm_needs_session_number(self, shard_count):
+        """Whether confirming a renewal without a target number needs the
+        session's number looked up first, to find its shard or to declare its
+        keys in the v2 layout"""
+        return shard_count > 1 or self._is_v2_key_layout()
+
+    def _get_renewed_context(
+        self, pool_id, number, context, curr_context, pool_props=None
+    ):
+        """Merge a renewal context into the current number context, raising if
+        the renewal is not allowed"""
+        sid = self._get_session_id(pool_id, context["request_context"])
+        curr_sid = self._get_session_id(pool_id, curr_context["request_context"])
+        if sid != curr_sid:
+            msg = (
+                f"session key mismatch for {pool_id}/{number} {sid}/{curr_sid}, "
+                "can not renew"
+            )
+            warn(msg)
+            raise NumberSessionKeyMismatch(msg)
+
+        recent = list((context["request_context"] or {}).get("visits", None) or {})
+        if context != curr_context:
+            # 2nd arg overwrites 1st on conflict
+            context = dictmerge(curr_context, context, overwrite=True)
+        self._apply_visits_policy(
+            pool_id, pool_props, context["request_context"], recent=recent
+        )
+
+        context["renewed_at"] = time.time()
+        if (context["renewed_at"] - context["leased_at"]) > NUMBER_POOL_MAX_RENEWAL_AGE:
+            msg = f"Not renewing number {pool_id}/{number} due to max renewal time"
+            warn(msg)
+            raise NumberMaxRenewalExceeded(msg)
+        return context
+
+    def _get_lease_area_codes(self, pool_id, pool_props, area_codes):
+        """Get the area codes to try in order for an area code pool lease, ending
+        with the pool's fallback area code"""
+        fallback_area_code = pool_props.get("fallback_area_code", None)
+        raiseifnot(
+            fallback_area_code, f"No fallback area code specified for pool {pool_id}"
+        )
+        if not area_codes:
+            warn(f"Area code not specified, using fallback {fallback_area_code}")
+            return [fallback_area_code]
+
+        for area_code in area_codes:
+            raiseifnot(
+                isinstance(area_code, str)
+                and len(area_code) == 3
+                and area_code.isdigit(),
+                f"Invalid area code: {area_code}",
+            )
+
+        area_codes = list(area_codes)
+        if fallback_area_code not in area_codes:
+            area_codes.append(fallback_area_code)
+        return area_codes
+
+    def _get_lease_script_params(
+        self,
+        pool_id,
+        request_context,
+        target_number,
+        renew,
+        area_codes,
+        expiration,
+        pool_props=None,
+        shard=None,
+        allow_expired=True,
+        declared_numbers=(),
+    ):
+        """Get the keys and args for LEASE_NUMBER_SCRIPT on one shard. The keys
+        of the area codes to try and of declared_numbers, which must include
+        the target number, are passed to the script in the v2 layout. In the v1
+        layout the script derives them, see _get_script_key_prefixes."""
+        context = self._number_context_value(
+            self._create_number_context(pool_id, request_context, pool_props=pool_props)
+        )
+        if self.context_format == NumberContextFormats.HASH:
+            new_context = self._encode_context_fields(context)["request_context"]
+        else:
+            new_context = dumps_json(context)
+        session_key = self._get_pool_session_key(pool_id)
+        sid = self._get_session_id(pool_id, request_context)
+        key_prefixes = self._get_script_key_prefixes(pool_id, shard=shard)
+        if key_prefixes is None:
+            declared_area_codes = list(
+                dict.fromkeys(
+                    [*area_codes, *map(self._get_number_area_code, declared_numbers)]
+                )
+            )
+        else:
+            # Derived by the script
+            declared_area_codes, declared_numbers = [], []
+        keys = [
+            self._get_free_pool_name(pool_id, shard=shard),
+            self._get_taken_pool_name(pool_id, shard=shard),
+            self._get_session_number_hash_name(pool_id, shard=shard),
+            self._get_free_area_code_counts_name(pool_id, shard=shard),
+            *self._get_area_code_script_keys(
+                pool_id, declared_area_codes, shard=shard, taken=True
+            ),
+            *self._get_number_script_keys(
+                pool_id,
+                declared_numbers,
+                self._get_shard_count_from_properties(pool_id, pool_props),
+            ),
+        ]
+        args = [
+            sid or "",
+            target_number or "",
+            1 if renew else 0,
+            context["renewed_at"],
+            expiration,
+            NUMBER_POOL_MAX_RENEWAL_AGE,
+            session_key,
+            1 if session_key in request_context else 0,
+            new_context,
+            self.context_format,
+            pool_id,
+            1 if allow_expired else 0,
+            dumps_json(
+                list(chain.from_iterable(self._get_attribution_fields(context).items()))
+            ),
+            dumps_json(declared_area_codes),
+            dumps_json(list(declared_numbers)),
+            LEASE_SCRIPT_CANDIDATES if key_prefixes is None else 0,
+            dumps_json(key_prefixes) if key_prefixes else "",
+            *area_codes,
+        ]
+        return keys, args
+
+    def _get_script_renewal_params(
+        self,
+        pool_id,
+        number,
+        raw_context,
+        request_context,
+        from_sid=False,
+        pool_props=None,
+        updates=None,
+    ):
+        """Merge any context updates and the request context into the number
+        context read by the lease script and get the keys and args for
+        RENEW_NUMBER_SCRIPT"""
+        context, stored_fields = self._decode_script_context(raw_context)
+        self._apply_context_updates(context, updates)
+        if request_context:
+            self._merge_request_context(context, dict(request_context))
+        recent = list((context["request_context"] or {}).get("visits", None) or {})
+        self._apply_visits_policy(
+            pool_id, pool_props, context["request_context"], recent=recent
+        )
+        context["renewed_at"] = time.time()
+        context = self._number_context_value(context)
+
+        sid = self._get_session_id(pool_id, context["request_context"] or {})
+        area_code = self._get_number_area_code(number)
+        shard_count = self._get_shard_count_from_properties(pool_id, pool_props)
+        shard = self._get_shard(number, shard_count)
+        number_keys = dict(pool_id=pool_id, shard_count=shard_count)
+        keys = [
+            self._get_taken_pool_name(pool_id, shard=shard),
+            self._get_session_number_hash_name(pool_id, shard=shard),
+            self._get_taken_area_code_pool_name(pool_id, area_code, shard=shard),
+            self._get_context_updates_key(number, **number_keys),
+            self._get_number_key(number, **number_keys),
+            self._get_attribution_key(number, **number_keys),
+        ]
+        hash_writes = []
+        if self.context_format == NumberContextFormats.HASH:
+            for field, value in self._get_context_writes(
+                context, stored_fields=stored_fields
+            ).items():
+                hash_writes.extend([field, value])
+        args = [
+            number,
+            hashlib.sha1(raw_context.encode("utf-8")).hexdigest(),
+            (
+                dumps_json(context)
+                if self.context_format == NumberContextFormats.JSON
+                else ""
+            ),
+            context["renewed_at"],
+            "" if (from_sid or not sid) else sid,
+            self.context_format,
+            dumps_json(
+                list(chain.from_iterable(self._get_attribution_fields(context).items()))
+            ),
+            *hash_writes,
+        ]
+        return keys, args
+
+    def _init_options(self, lease_mode, context_format, codec, lock_scope, key_layout):
+        """Set the lease mode, context format, codec, lock scope and key layout,
+        defaulting to the settings"""
+        self.lease_mode = lease_mode or settings.NUMBER_POOL_LEASE_MODE
+        raiseifnot(
+            self.lease_mode in NumberPoolLeaseModes,
+            f"Invalid lease mode: {self.lease_mode}",
+        )
+        self.context_format = context_format or settings.NUMBER_POOL_CONTEXT_FORMAT
+        raiseifnot(
+            self.context_format in NumberContextFormats,
+            f"Invalid context format: {self.context_format}",
+        )
+        self.lock_scope = lock_scope or settings.NUMBER_POOL_LOCK_SCOPE
+        raiseifnot(
+            self.lock_scope in NumberPoolLockScopes,
+            f"Invalid lock scope: {self.lock_scope}",
+        )
+        self.key_layout = self._check_key_layout(key_layout)
+        self.codec = codec or redis_codec
+        # Free numbers to declare to the next lease script run on a shard, see
+        # _cache_lease_candidates
+        self._lease_candidates = {}
+
+    def _get_pool_lock(
+        self,
+        pool_id,
+        timeout=LOCK_HOLD_TIMEOUT,
+        blocking_timeout=LOCK_WAIT_TIMEOUT,
+    ):
+        return self.conn.lock(
+            self._get_pool_lock_name(pool_id),
+            timeout=timeout,
+            blocking_timeout=blocking_timeout,
+        )
+
+    def _get_number_lock(
+        self,
+        pool_id,
+        number,
+        timeout=LOCK_HOLD_TIMEOUT,
+        blocking_timeout=LOCK_WAIT_TIMEOUT,
+    ):
+        return self.conn.lock(
+            self._get_number_lock_name(pool_id, number),
+            timeout=timeout,
+            blocking_timeout=blocking_timeout,
+        )
+
+    def _get_number_scope_lock(self, pool_id, number):
+        """The number lock when locking per number. Otherwise a no-op, since
+        the caller already holds the pool lock."""
+        if self.lock_scope == NumberPoolLockScopes.NUMBER:
+            return self._get_number_lock(pool_id, number)
+        return nullcontext()
+
+    def _get_context_lock(self, pool_id, number):
+        """The lock to hold while updating a number context in place"""
+        if self.lock_scope == NumberPoolLockScopes.NUMBER:
+            return self._get_number_lock(pool_id, number)
+        return self._get_pool_lock(pool_id)
+
+    def _get_other_context_format(self):
+        if self.context_format == NumberContextFormats.HASH:
+            return NumberContextFormats.JSON
+        return NumberContextFormats.HASH
+
+    def _queue_lease_caller(self, pipeline, number, context, call_from):
+        """Queue adding call_from to the callers of a lease, ending with the
+        count of its distinct callers"""
+        key = self._get_lease_callers_key(number, context)
+        pipeline.sadd(key, call_from)
+        pipeline.expire(key, NUMBER_POOL_LEASE_CALLERS_EXPIRATION)
+        pipeline.scard(key)
+
+    def _queue_session_number_reads(
+        self, pipeline, pool_id, pool_props, request_context
+    ):
+        """Queue reading the session's number from every shard, home shard
+        first. Returns False if the request has no session ID."""
+        sid = self._get_session_id(pool_id, request_context)
+        if not sid:
+            return False
+        for shard in self._get_lease_shards(pool_id, pool_props, request_context, None):
+            pipeline.hget(self._get_session_number_hash_name(pool_id, shard=shard), sid)
+        return True
+
+    def _warn_session_number_mismatch(
+        self, pool_id, request_context, sid_number, target_number
+    ):
+        request_sid = self._get_session_id(pool_id, request_context)
+        warn(
+            f"{request_sid}: Session / Target number mismatch: "
+            f"{sid_number} / {target_number}: {request_context}"
+        )
+
+    def _check_lease_script_result(self, pool_id, request_context, target_number, res):
+        """Log the result of the lease script, raising if the target number can
+        not be leased or renewed"""
+        status, number, detail, _, sid_number_mismatch = res
+        if sid_number_mismatch:
+            self._warn_session_number_mismatch(
+                pool_id, request_context, number, target_number
+            )
+        if status == LeaseScriptStatus.LEASED:
+            info(f"Leasing {detail} number {pool_id}/{number}")
+        elif status == LeaseScriptStatus.RENEW:
+            request_sid = self._get_session_id(pool_id, request_context)
+            dbg(f"{request_sid}: target number {number} taken, renewal requested")
+        elif status == LeaseScriptStatus.NOT_FOUND:
+            raise NumberNotFound(f"could not find number {pool_id}/{number}")
+        elif status == LeaseScriptStatus.MAX_RENEWAL:
+            msg = f"Not renewing number {pool_id}/{number} due to max renewal time"
+            warn(msg)
+            raise NumberMaxRenewalExceeded(msg)
+
+    def _get_declared_lease_numbers(self, pool_id, shard, target_number):
+        """The numbers to declare to the first lease script run on a shard: the
+        target number and the candidates cached by the last run"""
+        numbers = [target_number] if target_number else []
+        numbers.extend(self._lease_candidates.get((pool_id, shard), []))
+        return list(dict.fromkeys(numbers))
+
+    def _cache_lease_candidates(self, pool_id, shard, res):
+        """Cache the candidates returned with a lease for the next lease on the
+        shard. Returns the lease script result without them."""
+        if res[0] == LeaseScriptStatus.LEASED and len(res) > 5:
+            self._lease_candidates[(pool_id, shard)] = [
+                number for number in res[5] if number != res[1]
+            ]
+        return res[:5]
+
+    def _declare_lease_number(self, res, declared_numbers):
+        """If the lease script needs the keys of a number it was not given, add
+        it to declared_numbers for the next run and return True"""
+        if res[0] != LeaseScriptStatus.UNDECLARED:
+            return False
+        declared_numbers.append(res[1])
+        return True
+
+    def _get_lease_tries_error(self, pool_id):
+        return NumberPoolUnavailable(
+            f"Could not lease number from pool {pool_id} after "
+            f"{LEASE_SCRIPT_MAX_TRIES} tries"
+        )
 
+    def _check_leased_number(self, number, from_sid, start, lease_state):
+        """Return the leased number, or raise if there is none. lease_state is
+        logged with the error."""
+        request_sid = lease_state.get("request_sid", None)
+        dbg(f"{request_sid}: took {time.time() - start:0.3f}s, number: {number}")
+        if number:
+            return number
+        msg = "No numbers available"
+        exc = NumberPoolEmpty
+        if from_sid:
+            msg = "Session number unavailable"
+            exc = SessionNumberUnavailable
+        error(msg + f": {lease_state}")
+        raise exc(msg)
+
+    def _get_updated_context(
+        self, pool_id, number, ctx, request_context, merge=False, pool_props=None
+    ):
+        """Update a number context with request_context in place for
+        update_number. Returns False if the number is not the session's."""
+        request_sid = self._get_session_id(pool_id, request_context)
+        curr_request_ctx = ctx.get("request_context", {}) or {}
+        curr_sid = self._get_session_id(pool_id, curr_request_ctx)
+        if request_sid != curr_sid:
+            warn(
+                f"session key mismatch for {pool_id}/{number} "
+                f"{request_sid}/{curr_sid}, can not update"
+            )
+            return False
 
-class NumberStatus(metaclass=ClassValueContainsMeta):
-    FREE = "free"
-    TAKEN = "taken"
-    EXPIRED = "expired"
+        if merge:
+            ctx["request_context"] = dictmerge(
+                curr_request_ctx, request_context, overwrite=True
+            )
+        else:
+            ctx["request_context"] = request_context
+        self._apply_visits_policy(
+            pool_id,
+            pool_props,
+            ctx["request_context"],
+            recent=list((request_context or {}).get("visits", None) or {}),
+        )
+        return True
 
+    def _get_area_code_script_keys(self, pool_id, area_codes, shard=None, taken=False):
+        """The keys a script declares for area_codes: the free set of each area
+        code, followed by its taken set if taken"""
+        keys = []
+        for area_code in area_codes:
+            keys.append(self._get_free_area_code_pool_name(pool_id, area_code, shard))
+            if taken:
+                keys.append(
+                    self._get_taken_area_code_pool_name(pool_id, area_code, shard)
+                )
+        return keys
 
-class NumberPoolResponseStatus(metaclass=ClassValueContainsMeta):
-    ERROR = "error"
-    SUCCESS = "success"
+    def _get_script_key_prefixes(self, pool_id, shard=None):
+        """The key prefixes the lease and confirm scripts derive area code and
+        number keys from in the v1 layout instead of having them declared, so
+        no lease takes another run. None in the v2 layout."""
+        if self._is_v2_key_layout():
+            return None
+        return dict(
+            free_area_code=self._get_free_area_code_pool_name(pool_id, "", shard),
+            taken_area_code=self._get_taken_area_code_pool_name(pool_id, "", shard),
+            context=self._get_number_key_prefix(pool_id, shard),
+            context_updates=self._get_context_updates_prefix(pool_id, shard),
+            attribution=self._get_attribution_prefix(pool_id, shard),
+        )
 
+    def _get_number_script_keys(self, pool_id, numbers, shard_count=None):
+        """The context, context updates and attribution snapshot keys a script
+        declares for numbers"""
+        number_keys = dict(pool_id=pool_id, shard_count=shard_count)
+        keys = []
+        for number in numbers:
+            keys.extend(
+                [
+                    self._get_number_key(number, **number_keys),
+                    self._get_context_updates_key(number, **number_keys),
+                    self._get_attribution_key(number, **number_keys),
+                ]
+            )
+        return keys
 
-class NumberPoolResponseMessages(metaclass=ClassValueContainsMeta):
-    POOL_UNAVAILABLE = "pool unavailable"
-    NUMBER_UNAVAILABLE = "number unavailable"
-    EMPTY = "pool empty"
-    NO_SID = "no session ID"
-    EXPIRED = "expired"
-    NOT_FOUND = "not found"
-    MAX_RENEWAL = "maximum renewal exceeded"
-    INTERNAL_ERROR = "internal error"
+    def _get_free_numbers_params(
+        self, pool_id, op, numbers=None, shard=None, area_codes=None
+    ):
+        """Get the keys and args for FREE_NUMBERS_SCRIPT. The area codes of
+        the numbers are declared to the script along with area_codes."""
+        numbers = numbers or []
+        area_codes = sorted(
+            set(area_codes or []) | set(map(self._get_number_area_code, numbers))
+        )
+        keys = [
+            self._get_free_pool_name(pool_id, shard=shard),
+            self._get_free_area_code_counts_name(pool_id, shard=shard),
+            *self._get_area_code_script_keys(pool_id, area_codes, shard=shard),
+        ]
+        args = [op, dumps_json(area_codes), *numbers]
+        return keys, args
+
+    def _get_reap_params(
+        self, pool_id, numbers, expiration, shard=None, shard_count=None
+    ):
+        """Get the keys and args for REAP_EXPIRED_NUMBERS_SCRIPT"""
+        area_codes = sorted(set(map(self._get_number_area_code, numbers)))
+        keys = [
+            self._get_free_pool_name(pool_id, shard=shard),
+            self._get_taken_pool_name(pool_id, shard=shard),
+            self._get_free_area_code_counts_name(pool_id, shard=shard),
+            *self._get_area_code_script_keys(
+                pool_id, area_codes, shard=shard, taken=True
+            ),
+            *[
+                self._get_number_key(number, pool_id=pool_id, shard_count=shard_count)
+                for number in numbers
+            ],
+        ]
+        args = [time.time(), expiration, dumps_json(area_codes), *numbers]
+        return keys, args
+
+    def _queue_least_recently_renewed(self, pipeline, pool_id, shard_count):
+        for shard in self._get_shards(shard_count):
+            pipeline.zrangebyscore(
+                self._get_taken_pool_name(pool_id, shard=shard),
+                "-inf",
+                "+inf",
+                withscores=True,
+                start=0,
+                num=1,
+            )
 
+    def _parse_least_recently_renewed(self, res):
+        """The (number, renewed_at) with the earliest timestamp across the
+        shards read by _queue_least_recently_renewed"""
+        res = [x[0] for x in res if x]
+        return min(res, key=lambda x: x[1]) if res else None
 
-number_pool_conn = None
+    def _get_area_code_search(self, pool_id, pool_props, area_codes):
+        """The fallback area code of a pool, and the area codes to search for a
+        lease, which are checked to be valid"""
+        fallback_area_code = pool_props.get("fallback_area_code", None)
+        raiseifnot(
+            fallback_area_code, f"No fallback area code specified for pool {pool_id}"
+        )
+        if not area_codes:
+            # This can happen if the area code pool is in use but we didn't have
+            # enough info to target a specific area code. We still want to force
+            # picking a number from the fallback area code.
+            warn(f"Area code not specified, using fallback {fallback_area_code}")
+            area_codes = [fallback_area_code]
+        for area_code in area_codes:
+            raiseifnot(
+                isinstance(area_code, str)
+                and len(area_code) == 3
+                and area_code.isdigit(),
+                f"Invalid area code: {area_code}",
+            )
+        return fallback_area_code, area_codes
 
+    def _queue_expired_area_code_candidates(
+        self, pipeline, pool_id, area_code, shards, cutoff, limit
+    ):
+        for shard in shards:
+            pipeline.zrangebyscore(
+                self._get_taken_area_code_pool_name(pool_id, area_code, shard=shard),
+                "-inf",
+                cutoff,
+                start=0,
+                num=limit,
+                withscores=True,
+            )
 
-def get_number_pool_conn(tries=NUMBER_POOL_CONNECT_TRIES, refresh=False):
-    global number_pool_conn
-    if (not number_pool_conn) or refresh:
-        while True:
-            try:
-                number_pool_conn = redis.Redis(
-                    host=settings.REDIS_HOST,
-                    port=6379,
-                    password=settings.REDIS_PASSWORD,
-                    decode_responses=True,
-                )
-                info("Connected to Redis number pool")
-                break
-            except Exception as e:
-                tries -= 1
-                if tries <= 0:
-                    msg = f"Could not connect to Redis number pool: {str(e)}"
-                    error(msg)
-                    rollbar.report_message(dict(msg=msg), "error")
-                    break
-                warn("Retrying Redis number pool connection...")
-                time.sleep(1)
-    return number_pool_conn
+    def _parse_expired_area_code_candidates(self, res, limit):
+        """The least recently renewed numbers read by
+        _queue_expired_area_code_candidates across all shards"""
+        candidates = sorted(
+            [x for shard_res in res for x in shard_res], key=lambda x: x[1]
+        )
+        return [number for number, _ in candidates[:limit]]
 
 
-class NumberPoolAPI:
+class NumberPoolAPI(NumberPoolAPIBase):
     """An API to manage leasing numbers from a set of dynamic phone number
     tracking pools. The pools are hydrated from the database and are managed in
     Redis in the data structures described below. It is expected `init_pools`
@@ -138,25 +1750,104 @@ class NumberPoolAPI:
 
     The numbers are managed across 3 data structures:
 
-    * Top level keys mapping phone numbers to contexts (JSON)
+    * Top level keys mapping phone numbers to contexts (JSON), with a compact
+    attribution snapshot hash per number (see get_number_attribution)
     * A Redis Set of free numbers per pool
     * A Redis Sorted Set of taken numbers per pool. A sorted set is used so we can
     track the numbers with the oldest renewal time for reclaiming to the pool (if
     they are past expiration).
 
-    Pool properties are stored in Redis under keys like 'pool_properties:{pool_id}'.
+    The free numbers are also indexed by area code in a Redis Set per pool and area
+    code, with a Redis Hash of free counts per area code, so area code pools can
+    find a free number in O(1). Likewise the taken numbers are indexed in a Redis
+    Sorted Set per pool and area code, scored by renewal time, so the oldest
+    expired number for an area code is a single range query.
+
+    Pool properties are stored in Redis under keys like 'pool_properties:{pool_id}'
+    and cached in each process until a change is published (see
+    PoolPropertiesCache).
+
+    Large pools can be split into shards with the "shards" pool property (see
+    NUMBER_POOL_SHARDS). Each shard has its own free, taken, area code and
+    session structures, with hash tagged keys so a shard's keys share a Redis
+    Cluster slot, and every number always lives in the shard its number hashes
+    to. Session mappings live in the shard of the session's number. Leases try
+    the target number's shard, or else the session's home shard, before the
+    other shards. Stats and resets cover all shards, and a reset moves the
+    numbers over if the shard count changed.
+
+    Keys follow one of two layouts (see NumberPoolKeyLayouts). In the v1 layout
+    number contexts are keyed by the bare number, so the keys touched by a
+    lease are spread across Redis Cluster slots. The v2 layout tags number
+    contexts, context updates, attribution snapshots and the free/taken
+    structures of every pool with the pool and the shard of the number, so
+    every lease, renewal and removal only touches one slot and pools are
+    spread across slots. Each pool keeps its own shard count, so a single shard
+    pool has all its keys in one slot, and a reset that changes the shard count
+    moves the number contexts along with the numbers. A hash of number -> pool
+    ID (NUMBER_POOL_IDS_KEY) finds the contexts of a number when its pool isn't
+    known. Pool properties, route, user, static and lease caller keys keep
+    their untagged names in both layouts, so each is only ever read or written
+    with single-key commands, never in an MGET, multi-key transaction or
+    script. A keyspace is moved between layouts with
+    app.number_pool_migrate.
+
+    Leases run in one of two modes (see NumberPoolLeaseModes). In "script" mode
+    the whole lease is done by a server-side Lua script, usually in a single
+    round trip, with renewals committed by a second compare-and-set script once
+    the new context has been merged in Python. Scripts are passed every key
+    they touch, so a lease that picks a number the caller didn't declare runs
+    again with it declared. In "lock" mode the lease holds a per-pool
+    Redis lock while it issues the individual commands. With the "number" lock
+    scope (see NumberPoolLockScopes), renewals of a number the session already
+    owns and context updates only hold a per-number lock, and the pool lock is
+    only taken to claim a free or expired number.
+
+    If a pool has a renewal throttle (see NUMBER_POOL_RENEWAL_THROTTLE), renewals
+    by the session that owns a recently renewed number are confirmed by a script
+    in one round trip in either mode, without the pool lock. Their request
+    contexts are appended to a capped list per number and folded into the
+    context when it is read, and into the stored context on the next full
+    renewal. The visits policy is applied at that point too. Confirmed
+    renewals don't change the taken score, so the numbers are also kept in a
+    sorted set per pool shard scored by the last confirmation, which snapshots
+    read alongside the taken sets.
 
     * TODO add number limits by request ip/user agent/host
     """
 
-    def __init__(self, conn_tries=NUMBER_POOL_CONNECT_TRIES):
+    def __init__(
+        self,
+        conn_tries=NUMBER_POOL_CONNECT_TRIES,
+        lease_mode=None,
+        context_format=None,
+        codec=None,
+        lock_scope=None,
+        key_layout=None,
+    ):
         # NOTE: It is assumed the pool has been initialized by an outside process,
         # such as in a prestart command for the service.
+        self._init_options(lease_mode, context_format, codec, lock_scope, key_layout)
         self.conn = get_number_pool_conn(tries=conn_tries)
-        self._pool_properties_cache = {}
-        self._pool_properties_cache_updated_at = {}
+        self._pools_cache = None
+        self._pools_cache_updated_at = 0
         if not self.conn:
             raise NumberPoolUnavailable("could not connect to pool")
+        self._connect_families()
+        self._register_scripts()
+        pool_properties_cache.start_listener(self.conn)
+
+    def _register_scripts(self):
+        self._lease_number_script = self.conn.register_script(LEASE_NUMBER_SCRIPT)
+        self._renew_number_script = self.conn.register_script(RENEW_NUMBER_SCRIPT)
+        self._confirm_renewal_script = self.conn.register_script(CONFIRM_RENEWAL_SCRIPT)
+        self._free_numbers_script = self.conn.register_script(FREE_NUMBERS_SCRIPT)
+        self._rebuild_taken_area_code_index_script = self.conn.register_script(
+            REBUILD_TAKEN_AREA_CODE_INDEX_SCRIPT
+        )
+        self._reap_expired_numbers_script = self.conn.register_script(
+            REAP_EXPIRED_NUMBERS_SCRIPT
+        )
 
     @classmethod
     def get_pools_from_db(cls):
@@ -171,37 +1862,108 @@ class NumberPoolAPI:
         )
         return set([x["number"] for x in res.fetchall()])
 
-    def _get_pool_properties_key(self, pool_id):
-        return f"pool_properties:{pool_id}"
+    @classmethod
+    def get_all_pool_numbers_from_db(cls, pool_ids=None):
+        """Numbers of the given (or all active) pools in one query, by pool ID"""
+        sql = (
+            "select n.pool_id, n.number from zar.pool_numbers n "
+            "join zar.pools p on p.id=n.pool_id where p.active=1"
+        )
+        params = {}
+        if pool_ids:
+            sql += " and n.pool_id in %(pool_ids)s"
+            params = dict(pool_ids=tuple(pool_ids))
+        res = {pool_id: set() for pool_id in pool_ids or []}
+        for row in engine.execute(sql, params).fetchall():
+            res.setdefault(row["pool_id"], set()).add(row["number"])
+        return res
 
-    def get_pool_properties(self, pool_id):
-        cache_age = time.monotonic() - self._pool_properties_cache_updated_at.get(
-            pool_id, 0
+    @classmethod
+    def get_pool_snapshots_from_db(cls, pool_id, renewed_since):
+        """Snapshotted (number, context JSON) rows of a pool renewed since the
+        given time, least recently renewed first"""
+        res = engine.execute(
+            "select number, context from zar.pool_number_snapshots "
+            "where pool_id=%(pool_id)s and renewed_at>=%(renewed_since)s "
+            "order by renewed_at",
+            dict(pool_id=pool_id, renewed_since=renewed_since),
         )
-        if (
-            pool_id in self._pool_properties_cache
-            and cache_age < POOL_PROPERTIES_CACHE_EXPIRATION
-        ):
-            return self._pool_properties_cache[pool_id]
+        return [(row["number"], row["context"]) for row in res.fetchall()]
+
+    @classmethod
+    def write_pool_snapshots_to_db(cls, rows):
+        """Upsert snapshot rows with pool_id, number, sid, renewed_at and
+        context keys"""
+        engine.execute(
+            "insert into zar.pool_number_snapshots "
+            "(pool_id, number, sid, renewed_at, context) values "
+            "(%(pool_id)s, %(number)s, %(sid)s, %(renewed_at)s, %(context)s) "
+            "on duplicate key update sid=values(sid), "
+            "renewed_at=values(renewed_at), context=values(context)",
+            rows,
+        )
+
+    @classmethod
+    def delete_pool_snapshots_from_db(cls, renewed_before):
+        res = engine.execute(
+            "delete from zar.pool_number_snapshots "
+            "where renewed_at<%(renewed_before)s",
+            dict(renewed_before=renewed_before),
+        )
+        return res.rowcount
+
+    @classmethod
+    def get_pool_number_versions_from_db(cls):
+        """Number counts and a version string per pool that changes whenever a
+        pool's numbers are added, removed or updated"""
+        res = engine.execute(
+            "select pool_id, count(*) as count, max(updated_at) as updated_at, "
+            "sum(crc32(number)) as checksum from zar.pool_numbers group by pool_id"
+        )
+        return {
+            row["pool_id"]: dict(
+                count=row["count"],
+                version=f"{row['count']}:{row['updated_at']}:{row['checksum']}",
+            )
+            for row in res.fetchall()
+        }
+
+    def get_pools(self):
+        """Active pools from the DB, cached briefly for monitoring endpoints"""
+        cache_age = time.monotonic() - self._pools_cache_updated_at
+        if self._pools_cache is None or cache_age >= POOL_LIST_CACHE_EXPIRATION:
+            self._pools_cache = [dict(pool) for pool in self.get_pools_from_db()]
+            self._pools_cache_updated_at = time.monotonic()
+        return self._pools_cache
+
+    def get_pool_properties(self, pool_id):
+        res = pool_properties_cache.get(pool_id)
+        if res is not None:
+            return res
+        generation = pool_properties_cache.generation
         key = self._get_pool_properties_key(pool_id)
         properties_json = self.conn.get(key)
         if properties_json:
             res = json.loads(properties_json)
-            self._pool_properties_cache[pool_id] = res
-            self._pool_properties_cache_updated_at[pool_id] = time.monotonic()
+            pool_properties_cache.set(pool_id, res, generation=generation)
             return res
         msg = f"Pool properties not found for pool {pool_id}"
         rollbar.report_message(dict(msg=msg), "warning")
         return {}
 
-    def set_pool_properties(self, pool_id, pool_row):
+    def set_pool_properties(self, pool_id, pool_row, client=None):
+        """Store pool properties and notify all processes to drop their cached
+        copy. Pass a pipeline as client to batch several pools."""
         key = self._get_pool_properties_key(pool_id)
         pool_data = dict(pool_row)
         properties_str = pool_data.get("properties", None) or "{}"
         properties = json.loads(properties_str)  # Validate JSON
-        self.conn.set(key, json.dumps(properties))
-        self._pool_properties_cache[pool_id] = properties
-        self._pool_properties_cache_updated_at[pool_id] = time.monotonic()
+        pipeline = client or self.conn.pipeline()
+        pipeline.set(key, json.dumps(properties))
+        pipeline.publish(POOL_PROPERTIES_CHANNEL, pool_id)
+        if not client:
+            pipeline.execute()
+        pool_properties_cache.invalidate(pool_id)
         dbg(f"Stored properties for pool {pool_id}")
 
     def reset_pool_properties(self):
@@ -210,8 +1972,8 @@ class NumberPoolAPI:
         pools = self.get_pools_from_db()
         count = 0
         errors = 0
-        self._pool_properties_cache = {}
-        self._pool_properties_cache_updated_at = {}
+        pool_properties_cache.invalidate()
+        self._pools_cache = None
 
         for pool in pools:
             pool_id = pool["id"]
@@ -226,7 +1988,10 @@ class NumberPoolAPI:
         )
         return {"success": count, "errors": errors}
 
-    def init_pools(self, pool_ids=None):
+    def init_pools(self, pool_ids=None, force=False):
+        """Sync the Redis pools with the database. All pools and versions are
+        read up front and only pools whose numbers changed since the last init
+        (or that are missing from Redis) are reset, unless force is set."""
         start = time.time()
         pools = []
         errors = []
@@ -235,29 +2000,48 @@ class NumberPoolAPI:
             with self._get_init_lock():
                 info("Initializing number pools...")
                 counts = {}
-                pools = self.get_pools_from_db()
+                pools = [
+                    pool
+                    for pool in self.get_pools_from_db()
+                    if (not pool_ids) or (pool["id"] in pool_ids)
+                ]
+                if not self._check_keyspace_layout(pools):
+                    return
+                pipeline = self.conn.pipeline(transaction=False)
                 for pool in pools:
-                    pool_id = pool["id"]
-                    if pool_ids and (pool_id not in pool_ids):
-                        info(f"Skipping pool {pool_id}/{pool['name']}")
-                        continue
+                    self.set_pool_properties(pool["id"], pool, client=pipeline)
+                pipeline.execute()
 
-                    self.set_pool_properties(pool_id, pool)
+                versions = self.get_pool_number_versions_from_db()
+                if force:
+                    changed = [pool["id"] for pool in pools]
+                else:
+                    changed = self._get_changed_pool_ids(pools, versions)
+                info(f"{len(changed)}/{len(pools)} pools changed")
+                numbers = (
+                    self.get_all_pool_numbers_from_db(pool_ids=changed)
+                    if changed
+                    else {}
+                )
 
+                for pool in pools:
+                    pool_id = pool["id"]
+                    version = versions.get(pool_id, dict(count=0, version=""))
+                    counts[pool["name"]] = version["count"]
+                    if pool_id not in numbers:
+                        continue
                     try:
                         with self._get_pool_lock(pool_id):
-                            numbers = self.get_pool_numbers_from_db(pool_id)
-                            if self._pool_exists(pool_id):
-                                info(f"Resetting pool {pool_id}, preserve=True")
-                                self._reset_pool(
-                                    pool_id, numbers=numbers, preserve=True
-                                )
-                            elif numbers:
-                                info(
-                                    f"Adding {len(numbers)} numbers for pool {pool_id}"
-                                )
-                                self._add_numbers(pool_id, numbers)
-                            counts[pool["name"]] = len(numbers)
+                            info(f"Resetting pool {pool_id}, preserve=True")
+                            self._reset_pool(
+                                pool_id, numbers=numbers[pool_id], preserve=True
+                            )
+                            if settings.NUMBER_POOL_SNAPSHOT_ENABLED:
+                                self.restore_pool_snapshot(pool_id)
+                            self.conn.set(
+                                self._get_pool_version_key(pool_id), version["version"]
+                            )
+                            counts[pool["name"]] = len(numbers[pool_id])
                     except LockError:
                         errors.append(
                             f"Unable to init pool {pool_id}/{pool['name']}: LockError"
@@ -275,22 +2059,150 @@ class NumberPoolAPI:
         info(f"took {time.time() - start:.3f}s")
         return counts
 
+    def _get_changed_pool_ids(self, pools, versions):
+        """IDs of pools whose Redis version doesn't match the database or whose
+        Redis structures are missing, checked in one pipeline"""
+        names = {}
+        pipeline = self.conn.pipeline(transaction=False)
+        for pool in pools:
+            pool_id = pool["id"]
+            pipeline.get(self._get_pool_version_key(pool_id))
+            pipeline.get(self._get_pool_shards_key(pool_id))
+            names[pool_id] = self._get_pool_structure_names(pool_id)
+            for name in names[pool_id]:
+                pipeline.exists(name)
+        res = iter(pipeline.execute())
+
+        changed = []
+        for pool in pools:
+            pool_id = pool["id"]
+            curr_version, curr_shard_count = next(res), next(res)
+            exists = sum([next(res) for _ in names[pool_id]])
+            version = versions.get(pool_id, dict(count=0, version=""))
+            if (
+                (curr_version != version["version"])
+                or (version["count"] and not exists)
+                or (int(curr_shard_count or 1) != self.get_shard_count(pool_id))
+            ):
+                changed.append(pool_id)
+        return changed
+
+    def _get_pool_structure_names(self, pool_id):
+        """Names of the free and taken structures of every shard of a pool"""
+        names = []
+        for shard in self._get_shards(self.get_shard_count(pool_id)):
+            names.append(self._get_free_pool_name(pool_id, shard=shard))
+            names.append(self._get_taken_pool_name(pool_id, shard=shard))
+        return names
+
+    def _check_keyspace_layout(self, pools):
+        """Check the keyspace is in this API's key layout, marking new keyspaces
+        as v2 if that is the configured layout. Keyspaces must be moved between
+        layouts with app.number_pool_migrate."""
+        key_layout = self.conn.get(NUMBER_POOL_KEY_LAYOUT_KEY)
+        if key_layout is None and self._is_v2_key_layout():
+            # Version keys have the same name in both layouts
+            pipeline = self.conn.pipeline(transaction=False)
+            for pool in pools:
+                pipeline.exists(self._get_pool_version_key(pool["id"]))
+            if any(pipeline.execute()):
+                key_layout = NumberPoolKeyLayouts.V1
+            else:
+                self.conn.set(NUMBER_POOL_KEY_LAYOUT_KEY, self.key_layout)
+                key_layout = self.key_layout
+        key_layout = key_layout or NumberPoolKeyLayouts.V1
+        if key_layout != self.key_layout:
+            msg = (
+                f"Number pool keyspace is in the {key_layout} key layout, expected "
+                f"{self.key_layout}. Migrate it with app.number_pool_migrate."
+            )
+            error(msg)
+            rollbar.report_message(dict(msg=msg), "error")
+            return False
+        return True
+
+    def _connect_families(self, refresh=False):
+        """Get the clients for the cached contexts, see RedisFamilies"""
+        self.route_conn = get_redis_family_conn(RedisFamilies.ROUTES, refresh=refresh)
+        self.user_context_conn = get_redis_family_conn(
+            RedisFamilies.USER_CONTEXTS, refresh=refresh
+        )
+        self.lease_callers_conn = get_redis_family_conn(
+            RedisFamilies.LEASE_CALLERS, refresh=refresh
+        )
+
     def refresh_conn(self, conn_tries=NUMBER_POOL_CONNECT_TRIES):
         self.conn = get_number_pool_conn(tries=conn_tries, refresh=True)
+        self._connect_families(refresh=True)
+        self._register_scripts()
 
     def get_pool_number_context(self, number, with_age=False):
-        res = self.conn.get(number)
-        res = json.loads(res) if res else None
+        res, _ = self._read_number_context(number)
         if res and with_age:
             res["age"] = self._number_context_age(res)
             res["expired"] = self._number_context_expired(res)
         dbg(f"{number}: {res}")
         return res
 
-    def set_number_context(self, number, context):
+    def set_number_context(self, number, context, stored_fields=None):
         dbg(f"{number}: {context}")
-        context = NumberPoolCacheValue(**context)
-        self.conn.set(number, context.model_dump_json())
+        pipeline = self.conn.pipeline()
+        self._queue_number_context(
+            pipeline,
+            number,
+            context,
+            stored_fields=stored_fields,
+            shard_count=self._get_number_shard_count(context["pool_id"]),
+        )
+        pipeline.execute()
+
+    def _get_number_pool_id(self, number):
+        """Get the ID of the pool a number is in, which is part of its context
+        keys in the v2 layout. Lookups are cached, see PoolPropertiesCache.
+        Returns None if the number is in no pool, and always in the v1 layout
+        where the pool isn't needed."""
+        if not self._is_v2_key_layout():
+            return None
+        pool_id = pool_properties_cache.get_number_pool_id(number)
+        if pool_id is None:
+            generation = pool_properties_cache.generation
+            pool_id = self._parse_number_pool_id(
+                self.conn.hget(NUMBER_POOL_IDS_KEY, number)
+            )
+            pool_properties_cache.set_number_pool_id(
+                number, pool_id, generation=generation
+            )
+        return pool_id or None
+
+    def _read_number_context(self, number):
+        """Read a number context stored in either format. Returns the context
+        and the stored hash fields, or None for the fields if the context is
+        stored as JSON. Costs a second round trip only for contexts that are
+        not yet in the configured format."""
+        pool_id = self._get_number_pool_id(number)
+        if not self._has_number_keys(pool_id):
+            return None, None
+        shard_count = self._get_number_shard_count(pool_id)
+        try:
+            return self._read_number_context_as(
+                number, self.context_format, pool_id, shard_count
+            )
+        except ResponseError as e:
+            if not self._is_wrong_type_error(e):
+                raise
+        return self._read_number_context_as(
+            number, self._get_other_context_format(), pool_id, shard_count
+        )
+
+    def _read_number_context_as(self, number, context_format, pool_id, shard_count):
+        """Read a number context stored in the given format, with its context
+        updates folded in, in one round trip"""
+        pipeline = self.conn.pipeline(transaction=False)
+        self._queue_number_context_read(
+            pipeline, number, context_format, pool_id, shard_count
+        )
+        res, updates = pipeline.execute()
+        return self._parse_number_context(context_format, res, updates)
 
     def get_number_status(self, number, with_age=False):
         res = self.get_pool_number_context(number, with_age=with_age)
@@ -300,60 +2212,46 @@ class NumberPoolAPI:
             return NumberStatus.EXPIRED, res
         return NumberStatus.TAKEN, res
 
-    def get_cached_route_key(self, call_from, call_to):
-        return f"{call_from}->{call_to}"
-
     def track_lease_caller(self, number, context, call_from):
-        key = f"lease_callers:{context['pool_id']}:{number}:{context['leased_at']}"
-        pipeline = self.conn.pipeline()
-        pipeline.sadd(key, call_from)
-        pipeline.expire(key, NUMBER_POOL_LEASE_CALLERS_EXPIRATION)
-        pipeline.scard(key)
+        pipeline = self.lease_callers_conn.pipeline()
+        self._queue_lease_caller(pipeline, number, context, call_from)
         _, _, distinct_callers = pipeline.execute()
         return distinct_callers
 
-    def _is_ignored_phone_user_id(self, user_id):
-        if user_id is None:
-            return False
-        return user_id.lower().lstrip("+") in IGNORED_USER_CONTEXT_CALLER_IDS
-
     def set_cached_route_context(self, call_from, call_to, context):
         if self._is_ignored_phone_user_id(call_from):
             return
-        context = NumberPoolCacheValue(**context)
+        context = self._number_context_value(context)
         key = self.get_cached_route_key(call_from, call_to)
-        self.conn.set(
-            key, context.model_dump_json(), ex=NUMBER_POOL_ROUTE_CACHE_EXPIRATION
+        self.route_conn.set(
+            key, self.codec.dumps(context), ex=NUMBER_POOL_ROUTE_CACHE_EXPIRATION
         )
 
     def get_cached_route_context(self, call_from, call_to):
         if self._is_ignored_phone_user_id(call_from):
             return None
         key = self.get_cached_route_key(call_from, call_to)
-        res = self.conn.get(key)
-        return json.loads(res) if res else None
-
-    def get_user_context_key(self, id_type, user_id):
-        return f"{id_type}:{user_id}"
+        res = get_encoded(self.route_conn, key)
+        return self.codec.loads(res) if res else None
 
     def get_user_context(self, id_type, user_id):
         if id_type == UserIDTypes.PHONE and self._is_ignored_phone_user_id(user_id):
             return None
         key = self.get_user_context_key(id_type, user_id)
-        res = self.conn.get(key)
-        return json.loads(res) if res else None
+        res = get_encoded(self.user_context_conn, key)
+        return self.codec.loads(res) if res else None
 
     def set_user_context(self, id_type, user_id, context):
         if id_type == UserIDTypes.PHONE and self._is_ignored_phone_user_id(user_id):
             return
         key = self.get_user_context_key(id_type, user_id)
-        self.conn.set(key, json.dumps(context), ex=NUMBER_POOL_USER_CONTEXT_EXPIRATION)
+        self.user_context_conn.set(
+            key, self.codec.dumps(context), ex=NUMBER_POOL_USER_CONTEXT_EXPIRATION
+        )
 
     def update_user_context(self, id_type, user_id, context):
         current_ctx = self.get_user_context(id_type, user_id)
-        if current_ctx:
-            # Second arg overwrites first on conflict
-            context = dictmerge(current_ctx, context, overwrite=True)
+        context = self._merge_user_context(current_ctx, context)
         self.set_user_context(id_type, user_id, context)
         return context
 
@@ -361,68 +2259,182 @@ class NumberPoolAPI:
         if id_type == UserIDTypes.PHONE and self._is_ignored_phone_user_id(user_id):
             return
         key = self.get_user_context_key(id_type, user_id)
-        self.conn.delete(key)
-
-    def get_static_number_key(self, number):
-        return f"static:{number}"
+        self.user_context_conn.delete(key)
 
     def get_static_number_context(self, number):
         key = self.get_static_number_key(number)
-        res = self.conn.get(key)
-        return json.loads(res) if res else None
+        res = get_encoded(self.conn, key)
+        return self.codec.loads(res) if res else None
 
     def set_static_number_context(self, number, context):
         key = self.get_static_number_key(number)
-        self.conn.set(key, json.dumps(context))
-
-    def is_same_ip_user_agent(self, pool_id, req_ctx1, req_ctx2):
-        ip1 = self._get_session_ip(pool_id, req_ctx1)
-        ip2 = self._get_session_ip(pool_id, req_ctx2)
-        ua1 = self._get_session_user_agent(pool_id, req_ctx1)
-        ua2 = self._get_session_user_agent(pool_id, req_ctx2)
-        if not (ip1 and ip2 and ua1 and ua2):
-            return False
-        return (ip1 == ip2) and (ua1 == ua2)
+        self.conn.set(key, self.codec.dumps(context))
+
+    def get_number_attribution(self, number):
+        """Get the attribution snapshot of a number: its pool_id, leased_at,
+        renewed_at, and the sid, ip, user_agent and zip of its request context
+        (None if not set). Kept up to date by leases and renewals, so calls can
+        be attributed without decoding the whole number context. Returns None
+        for numbers without a snapshot, such as those last leased before
+        snapshots were added."""
+        pool_id = self._get_number_pool_id(number)
+        if not self._has_number_keys(pool_id):
+            return None
+        res = self.conn.hgetall(
+            self._get_attribution_key(
+                number,
+                pool_id=pool_id,
+                shard_count=self._get_number_shard_count(pool_id),
+            )
+        )
+        return self._decode_attribution_fields(res)
+
+    def get_call_contexts(self, call_from, call_to):
+        """Read the number context and attribution snapshot, and the route,
+        phone user and static contexts of a call in one round trip per client,
+        see RedisFamilies. Returns them by name."""
+        pool_id = self._get_number_pool_id(call_to)
+        shard_count = self._get_number_shard_count(pool_id)
+        results = [
+            (names, pipeline.execute(raise_on_error=False))
+            for pipeline, names in self._queue_call_context_reads(
+                call_from, call_to, pool_id=pool_id, shard_count=shard_count
+            )
+        ]
+        contexts, reread = self._parse_call_contexts(results, pool_id=pool_id)
+        if reread:
+            contexts["pool"], _ = self._read_number_context(call_to)
+        if contexts["pool"] and not contexts["attribution"]:
+            contexts["attribution"] = self._get_context_attribution(contexts["pool"])
+        return contexts
+
+    def write_call_contexts(self, call_from, call_to, context, user_contexts=None):
+        """Cache the route context of a call, set user_contexts and track the
+        caller of the lease in one round trip per client. user_contexts is a list of
+        (id_type, user_id, context). Returns the distinct callers of the
+        lease."""
+        pipelines, lease_callers_pipeline = self._queue_call_context_writes(
+            call_from, call_to, context, user_contexts=user_contexts
+        )
+        distinct_callers = None
+        for pipeline in pipelines:
+            res = pipeline.execute()
+            if pipeline is lease_callers_pipeline:
+                distinct_callers = res[-1]
+        return distinct_callers
 
     def get_all_pool_stats(self, with_contexts=False):
+        """Counts for all active pools in a single pipelined round trip. Expired
+        counts include taken numbers not yet returned by the reaper. Use
+        iter_number_contexts to export contexts for large pools."""
         stats = {}
-        pools = self.get_pools_from_db()
+        pools = self.get_pools()
+        now = time.time()
+        pipe = self.conn.pipeline(transaction=False)
+        for pool in pools:
+            pool_id = pool["id"]
+            cutoff = now - self.get_cache_expiration(pool_id)
+            for shard in self._get_shards(self.get_shard_count(pool_id)):
+                taken_name = self._get_taken_pool_name(pool_id, shard=shard)
+                pipe.scard(self._get_free_pool_name(pool_id, shard=shard))
+                pipe.zcard(taken_name)
+                pipe.zcount(taken_name, "-inf", cutoff)
+                if self.is_area_code_pool(pool_id):
+                    pipe.hgetall(
+                        self._get_free_area_code_counts_name(pool_id, shard=shard)
+                    )
+        res = iter(pipe.execute())
+
         for pool in pools:
             pool_id = pool["id"]
-            free = self._get_free_numbers(pool_id)
-            taken = self._get_taken_numbers(pool_id)
+            area_code_pool = self.is_area_code_pool(pool_id)
+            free, taken, expired = 0, 0, 0
+            area_code_counts = {}
+            for _ in self._get_shards(self.get_shard_count(pool_id)):
+                free += next(res)
+                taken += next(res)
+                expired += next(res)
+                if area_code_pool:
+                    self._sum_area_code_counts(area_code_counts, next(res))
             pool_res = dict(
-                counts=dict(
-                    free=len(free), taken=len(taken), total=len(free) + len(taken)
-                )
+                counts=dict(free=free, taken=taken, expired=expired, total=free + taken)
             )
+            if area_code_pool:
+                pool_res["counts"]["free_area_codes"] = area_code_counts
             if with_contexts:
-                pool_res["contexts"] = self._get_number_contexts(taken, with_age=True)
+                pool_res["contexts"] = self._get_number_contexts(
+                    self._get_taken_numbers(pool_id), with_age=True, pool_id=pool_id
+                )
             stats[f"{pool_id}/{pool['name']}"] = pool_res
         return stats
 
+    def iter_number_contexts(
+        self, pool_ids=None, with_age=True, batch_size=NUMBER_CONTEXT_BATCH_SIZE
+    ):
+        """Yield (pool_id, number, context) for taken numbers, scanning each
+        taken set and reading contexts with their context updates in one round
+        trip per batch"""
+        if pool_ids is None:
+            pool_ids = [pool["id"] for pool in self.get_pools()]
+        for pool_id in pool_ids:
+            batch = []
+            for shard in self._get_shards(self.get_shard_count(pool_id)):
+                taken_name = self._get_taken_pool_name(pool_id, shard=shard)
+                for number, _ in self.conn.zscan_iter(taken_name, count=batch_size):
+                    batch.append(number)
+                    if len(batch) >= batch_size:
+                        yield from self._iter_batch_contexts(pool_id, batch, with_age)
+                        batch = []
+            if batch:
+                yield from self._iter_batch_contexts(pool_id, batch, with_age)
+
+    def _iter_batch_contexts(self, pool_id, numbers, with_age):
+        for number, context in self._get_number_contexts(
+            numbers, with_age=with_age, pool_id=pool_id
+        ).items():
+            yield pool_id, number, context
+
+    def get_free_area_code_counts(self, pool_id):
+        pipeline = self.conn.pipeline(transaction=False)
+        for shard in self._get_shards(self.get_shard_count(pool_id)):
+            pipeline.hgetall(self._get_free_area_code_counts_name(pool_id, shard=shard))
+        res = {}
+        for counts in pipeline.execute():
+            self._sum_area_code_counts(res, counts)
+        return res
+
+    def _sum_area_code_counts(self, res, counts):
+        for area_code, count in counts.items():
+            res[area_code] = res.get(area_code, 0) + int(count)
+        return res
+
     def is_area_code_pool(self, pool_id):
-        pool_props = self.get_pool_properties(pool_id) or {}
-        return (pool_props.get("area_code", None) or "").lower() == "all"
+        return self._is_area_code_pool_properties(self.get_pool_properties(pool_id))
 
     def get_cache_expiration(self, pool_id):
-        pool_props = self.get_pool_properties(pool_id) or {}
-        expiration = pool_props.get(
-            NUMBER_POOL_CACHE_EXPIRATION_PROPERTY, NUMBER_POOL_CACHE_EXPIRATION
+        return self._get_cache_expiration_from_properties(
+            pool_id, self.get_pool_properties(pool_id)
         )
-        try:
-            if isinstance(expiration, bool):
-                raise ValueError
-            expiration = int(expiration)
-            if expiration <= 0:
-                raise ValueError
-        except (TypeError, ValueError):
-            warn(
-                f"Invalid {NUMBER_POOL_CACHE_EXPIRATION_PROPERTY} for pool "
-                f"{pool_id}: {expiration}, using {NUMBER_POOL_CACHE_EXPIRATION}"
-            )
-            return NUMBER_POOL_CACHE_EXPIRATION
-        return expiration
+
+    def get_renewal_throttle(self, pool_id):
+        return self._get_renewal_throttle_from_properties(
+            pool_id, self.get_pool_properties(pool_id)
+        )
+
+    def get_shard_count(self, pool_id):
+        return self._get_shard_count_from_properties(
+            pool_id, self.get_pool_properties(pool_id)
+        )
+
+    def _get_number_shard(self, pool_id, number):
+        return self._get_shard(number, self.get_shard_count(pool_id))
+
+    def _get_number_shard_count(self, pool_id):
+        """The shard count tagging the context keys of the numbers in pool_id,
+        None if not needed: in the v1 layout, or for numbers in no pool"""
+        if not self._is_v2_key_layout() or pool_id is None:
+            return None
+        return self.get_shard_count(pool_id)
 
     def lease_number(
         self,
@@ -431,6 +2443,33 @@ class NumberPoolAPI:
         target_number=None,
         target_area_codes=None,
         renew=False,
+    ):
+        number = self._confirm_recent_renewal(pool_id, request_context, target_number)
+        if number:
+            return number
+        if self.lease_mode == NumberPoolLeaseModes.SCRIPT:
+            return self._lease_number_with_script(
+                pool_id,
+                request_context,
+                target_number=target_number,
+                target_area_codes=target_area_codes,
+                renew=renew,
+            )
+        return self._lease_number_with_lock(
+            pool_id,
+            request_context,
+            target_number=target_number,
+            target_area_codes=target_area_codes,
+            renew=renew,
+        )
+
+    def _lease_number_with_lock(
+        self,
+        pool_id,
+        request_context,
+        target_number=None,
+        target_area_codes=None,
+        renew=False,
     ):
         request_context = request_context or {}
         start = time.time()
@@ -447,6 +2486,14 @@ class NumberPoolAPI:
 
         dbg(f"{request_sid}: pool_id: {pool_id}, target number {target_number}")
 
+        if self.lock_scope == NumberPoolLockScopes.NUMBER:
+            number = self._renew_session_number(pool_id, request_context, target_number)
+            if number:
+                dbg(
+                    f"{request_sid}: took {time.time() - start:0.3f}s, number: {number}"
+                )
+                return number
+
         try:
             with self._get_pool_lock(pool_id):
                 # HACK: ensure we are targeting the session number for renewal if one
@@ -454,8 +2501,8 @@ class NumberPoolAPI:
                 sid_number = self._get_session_number(pool_id, request_context)
                 if sid_number:
                     if target_number and sid_number != target_number:
-                        warn(
-                            f"{request_sid}: Session / Target number mismatch: {sid_number} / {target_number}: {request_context}"
+                        self._warn_session_number_mismatch(
+                            pool_id, request_context, sid_number, target_number
                         )
                         sid_number_mismatch = True
                     from_sid = True
@@ -480,117 +2527,324 @@ class NumberPoolAPI:
                         )
                     elif status == NumberStatus.TAKEN and renew:
                         dbg(
-                            f"{request_sid}: target number {target_number} taken, renewal requested"
+                            f"{request_sid}: target number {target_number} taken, "
+                            "renewal requested"
                         )
                         if request_context:
-                            # HACK: we can overwrite everything besides these dicts which need to be merged
-                            # such that the new request_context values take precedence. We should
-                            # probably change this to a more proper dict merge!
-                            visits = ctx["request_context"].get("visits", None) or {}
-                            visits.update(request_context.get("visits", None) or {})
-                            request_context["visits"] = visits
-
-                            latest_context = (
-                                ctx["request_context"].get("latest_context", {}) or {}
-                            )
-                            latest_context.update(
-                                request_context.get("latest_context", {}) or {}
-                            )
-                            request_context["latest_context"] = latest_context
+                            self._merge_request_context(ctx, request_context)
+                        try:
+                            with self._get_number_scope_lock(pool_id, target_number):
+                                res = self._renew_number(
+                                    pool_id,
+                                    target_number,
+                                    context=ctx,
+                                    from_sid=from_sid,
+                                )
+                            if res:
+                                number = target_number
+                        except NumberSessionKeyMismatch:
+                            # Can happen if, for example, a user comes back later
+                            # and their number has been leased out to another
+                            # session. Let it go on to leasing a random number
+                            # instead.
+                            key_mismatch = True
+
+                if (not number) and (
+                    (not from_sid) or (key_mismatch and not sid_number_mismatch)
+                ):
+                    if area_code_pool:
+                        number = self._lease_area_code_number(
+                            pool_id, request_context, target_area_codes
+                        )
+                    else:
+                        number = self._lease_random_number(pool_id, request_context)
+        except LockError:
+            raise NumberPoolUnavailable(f"Could not acquire pool {pool_id} lock")
+
+        return self._check_leased_number(number, from_sid, start, locals())
+
+    def _renew_session_number(self, pool_id, request_context, target_number):
+        """Renew the number the session already owns while holding only that
+        number's lock. Returns None if there is no such number, or it is no
+        longer the session's, so the caller falls back to a lease under the
+        pool lock."""
+        sid_number = self._get_session_number(pool_id, request_context)
+        if (not sid_number) or (target_number and target_number != sid_number):
+            return None
+        try:
+            with self._get_number_lock(pool_id, sid_number):
+                status, ctx = self.get_number_status(sid_number)
+                if status != NumberStatus.TAKEN:
+                    return None
+                if request_context:
+                    self._merge_request_context(ctx, request_context)
+                try:
+                    self._renew_number(pool_id, sid_number, context=ctx, from_sid=True)
+                except NumberSessionKeyMismatch:
+                    return None
+                return sid_number
+        except LockError:
+            raise NumberPoolUnavailable(
+                f"Could not acquire number {pool_id}/{sid_number} lock"
+            )
+
+    def _lease_number_with_script(
+        self,
+        pool_id,
+        request_context,
+        target_number=None,
+        target_area_codes=None,
+        renew=False,
+    ):
+        request_context = request_context or {}
+        start = time.time()
+        number = None
+        from_sid = False
+        request_sid = self._get_session_id(pool_id, request_context)
 
-                            ctx["request_context"].update(request_context)
-                        try:
-                            res = self._renew_number(
-                                pool_id, target_number, context=ctx, from_sid=from_sid
-                            )
-                            if res:
-                                number = target_number
-                        except NumberSessionKeyMismatch as e:
-                            # Can happen if, for example, a user comes back later and their
-                            # number has been leased out to another session. Let it go on to
-                            # leasing a random number instead.
-                            key_mismatch = True
+        area_codes = []
+        if self.is_area_code_pool(pool_id):
+            area_codes = self._get_lease_area_codes(
+                pool_id, self.get_pool_properties(pool_id), target_area_codes
+            )
 
-                if (not number) and (
-                    (not from_sid) or (key_mismatch and not sid_number_mismatch)
+        dbg(f"{request_sid}: pool_id: {pool_id}, target number {target_number}")
+
+        for _ in range(LEASE_SCRIPT_MAX_TRIES):
+            res = self._run_lease_script(
+                pool_id, request_context, target_number, renew, area_codes
+            )
+            self._check_lease_script_result(
+                pool_id, request_context, target_number, res
+            )
+            status, number, detail, from_sid, _ = res
+            from_sid = bool(from_sid)
+
+            if status == LeaseScriptStatus.RENEW:
+                if self._commit_script_renewal(
+                    pool_id, number, detail, request_context, from_sid=from_sid
                 ):
-                    if area_code_pool:
-                        number = self._lease_area_code_number(
-                            pool_id, request_context, target_area_codes
+                    break
+                warn(
+                    f"{request_sid}: number {pool_id}/{number} changed, retrying lease"
+                )
+                number = None
+                continue
+
+            if status != LeaseScriptStatus.LEASED:
+                number = None
+            break
+        else:
+            raise self._get_lease_tries_error(pool_id)
+
+        return self._check_leased_number(number, from_sid, start, locals())
+
+    def reap_expired_numbers(self, pool_id, batch_size=NUMBER_POOL_REAPER_BATCH_SIZE):
+        """Move all expired numbers in a pool back to the free set, batch_size
+        numbers at a time. Returns the number of numbers reaped."""
+        total = 0
+        for shard in self._get_shards(self.get_shard_count(pool_id)):
+            while True:
+                if self.lease_mode == NumberPoolLeaseModes.LOCK:
+                    try:
+                        with self._get_pool_lock(pool_id):
+                            reaped, checked = self._reap_expired_batch(
+                                pool_id, batch_size, shard=shard
+                            )
+                    except LockError:
+                        raise NumberPoolUnavailable(
+                            f"Could not acquire pool {pool_id} lock"
                         )
-                    else:
-                        number = self._lease_random_number(pool_id, request_context)
-        except LockError as e:
-            raise NumberPoolUnavailable(f"Could not acquire pool {pool_id} lock")
+                else:
+                    reaped, checked = self._reap_expired_batch(
+                        pool_id, batch_size, shard=shard
+                    )
+                total += reaped
+                if checked < batch_size:
+                    break
+        if total:
+            info(f"Reaped {total} expired numbers from pool {pool_id}")
+        return total
+
+    def snapshot_pool(self, pool_id):
+        """Write the contexts of the pool's numbers leased, renewed or with a
+        confirmed renewal since the last snapshot to the DB, with their context
+        updates folded in. Returns the number of contexts written."""
+        snapshot_key = self._get_pool_snapshot_key(pool_id)
+        start = time.time()
+        since = float(self.conn.get(snapshot_key) or 0)
+        shards = self._get_shards(self.get_shard_count(pool_id))
+        pipeline = self.conn.pipeline(transaction=False)
+        for shard in shards:
+            pipeline.zrangebyscore(
+                self._get_taken_pool_name(pool_id, shard=shard), since, "+inf"
+            )
+            pipeline.zrangebyscore(
+                self._get_confirmed_pool_name(pool_id, shard=shard), since, "+inf"
+            )
+        numbers = set().union(*pipeline.execute())
 
-        dbg(f"{request_sid}: took {time.time() - start:0.3f}s, number: {number}")
-        if not number:
-            msg = "No numbers available"
-            exc = NumberPoolEmpty
-            if from_sid:
-                msg = "Session number unavailable"
-                exc = SessionNumberUnavailable
-            error(msg + f": {locals()}")
-            raise exc(msg)
+        rows = []
+        for number, ctx in self._get_number_contexts(numbers, pool_id=pool_id).items():
+            if not ctx or ctx["pool_id"] != pool_id:
+                continue
+            ctx = self._number_context_value(ctx)
+            rows.append(
+                dict(
+                    pool_id=pool_id,
+                    number=number,
+                    sid=self._get_session_id(pool_id, ctx["request_context"] or {}),
+                    renewed_at=ctx["renewed_at"],
+                    context=dumps_json(ctx),
+                )
+            )
+        for i in range(0, len(rows), NUMBER_CONTEXT_BATCH_SIZE):
+            self.write_pool_snapshots_to_db(rows[i : i + NUMBER_CONTEXT_BATCH_SIZE])
+        since = start - NUMBER_POOL_SNAPSHOT_OVERLAP
+        pipeline = self.conn.pipeline(transaction=False)
+        pipeline.set(snapshot_key, since)
+        for shard in shards:
+            # Confirmations before the next snapshot's cutoff are covered
+            pipeline.zremrangebyscore(
+                self._get_confirmed_pool_name(pool_id, shard=shard), "-inf", f"({since}"
+            )
+        pipeline.execute()
+        return len(rows)
+
+    def restore_pool_snapshot(self, pool_id):
+        """Restore numbers from the DB snapshot whose contexts are missing from
+        Redis, such as after a restart or eviction, so calls to them are still
+        attributed. Numbers renewed within the max renewal age that are still in
+        the pool are marked taken with their snapshotted context and session
+        mapping, and are reaped as usual if expired. Returns the number of
+        numbers restored."""
+        snapshots = self.get_pool_snapshots_from_db(
+            pool_id, time.time() - NUMBER_POOL_MAX_RENEWAL_AGE
+        )
+        pool_numbers = self._get_pool_numbers(pool_id) if snapshots else set()
+        snapshots = [(n, loads_json(ctx)) for n, ctx in snapshots if n in pool_numbers]
+        # Sessions are mapped to their most recently renewed number
+        session_numbers = {}
+        for number, ctx in snapshots:
+            sid = self._get_session_id(pool_id, ctx["request_context"] or {})
+            if sid:
+                session_numbers[sid] = number
 
-        return number
+        shard_count = self.get_shard_count(pool_id)
+        count = 0
+        for i in range(0, len(snapshots), NUMBER_CONTEXT_BATCH_SIZE):
+            batch = snapshots[i : i + NUMBER_CONTEXT_BATCH_SIZE]
+            pipeline = self.conn.pipeline(transaction=False)
+            for number, _ in batch:
+                pipeline.exists(
+                    self._get_number_key(
+                        number, pool_id=pool_id, shard_count=shard_count
+                    )
+                )
+            missing = dict(
+                (number, ctx)
+                for (number, ctx), exists in zip(batch, pipeline.execute())
+                if not exists
+            )
+            if not missing:
+                continue
+            pipeline = self._get_multi_shard_pipeline()
+            for shard, numbers in self._group_by_shard(missing, shard_count).items():
+                self._update_free_numbers(
+                    pool_id,
+                    FreeNumbersScriptOps.REMOVE,
+                    numbers,
+                    client=pipeline,
+                    shard=shard,
+                )
+                for number in numbers:
+                    ctx = missing[number]
+                    sid = self._get_session_id(pool_id, ctx["request_context"] or {})
+                    if session_numbers.get(sid, None) != number:
+                        sid = None
+                    self._queue_taken_number(
+                        pipeline,
+                        pool_id,
+                        number,
+                        ctx,
+                        sid=sid,
+                        shard=shard,
+                        shard_count=shard_count,
+                    )
+            pipeline.execute()
+            count += len(missing)
+        if count:
+            info(f"Restored {count} numbers of pool {pool_id} from the snapshot")
+        return count
 
     def update_number(self, pool_id, number, request_context, merge=False):
         start = time.time()
         request_sid = self._get_session_id(pool_id, request_context)
 
         dbg(
-            f"{request_sid}: pool_id: {pool_id}, number {number}, request_context: {request_context}, merge: {merge}"
+            f"{request_sid}: pool_id: {pool_id}, number {number}, "
+            f"request_context: {request_context}, merge: {merge}"
         )
 
         try:
-            with self._get_pool_lock(pool_id):
-                status, ctx = self.get_number_status(number)
+            with self._get_context_lock(pool_id, number):
+                ctx, stored_fields = self._read_number_context(number)
                 if not ctx:
                     warn(
                         f"{request_sid}: number {number} has no context, can not update"
                     )
                     return {}
 
-                curr_request_ctx = ctx.get("request_context", {}) or {}
-                curr_sid = self._get_session_id(pool_id, curr_request_ctx)
-                if request_sid != curr_sid:
-                    msg = f"session key mismatch for {pool_id}/{number} {request_sid}/{curr_sid}, can not update"
-                    warn(msg)
+                if not self._get_updated_context(
+                    pool_id,
+                    number,
+                    ctx,
+                    request_context,
+                    merge=merge,
+                    pool_props=self.get_pool_properties(pool_id),
+                ):
                     return ctx
 
-                if merge:
-                    ctx["request_context"] = dictmerge(
-                        curr_request_ctx, request_context, overwrite=True
-                    )
-                else:
-                    ctx["request_context"] = request_context
-
-                self.set_number_context(number, ctx)
-        except LockError as e:
+                self.set_number_context(number, ctx, stored_fields=stored_fields)
+        except LockError:
             raise NumberPoolUnavailable(f"Could not acquire pool {pool_id} lock")
 
         dbg(f"{request_sid}: took {time.time() - start:0.3f}s, number: {number}")
         return ctx
 
     def _get_init_lock(self):
-        init_lock_name = "Pool Init"
-        return self.conn.lock(init_lock_name, blocking_timeout=INIT_LOCK_TIMEOUT)
+        return self.conn.lock(
+            self._get_init_lock_name(), blocking_timeout=INIT_LOCK_TIMEOUT
+        )
 
-    def _get_pool_lock(
-        self,
-        pool_id,
-        timeout=LOCK_HOLD_TIMEOUT,
-        blocking_timeout=LOCK_WAIT_TIMEOUT,
-    ):
-        name = f"Pool: {pool_id} / Lock"
-        return self.conn.lock(name, timeout=timeout, blocking_timeout=blocking_timeout)
+    def _get_multi_shard_pipeline(self):
+        """A pipeline for writes spanning shards. Not a transaction in the v2
+        layout, where shards may be in different cluster slots."""
+        return self.conn.pipeline(transaction=not self._is_v2_key_layout())
+
+    def _any_exists(self, names):
+        """Check if any of the keys exist, one EXISTS per key since keys of
+        different shards may be in different cluster slots"""
+        pipeline = self.conn.pipeline(transaction=False)
+        for name in names:
+            pipeline.exists(name)
+        return any(pipeline.execute())
 
     def _free_pool_exists(self, pool_id):
-        return True if self.conn.exists(self._get_free_pool_name(pool_id)) else False
+        return self._any_exists(
+            [
+                self._get_free_pool_name(pool_id, shard=shard)
+                for shard in self._get_shards(self.get_shard_count(pool_id))
+            ]
+        )
 
     def _taken_pool_exists(self, pool_id):
-        return True if self.conn.exists(self._get_taken_pool_name(pool_id)) else False
+        return self._any_exists(
+            [
+                self._get_taken_pool_name(pool_id, shard=shard)
+                for shard in self._get_shards(self.get_shard_count(pool_id))
+            ]
+        )
 
     def _pool_exists(self, pool_id):
         if self._free_pool_exists(pool_id):
@@ -600,69 +2854,126 @@ class NumberPoolAPI:
             return True
         return False
 
-    def _get_free_pool_name(self, pool_id):
-        return f"Pool: {pool_id} / Free"
-
-    def _get_taken_pool_name(self, pool_id):
-        return f"Pool: {pool_id} / Taken"
-
-    def _get_session_number_hash_name(self, pool_id):
-        return f"Pool: {pool_id} / SID Number Hash"
-
     def _get_free_numbers(self, pool_id):
-        return set(self.conn.smembers(self._get_free_pool_name(pool_id)))
+        pipeline = self.conn.pipeline(transaction=False)
+        for shard in self._get_shards(self.get_shard_count(pool_id)):
+            pipeline.smembers(self._get_free_pool_name(pool_id, shard=shard))
+        return set().union(*pipeline.execute())
 
     def _get_taken_numbers(self, pool_id):
-        return set(self.conn.zrange(self._get_taken_pool_name(pool_id), 0, -1))
-
-    def _get_pool_session_key(self, pool_id):
-        # TODO make this configurable per pool
-        return POOL_SESSION_KEY
-
-    def _get_session_id(self, pool_id, request_context):
-        key = self._get_pool_session_key(pool_id)
-        return request_context.get(key, None)
+        pipeline = self.conn.pipeline(transaction=False)
+        for shard in self._get_shards(self.get_shard_count(pool_id)):
+            pipeline.zrange(self._get_taken_pool_name(pool_id, shard=shard), 0, -1)
+        return set().union(*pipeline.execute())
 
     def _get_session_number(self, pool_id, request_context):
-        sid = self._get_session_id(pool_id, request_context)
-        if not sid:
+        """Look up the session's number in every shard, home shard first"""
+        pipeline = self.conn.pipeline(transaction=False)
+        if not self._queue_session_number_reads(
+            pipeline, pool_id, self.get_pool_properties(pool_id), request_context
+        ):
             return None
-        return self.conn.hget(self._get_session_number_hash_name(pool_id), sid)
-
-    def _get_pool_ip_key(self, pool_id):
-        # TODO make this configurable per pool
-        return POOL_IP_KEY
-
-    def _get_session_ip(self, pool_id, request_context):
-        key = self._get_pool_ip_key(pool_id)
-        return request_context.get(key, None)
-
-    def _get_pool_user_agent_key(self, pool_id):
-        # TODO make this configurable per pool
-        return POOL_USER_AGENT_KEY
+        return next(filter(None, pipeline.execute()), None)
 
-    def _get_session_user_agent(self, pool_id, request_context):
-        key = self._get_pool_user_agent_key(pool_id)
-        return request_context.get(key, None)
+    def _get_number_contexts(self, numbers, with_age=False, pool_id=None):
+        """Read the contexts of numbers of a pool in batches. The pool ID is
+        only needed in the v2 layout."""
+        res = {}
+        numbers = list(numbers)
+        shard_count = self._get_number_shard_count(pool_id)
+        for i in range(0, len(numbers), NUMBER_CONTEXT_BATCH_SIZE):
+            batch = numbers[i : i + NUMBER_CONTEXT_BATCH_SIZE]
+            for number, ctx in self._read_number_context_batch(
+                batch, pool_id, shard_count
+            ).items():
+                if ctx and with_age:
+                    ctx["age"] = self._number_context_age(ctx)
+                    ctx["expired"] = self._number_context_expired(ctx)
+                res[number] = ctx
+        return res
 
-    def _get_number_contexts(self, numbers, with_age=False):
+    def _read_number_context_batch(self, numbers, pool_id, shard_count=None):
+        """Read contexts stored in either format with their context updates
+        folded in, with one MGET or pipeline of HGETALLs and the LRANGEs of the
+        updates in one round trip, plus one more for any in the other format"""
         res = {}
+        if not numbers:
+            return res
+        number_keys = dict(pool_id=pool_id, shard_count=shard_count)
+        pipeline = self.conn.pipeline(transaction=False)
+        if self.context_format == NumberContextFormats.HASH:
+            for number in numbers:
+                pipeline.hgetall(self._get_number_key(number, **number_keys))
+            mgets = None
+        else:
+            mgets = self._queue_number_key_mgets(
+                pipeline, numbers, pool_id, shard_count
+            )
         for number in numbers:
-            res[number] = self.get_pool_number_context(number, with_age=with_age)
+            pipeline.lrange(self._get_context_updates_key(number, **number_keys), 0, -1)
+        results = pipeline.execute(raise_on_error=False)
+        for value in results:
+            if isinstance(value, Exception) and not self._is_wrong_type_error(value):
+                raise value
+        updates = dict(zip(numbers, results[-len(numbers) :]))
+        if mgets is None:
+            values = results[: len(numbers)]
+        else:
+            values = self._parse_number_key_mgets(numbers, mgets, results)
+
+        others = []
+        for number, value in zip(numbers, values):
+            # MGET returns None for keys holding other types
+            if isinstance(value, Exception) or value is None:
+                others.append(number)
+                continue
+            res[number], _ = self._parse_number_context(
+                self.context_format, value, updates[number]
+            )
+        if others:
+            context_format = self._get_other_context_format()
+            pipeline = self.conn.pipeline(transaction=False)
+            for number in others:
+                self._queue_number_context_read(
+                    pipeline, number, context_format, pool_id, shard_count
+                )
+            values = iter(pipeline.execute())
+            for number in others:
+                res[number], _ = self._parse_number_context(
+                    context_format, next(values), next(values)
+                )
         return res
 
-    def _create_number_context(self, pool_id, request_context):
-        now = time.time()
-        return dict(
-            pool_id=pool_id,
-            request_context=request_context,
-            leased_at=now,
-            renewed_at=now,
-        )
+    def _queue_number_key_mgets(self, pipeline, numbers, pool_id, shard_count=None):
+        """Queue MGETs of the context keys of numbers of a pool, one per shard
+        in the v2 layout so each stays within a cluster slot. Returns the
+        numbers of each MGET for _parse_number_key_mgets."""
+        if self._is_v2_key_layout():
+            groups = {}
+            for number in numbers:
+                shard = self._get_number_key_shard(number, shard_count=shard_count)
+                groups.setdefault(shard, []).append(number)
+            groups = list(groups.values())
+        else:
+            groups = [numbers]
+        for group in groups:
+            pipeline.mget(
+                [
+                    self._get_number_key(
+                        number, pool_id=pool_id, shard_count=shard_count
+                    )
+                    for number in group
+                ]
+            )
+        return groups
 
-    def _number_context_age(self, context):
-        renewed_at = context["renewed_at"]
-        return int(time.time() - renewed_at)
+    def _parse_number_key_mgets(self, numbers, groups, results):
+        """The values of numbers from the results of a pipeline that starts
+        with the MGETs queued by _queue_number_key_mgets"""
+        values = {}
+        for group, group_values in zip(groups, results):
+            values.update(zip(group, group_values))
+        return [values[number] for number in numbers]
 
     def _number_context_expired(self, context):
         expiration = self.get_cache_expiration(context["pool_id"])
@@ -670,127 +2981,377 @@ class NumberPoolAPI:
             return True
         return False
 
-    def _pop_random_number(self, pool_id):
-        return self.conn.spop(self._get_free_pool_name(pool_id))
+    def _update_free_numbers(
+        self, pool_id, op, numbers=None, client=None, shard=None, area_codes=None
+    ):
+        """Update the free set and its area code index of a shard atomically.
+        Pass a pipeline as client to queue the update with other writes."""
+        keys, args = self._get_free_numbers_params(
+            pool_id, op, numbers=numbers, shard=shard, area_codes=area_codes
+        )
+        return self._free_numbers_script(keys=keys, args=args, client=client)
+
+    def _reap_expired_batch(self, pool_id, batch_size, shard=None):
+        """Reap up to batch_size of the numbers that were expired when read.
+        Returns the number reaped and the number checked."""
+        expiration = self.get_cache_expiration(pool_id)
+        numbers = self.conn.zrangebyscore(
+            self._get_taken_pool_name(pool_id, shard=shard),
+            "-inf",
+            time.time() - expiration,
+            start=0,
+            num=batch_size,
+        )
+        if not numbers:
+            return 0, 0
+        keys, args = self._get_reap_params(
+            pool_id,
+            numbers,
+            expiration,
+            shard=shard,
+            shard_count=self._get_number_shard_count(pool_id),
+        )
+        return self._reap_expired_numbers_script(keys=keys, args=args), len(numbers)
+
+    def _rebuild_area_code_indexes(self, pool_id, area_codes=None):
+        """Rebuild the area code indexes of every shard of a pool. area_codes
+        must cover those of the pool's numbers, and are read from the pool if
+        not given."""
+        shards = self._get_shards(self.get_shard_count(pool_id))
+        if area_codes is None:
+            pipeline = self.conn.pipeline(transaction=False)
+            for shard in shards:
+                pipeline.smembers(self._get_free_pool_name(pool_id, shard=shard))
+                pipeline.zrange(self._get_taken_pool_name(pool_id, shard=shard), 0, -1)
+                pipeline.hkeys(
+                    self._get_free_area_code_counts_name(pool_id, shard=shard)
+                )
+            res = iter(pipeline.execute())
+            area_codes = set()
+            for shard in shards:
+                free, taken, counts = next(res), next(res), next(res)
+                area_codes |= set(counts) | set(
+                    map(self._get_number_area_code, chain(free, taken))
+                )
+        area_codes = sorted(area_codes)
+        pipeline = self.conn.pipeline(transaction=False)
+        for shard in shards:
+            self._update_free_numbers(
+                pool_id,
+                FreeNumbersScriptOps.REBUILD,
+                client=pipeline,
+                shard=shard,
+                area_codes=area_codes,
+            )
+            self._rebuild_taken_area_code_index_script(
+                keys=[
+                    self._get_taken_pool_name(pool_id, shard=shard),
+                    *[
+                        self._get_taken_area_code_pool_name(pool_id, area_code, shard)
+                        for area_code in area_codes
+                    ],
+                ],
+                args=[dumps_json(area_codes)],
+                client=pipeline,
+            )
+        pipeline.execute()
+
+    def _pop_random_number(self, pool_id, shard=None):
+        """Remove a random number from the free set of a shard, retrying if
+        another writer removes it first. Returns None if the set is empty."""
+        free_key = self._get_free_pool_name(pool_id, shard=shard)
+        while True:
+            number = self.conn.srandmember(free_key)
+            if not number:
+                return None
+            if self._update_free_numbers(
+                pool_id, FreeNumbersScriptOps.REMOVE, [number], shard=shard
+            ):
+                return number
 
     def _pop_free_number(self, pool_id, number):
-        return self.conn.srem(self._get_free_pool_name(pool_id), number)
-
-    def _add_taken_number(self, pool_id, number, context):
-        return self.conn.zadd(
-            self._get_taken_pool_name(pool_id), {number: str(context["renewed_at"])}
+        return self._update_free_numbers(
+            pool_id,
+            FreeNumbersScriptOps.REMOVE,
+            [number],
+            shard=self._get_number_shard(pool_id, number),
         )
 
-    def _update_taken_number(self, pool_id, number, context):
-        return self.conn.zadd(
-            self._get_taken_pool_name(pool_id),
-            {number: str(context["renewed_at"])},
-            xx=True,  # Only update
-            ch=True,  # Return count of changed
+    def _write_taken_number(
+        self, pool_id, number, context, sid=None, update=False, stored_fields=None
+    ):
+        """Write a taken number's set entries, context and session mapping in
+        one MULTI/EXEC. Returns the result of the taken set ZADD."""
+        pipeline = self.conn.pipeline()
+        self._queue_taken_number(
+            pipeline,
+            pool_id,
+            number,
+            context,
+            sid=sid,
+            update=update,
+            stored_fields=stored_fields,
+            shard=self._get_number_shard(pool_id, number),
+            shard_count=self._get_number_shard_count(pool_id),
         )
+        return pipeline.execute()[0]
 
     def _get_least_recently_renewed(self, pool_id):
-        """Get the member with the earliest timestamp"""
-        res = self.conn.zrangebyscore(
-            self._get_taken_pool_name(pool_id),
-            "-inf",
-            "+inf",
-            withscores=True,
-            start=0,
-            num=1,
+        """Get the member with the earliest timestamp across all shards"""
+        pipeline = self.conn.pipeline(transaction=False)
+        self._queue_least_recently_renewed(
+            pipeline, pool_id, self.get_shard_count(pool_id)
         )
-        return res[0] if res else None
+        return self._parse_least_recently_renewed(pipeline.execute())
 
     # NOTE Everything below is expected to be called with a pool lock held!
 
-    def _add_session_number(self, pool_id, sid, number):
-        return self.conn.hset(
-            self._get_session_number_hash_name(pool_id), sid, value=number
-        )
-
     def _get_pool_numbers(self, pool_id):
-        return self._get_free_numbers(pool_id) | self._get_taken_numbers(pool_id)
+        pipeline = self.conn.pipeline(transaction=False)
+        self._queue_pool_numbers(pipeline, pool_id, self.get_shard_count(pool_id))
+        return set().union(*pipeline.execute())
+
+    def _queue_pool_numbers(self, pipeline, pool_id, shard_count):
+        """Queue reading the free and taken numbers of every shard"""
+        for shard in self._get_shards(shard_count):
+            pipeline.smembers(self._get_free_pool_name(pool_id, shard=shard))
+            pipeline.zrange(self._get_taken_pool_name(pool_id, shard=shard), 0, -1)
 
     def _add_numbers(self, pool_id, numbers):
-        return self.conn.sadd(self._get_free_pool_name(pool_id), *numbers)
+        count = 0
+        for shard, shard_numbers in self._group_by_shard(
+            numbers, self.get_shard_count(pool_id)
+        ).items():
+            count += self._update_free_numbers(
+                pool_id, FreeNumbersScriptOps.ADD, shard_numbers, shard=shard
+            )
+        return count
 
     def _remove_numbers(self, pool_id, numbers):
         """Completely remove numbers from the pool"""
         info(f"removing {len(numbers)} numbers from the pool")
-        sids = []
-        for number in numbers:
-            ctx = self.get_pool_number_context(number)
+        shard_count = self.get_shard_count(pool_id)
+        sids = {}
+        for number, ctx in self._get_number_contexts(numbers, pool_id=pool_id).items():
             if not ctx:
                 continue
             sid = self._get_session_id(pool_id, ctx.get("request_context", {}) or {})
             if sid:
-                sids.append(sid)
-
-        # remove from taken
-        self.conn.zrem(self._get_taken_pool_name(pool_id), *numbers)
-        # remove from keys
-        self.conn.delete(*numbers)
-        # remove from free
-        self.conn.srem(self._get_free_pool_name(pool_id), *numbers)
-        # remove session -> number mappings
-        if sids:
-            self.conn.hdel(self._get_session_number_hash_name(pool_id), *sids)
+                sids.setdefault(self._get_shard(number, shard_count), []).append(sid)
+
+        pipeline = self._get_multi_shard_pipeline()
+        number_keys = dict(pool_id=pool_id, shard_count=shard_count)
+        for shard, shard_numbers in self._group_by_shard(numbers, shard_count).items():
+            # remove from keys
+            pipeline.delete(
+                *[self._get_number_key(n, **number_keys) for n in shard_numbers]
+            )
+            pipeline.delete(
+                *[self._get_attribution_key(n, **number_keys) for n in shard_numbers]
+            )
+            # remove from taken
+            pipeline.zrem(
+                self._get_taken_pool_name(pool_id, shard=shard), *shard_numbers
+            )
+            pipeline.zrem(
+                self._get_confirmed_pool_name(pool_id, shard=shard), *shard_numbers
+            )
+            for area_code, area_code_numbers in self._group_by_area_code(
+                shard_numbers
+            ).items():
+                pipeline.zrem(
+                    self._get_taken_area_code_pool_name(
+                        pool_id, area_code, shard=shard
+                    ),
+                    *area_code_numbers,
+                )
+            # remove from free
+            self._update_free_numbers(
+                pool_id,
+                FreeNumbersScriptOps.REMOVE,
+                shard_numbers,
+                client=pipeline,
+                shard=shard,
+            )
+            # remove session -> number mappings
+            if sids.get(shard, None):
+                pipeline.hdel(
+                    self._get_session_number_hash_name(pool_id, shard=shard),
+                    *sids[shard],
+                )
+        pipeline.execute()
 
     def _take_number(self, pool_id, number, request_context, update=False):
-        context = self._create_number_context(pool_id, request_context)
-        if update:
-            res = self._update_taken_number(pool_id, number, context)
-        else:
-            res = self._add_taken_number(pool_id, number, context)
-        raiseifnot(res, f"Failed to take number: {pool_id}/{number}")
-        self.set_number_context(number, context)
+        context = self._create_number_context(
+            pool_id, request_context, pool_props=self.get_pool_properties(pool_id)
+        )
         sid = self._get_session_id(pool_id, request_context)
-        if sid:
-            self._add_session_number(pool_id, sid, number)
+        res = self._write_taken_number(pool_id, number, context, sid=sid, update=update)
+        raiseifnot(res, f"Failed to take number: {pool_id}/{number}")
         return res
 
     def _renew_number(self, pool_id, number, context=None, from_sid=False):
         """Expected to be called with a number that is 'taken'"""
         dbg(f"Renewing number {pool_id}/{number}")
 
-        curr_context = self.get_pool_number_context(number)
+        curr_context, stored_fields = self._read_number_context(number)
         raiseif(curr_context is None, "Trying to renew inactive number")
         if not context:
             warn(f"No context provided, using number {number} context")
             context = curr_context
 
+        context = self._get_renewed_context(
+            pool_id,
+            number,
+            context,
+            curr_context,
+            pool_props=self.get_pool_properties(pool_id),
+        )
         sid = self._get_session_id(pool_id, context["request_context"])
-        curr_sid = self._get_session_id(pool_id, curr_context["request_context"])
-        if sid != curr_sid:
-            msg = f"session key mismatch for {pool_id}/{number} {sid}/{curr_sid}, can not renew"
-            warn(msg)
-            raise NumberSessionKeyMismatch(msg)
-
-        if context != curr_context:
-            # 2nd arg overwrites 1st on conflict
-            context = dictmerge(curr_context, context, overwrite=True)
+        # Ensure this SID is associated with this number
+        res = self._write_taken_number(
+            pool_id,
+            number,
+            context,
+            sid=None if from_sid else sid,
+            update=True,
+            stored_fields=stored_fields,
+        )
+        raiseifnot(res, f"Failed to renew number: {pool_id}/{number}")
+        return res
 
-        context["renewed_at"] = time.time()
-        if (context["renewed_at"] - context["leased_at"]) > NUMBER_POOL_MAX_RENEWAL_AGE:
-            msg = f"Not renewing number {pool_id}/{number} due to max renewal time"
-            warn(msg)
-            raise NumberMaxRenewalExceeded(msg)
+    def _confirm_recent_renewal(self, pool_id, request_context, target_number):
+        """Confirm a renewal by a session that already owns the target number
+        if it was renewed within the pool's renewal throttle, without the pool
+        lock or rewriting the context. Returns None if a full lease is needed."""
+        request_context = request_context or {}
+        if not self._get_session_id(pool_id, request_context):
+            return None
+        throttle = self.get_renewal_throttle(pool_id)
+        if not throttle:
+            return None
+        interval = throttle * (self.get_cache_expiration(pool_id))
+        pool_props = self.get_pool_properties(pool_id)
+        session_number = None
+        if not target_number and self._confirm_needs_session_number(
+            self._get_shard_count_from_properties(pool_id, pool_props)
+        ):
+            session_number = self._get_session_number(pool_id, request_context)
+            if not session_number:
+                return None
+        keys, args = self._get_confirm_renewal_params(
+            pool_id,
+            request_context,
+            target_number,
+            interval,
+            pool_props=pool_props,
+            session_number=session_number,
+        )
+        number = self._confirm_renewal_script(keys=keys, args=args)
+        if number:
+            dbg(f"Confirmed recent renewal of {pool_id}/{number}")
+        return number or None
 
-        res = self._update_taken_number(pool_id, number, context)
-        raiseifnot(res, f"Failed to renew number: {pool_id}/{number}")
-        self.set_number_context(number, context)
-        if sid and (not from_sid):
-            # Ensure this SID is associated with this number
-            self._add_session_number(pool_id, sid, number)
+    def _run_lease_script(
+        self, pool_id, request_context, target_number, renew, area_codes
+    ):
+        """Run the lease script on the shards in turn until one finds a number
+        or the session's number turns out to be unavailable. The target number
+        is only looked up in its own shard, the first one tried. The script is
+        run again on a shard when it asks for the keys of another number."""
+        pool_props = self.get_pool_properties(pool_id)
+        expiration = self.get_cache_expiration(pool_id)
+        first_number = target_number
+        if self.get_shard_count(pool_id) > 1 and not target_number:
+            # Start with the shard of the session's number if it has one
+            first_number = self._get_session_number(pool_id, request_context)
+        shards = self._get_lease_shards(
+            pool_id, pool_props, request_context, first_number
+        )
+        for pass_area_codes, allow_expired in self._get_lease_passes(
+            shards, area_codes
+        ):
+            pass_shards = shards
+            if allow_expired and len(shards) > 1:
+                pipeline = self.conn.pipeline(transaction=False)
+                self._queue_oldest_taken(pipeline, pool_id, shards, pass_area_codes)
+                pass_shards = self._get_expired_shards(
+                    shards,
+                    pass_area_codes,
+                    pipeline.execute(),
+                    time.time() - expiration,
+                )
+            for shard in pass_shards:
+                declared_numbers = self._get_declared_lease_numbers(
+                    pool_id, shard, target_number
+                )
+                for _ in range(LEASE_SCRIPT_MAX_DECLARES):
+                    keys, args = self._get_lease_script_params(
+                        pool_id,
+                        request_context,
+                        target_number,
+                        renew,
+                        pass_area_codes,
+                        expiration,
+                        pool_props=pool_props,
+                        shard=shard,
+                        allow_expired=allow_expired,
+                        declared_numbers=declared_numbers,
+                    )
+                    res = self._lease_number_script(keys=keys, args=args)
+                    if not self._declare_lease_number(res, declared_numbers):
+                        break
+                else:
+                    raise self._get_lease_tries_error(pool_id)
+                res = self._cache_lease_candidates(pool_id, shard, res)
+                target_number = None
+                status, from_sid = res[0], res[3]
+                if status != LeaseScriptStatus.EMPTY or from_sid:
+                    return res
         return res
 
+    def _commit_script_renewal(
+        self, pool_id, number, raw_context, request_context, from_sid=False
+    ):
+        """Write back a renewal of a number context read by the lease script if
+        the number has not changed in the meantime. Returns False if the renewal
+        lost a race and should be retried."""
+        dbg(f"Renewing number {pool_id}/{number}")
+        updates = None
+        if self.get_renewal_throttle(pool_id):
+            updates = self.conn.lrange(
+                self._get_context_updates_key(
+                    number,
+                    pool_id=pool_id,
+                    shard_count=self._get_number_shard_count(pool_id),
+                ),
+                0,
+                -1,
+            )
+        keys, args = self._get_script_renewal_params(
+            pool_id,
+            number,
+            raw_context,
+            request_context,
+            from_sid=from_sid,
+            pool_props=self.get_pool_properties(pool_id),
+            updates=updates,
+        )
+        return bool(self._renew_number_script(keys=keys, args=args))
+
     def _lease_random_number(self, pool_id, request_context):
-        number = self._pop_random_number(pool_id)
+        number = None
+        for shard in self._get_lease_shards(
+            pool_id, self.get_pool_properties(pool_id), request_context, None
+        ):
+            number = self._pop_random_number(pool_id, shard=shard)
+            if number:
+                break
         if not number:
             dbg("No free numbers found, checking expired...")
             res = self._get_least_recently_renewed(pool_id)
             raiseifnot(res, "No least recently renewed number?")
-            target_number, renewed_at = res
+            target_number, _ = res
             status, _ = self.get_number_status(target_number)
             if status == NumberStatus.EXPIRED:
                 return self._lease_expired_number(
@@ -804,50 +3365,42 @@ class NumberPoolAPI:
         return number
 
     def _lease_area_code_number(self, pool_id, request_context, area_codes):
-        fallback_area_code = self.get_pool_properties(pool_id).get(
-            "fallback_area_code", None
+        pool_props = self.get_pool_properties(pool_id)
+        fallback_area_code, area_codes = self._get_area_code_search(
+            pool_id, pool_props, area_codes
         )
-        raiseifnot(
-            fallback_area_code, f"No fallback area code specified for pool {pool_id}"
-        )
-        if not area_codes:
-            # This can happen if the area code pool is in use but we didn't have
-            # enough info to target a specific area code. We still want to force
-            # picking a number from the fallback area code.
-            warn(f"Area code not specified, using fallback {fallback_area_code}")
-            area_codes = [fallback_area_code]
 
+        shards = self._get_lease_shards(pool_id, pool_props, request_context, None)
         for area_code in area_codes:
-            raiseifnot(
-                isinstance(area_code, str)
-                and len(area_code) == 3
-                and area_code.isdigit(),
-                f"Invalid area code: {area_code}",
-            )
-
-            pattern = f"{area_code}*"
             dbg(f"Searching for number with area code {area_code} in {pool_id}")
 
-            for number in self.conn.sscan_iter(
-                self._get_free_pool_name(pool_id), match=pattern, count=10
-            ):
-                leased_number = self._lease_free_number(
-                    pool_id, number, request_context
+            for shard in shards:
+                number = self.conn.srandmember(
+                    self._get_free_area_code_pool_name(pool_id, area_code, shard=shard)
                 )
-                if leased_number:
-                    return leased_number
+                if number:
+                    leased_number = self._lease_free_number(
+                        pool_id, number, request_context
+                    )
+                    if leased_number:
+                        return leased_number
 
             dbg(f"No free number found for area code {area_code}, checking expired...")
 
             max_expired_tries = 3
-            for number in self.conn.zrange(self._get_taken_pool_name(pool_id), 0, -1):
-                if not number.startswith(area_code):
-                    continue
-
+            cutoff = time.time() - self.get_cache_expiration(pool_id)
+            pipeline = self.conn.pipeline(transaction=False)
+            self._queue_expired_area_code_candidates(
+                pipeline, pool_id, area_code, shards, cutoff, max_expired_tries
+            )
+            for number in self._parse_expired_area_code_candidates(
+                pipeline.execute(), max_expired_tries
+            ):
                 status, _ = self.get_number_status(number)
                 if status != NumberStatus.EXPIRED:
                     dbg(
-                        f"Least recently renewed taken number {number} for {area_code} is not expired. Stopping search!"
+                        f"Least recently renewed taken number {number} for "
+                        f"{area_code} is not expired. Stopping search!"
                     )
                     break
 
@@ -862,7 +3415,8 @@ class NumberPoolAPI:
                 max_expired_tries -= 1
                 if max_expired_tries <= 0:
                     warn(
-                        f"Max tries checking expired numbers for area code {area_code} in {pool_id}"
+                        "Max tries checking expired numbers for area code "
+                        f"{area_code} in {pool_id}"
                     )
                     break
 
@@ -872,7 +3426,8 @@ class NumberPoolAPI:
         if fallback_area_code not in area_codes:
             # TODO: record stats in redis or db
             warn(
-                f"Trying fallback area code {fallback_area_code}. Target was {area_codes}"
+                f"Trying fallback area code {fallback_area_code}. "
+                f"Target was {area_codes}"
             )
             leased_number = self._lease_area_code_number(
                 pool_id, request_context, [fallback_area_code]
@@ -894,7 +3449,12 @@ class NumberPoolAPI:
     def _lease_expired_number(self, pool_id, number, request_context):
         """This will just take over an already-taken-but-expired number"""
         info(f"Leasing expired number: {pool_id}/{number}")
-        self._take_number(pool_id, number, request_context, update=True)
+        with self._get_number_scope_lock(pool_id, number):
+            if self._pop_free_number(pool_id, number):
+                # Already returned to the free set by the expiry reaper
+                self._take_number(pool_id, number, request_context)
+            else:
+                self._take_number(pool_id, number, request_context, update=True)
         return number
 
     def _set_number_renewed_at(self, number, renewed_at):
@@ -903,13 +3463,26 @@ class NumberPoolAPI:
             status == NumberStatus.TAKEN,
             f"Trying to set renewed_at on number with invalid status: {status}",
         )
-        ctx = self.get_pool_number_context(number)
+        ctx, stored_fields = self._read_number_context(number)
         ctx["renewed_at"] = renewed_at
-        self.set_number_context(number, ctx)
+        self._write_taken_number(
+            ctx["pool_id"], number, ctx, update=True, stored_fields=stored_fields
+        )
 
     def _reset_pool(self, pool_id, numbers=None, preserve=True):
-        target_numbers = numbers or self.get_pool_numbers_from_db(pool_id)
-        current_numbers = self._get_pool_numbers(pool_id)
+        target_numbers = (
+            self.get_pool_numbers_from_db(pool_id) if numbers is None else numbers
+        )
+        shard_count = self.get_shard_count(pool_id)
+        pipeline = self.conn.pipeline(transaction=False)
+        pipeline.get(self._get_pool_shards_key(pool_id))
+        self._queue_pool_numbers(pipeline, pool_id, shard_count)
+        curr_shard_count, *shard_numbers = pipeline.execute()
+        curr_shard_count = int(curr_shard_count or 1)
+        if curr_shard_count != shard_count:
+            current_numbers = self._reshard_pool(pool_id, curr_shard_count, shard_count)
+        else:
+            current_numbers = set().union(*shard_numbers)
         if preserve:
             # Remove only numbers that no longer exist
             removes = current_numbers - target_numbers
@@ -923,13 +3496,184 @@ class NumberPoolAPI:
             self._remove_numbers(pool_id, removes)
         if adds:
             self._add_numbers(pool_id, adds)
+        self._update_number_pool_ids(
+            pool_id, target_numbers, removes=removes - target_numbers
+        )
+        # Also builds the indexes for pools that predate them
+        self._rebuild_area_code_indexes(
+            pool_id,
+            area_codes=self._group_by_area_code(current_numbers | target_numbers),
+        )
         info(f"{len(target_numbers)} total, {len(removes)} removes, {len(adds)} adds")
 
+    def _reshard_pool(self, pool_id, curr_shard_count, shard_count, source=None):
+        """Move the free and taken numbers and session mappings of a pool from
+        curr_shard_count shards to shard_count shards, returning the numbers
+        moved. source is an API for the key layout the pool is currently in, if
+        not this API's. Number contexts and context updates are moved too if
+        their keys change, which only happens with the v2 layout."""
+        info(f"Resharding pool {pool_id} from {curr_shard_count} to {shard_count}")
+        source = source or self
+        curr_shards = source._get_shards(curr_shard_count)
+        pipeline = self.conn.pipeline(transaction=False)
+        for shard in curr_shards:
+            pipeline.smembers(source._get_free_pool_name(pool_id, shard=shard))
+            pipeline.zrange(
+                source._get_taken_pool_name(pool_id, shard=shard),
+                0,
+                -1,
+                withscores=True,
+            )
+            pipeline.hgetall(source._get_session_number_hash_name(pool_id, shard=shard))
+            pipeline.zrange(
+                source._get_confirmed_pool_name(pool_id, shard=shard),
+                0,
+                -1,
+                withscores=True,
+            )
+        res = iter(pipeline.execute())
+
+        free, taken, sessions, confirmed = set(), {}, {}, {}
+        for shard in curr_shards:
+            free |= next(res)
+            taken.update(next(res))
+            sessions.update(next(res))
+            confirmed.update(next(res))
+
+        # Not a transaction if v2 keys are involved, see _get_multi_shard_pipeline
+        pipeline = self.conn.pipeline(
+            transaction=not (source._is_v2_key_layout() or self._is_v2_key_layout())
+        )
+        area_codes = self._group_by_area_code(free | set(taken))
+        for shard in curr_shards:
+            deletes = [
+                source._get_free_pool_name(pool_id, shard=shard),
+                source._get_taken_pool_name(pool_id, shard=shard),
+                source._get_free_area_code_counts_name(pool_id, shard=shard),
+                source._get_session_number_hash_name(pool_id, shard=shard),
+                source._get_confirmed_pool_name(pool_id, shard=shard),
+            ]
+            for area_code in area_codes:
+                deletes.append(
+                    source._get_free_area_code_pool_name(
+                        pool_id, area_code, shard=shard
+                    )
+                )
+                deletes.append(
+                    source._get_taken_area_code_pool_name(
+                        pool_id, area_code, shard=shard
+                    )
+                )
+            pipeline.delete(*deletes)
+        for shard, numbers in self._group_by_shard(free, shard_count).items():
+            self._update_free_numbers(
+                pool_id, FreeNumbersScriptOps.ADD, numbers, client=pipeline, shard=shard
+            )
+        for shard, numbers in self._group_by_shard(taken, shard_count).items():
+            pipeline.zadd(
+                self._get_taken_pool_name(pool_id, shard=shard),
+                {number: taken[number] for number in numbers},
+            )
+        for shard, numbers in self._group_by_shard(confirmed, shard_count).items():
+            pipeline.zadd(
+                self._get_confirmed_pool_name(pool_id, shard=shard),
+                {number: confirmed[number] for number in numbers},
+            )
+        for sid, number in sessions.items():
+            if number not in free and number not in taken:
+                continue
+            pipeline.hset(
+                self._get_session_number_hash_name(
+                    pool_id, shard=self._get_shard(number, shard_count)
+                ),
+                sid,
+                value=number,
+            )
+        if shard_count > 1:
+            pipeline.set(self._get_pool_shards_key(pool_id), shard_count)
+        else:
+            pipeline.delete(self._get_pool_shards_key(pool_id))
+        pipeline.execute()
+
+        moves = []
+        for number in free | set(taken):
+            for get_key_name in (
+                "_get_number_key",
+                "_get_context_updates_key",
+                "_get_attribution_key",
+            ):
+                moves.append(
+                    (
+                        getattr(source, get_key_name)(
+                            number, pool_id=pool_id, shard_count=curr_shard_count
+                        ),
+                        getattr(self, get_key_name)(
+                            number, pool_id=pool_id, shard_count=shard_count
+                        ),
+                    )
+                )
+        self._move_keys([(src, dst) for src, dst in moves if src != dst])
+        self._update_number_pool_ids(pool_id, free | set(taken))
+        # The taken area code indexes are rebuilt by the caller
+        return free | set(taken)
+
+    def _update_number_pool_ids(self, pool_id, numbers, removes=None):
+        """Map numbers to the pool in NUMBER_POOL_IDS_KEY, and unmap the
+        removed numbers still mapped to it, since they may have moved to a pool
+        that was reset first. Only kept in the v2 layout. Publishes a change to
+        the pool so processes drop their cached lookups."""
+        if not self._is_v2_key_layout():
+            return
+        removes = list(removes or [])
+        if removes:
+            curr_pool_ids = self.conn.hmget(NUMBER_POOL_IDS_KEY, removes)
+            removes = [
+                number
+                for number, curr_pool_id in zip(removes, curr_pool_ids)
+                if self._parse_number_pool_id(curr_pool_id) == pool_id
+            ]
+        pipeline = self.conn.pipeline(transaction=False)
+        if removes:
+            pipeline.hdel(NUMBER_POOL_IDS_KEY, *removes)
+        if numbers:
+            pipeline.hset(
+                NUMBER_POOL_IDS_KEY, mapping={number: pool_id for number in numbers}
+            )
+        pipeline.publish(POOL_PROPERTIES_CHANNEL, pool_id)
+        pipeline.execute()
+        pool_properties_cache.invalidate(pool_id)
+
+    def _move_keys(self, moves):
+        """Move keys to new names with DUMP and RESTORE, keeping their TTLs.
+        RENAME would require both names to be in the same cluster slot. Returns
+        the number of keys moved."""
+        count = 0
+        for i in range(0, len(moves), NUMBER_CONTEXT_BATCH_SIZE):
+            batch = moves[i : i + NUMBER_CONTEXT_BATCH_SIZE]
+            pipeline = self.conn.pipeline(transaction=False)
+            for src, _ in batch:
+                pipeline.dump(src)
+                pipeline.pttl(src)
+            res = iter(pipeline.execute())
+            pipeline = self.conn.pipeline(transaction=False)
+            for src, dst in batch:
+                value, ttl = next(res), next(res)
+                if value is None:
+                    continue
+                pipeline.restore(dst, max(ttl, 0), value, replace=True)
+                pipeline.delete(src)
+                count += 1
+            pipeline.execute()
+        return count
+
     def _reset_pools(self, preserve=True):
         pools = self.get_pools_from_db()
-        self._pool_properties_cache = {}
-        self._pool_properties_cache_updated_at = {}
+        pool_properties_cache.invalidate()
+        self._pools_cache = None
         info(f"Resetting {len(pools)} pools")
+        numbers = self.get_all_pool_numbers_from_db(
+            pool_ids=[pool["id"] for pool in pools]
+        )
         for pool in pools:
             self.set_pool_properties(pool["id"], pool)
-            self._reset_pool(pool["id"], preserve=preserve)
+            self._reset_pool(pool["id"], numbers=numbers[pool["id"]], preserve=preserve)
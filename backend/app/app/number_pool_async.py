@@ -0,0 +1,945 @@
+"""An asyncio version of the NumberPoolAPI request path built on redis.asyncio,
+so the API endpoints can lease numbers and read/write contexts without blocking
+the event loop or occupying threadpool slots.
+
+It operates on the same Redis data structures, locks and Lua scripts as
+NumberPoolAPI. Key names, script parameters and the handling of results are
+shared through NumberPoolAPIBase, so this class only does the awaited I/O. Pool
+maintenance (init, reset, stats, reaping) stays on the synchronous NumberPoolAPI
+since it is driven by the database.
+"""
+
+import asyncio
+import time
+
+from redis.exceptions import LockError, ResponseError
+import rollbar
+from tlbx import json, dbg, info, warn, raiseif, raiseifnot
+
+from app.db.redis_codec import get_encoded
+from app.db.redis_session import (
+    RedisFamilies,
+    create_async_redis_client,
+    get_redis_family_url,
+)
+from app.number_pool import (
+    LEASE_SCRIPT_MAX_DECLARES,
+    LEASE_SCRIPT_MAX_TRIES,
+    NUMBER_POOL_IDS_KEY,
+    NUMBER_POOL_ROUTE_CACHE_EXPIRATION,
+    NUMBER_POOL_USER_CONTEXT_EXPIRATION,
+    FreeNumbersScriptOps,
+    LeaseScriptStatus,
+    NumberNotFound,
+    NumberPoolAPIBase,
+    NumberPoolLeaseModes,
+    NumberPoolLockScopes,
+    NumberPoolUnavailable,
+    NumberSessionKeyMismatch,
+    NumberStatus,
+    get_number_pool_conn,
+    pool_properties_cache,
+)
+from app.number_pool_scripts import (
+    CONFIRM_RENEWAL_SCRIPT,
+    FREE_NUMBERS_SCRIPT,
+    LEASE_NUMBER_SCRIPT,
+    RENEW_NUMBER_SCRIPT,
+)
+from app.schemas.zar import UserIDTypes
+
+
+async_number_pool_conn = None
+
+
+def get_async_number_pool_conn(refresh=False):
+    """The client connects lazily, so unlike get_number_pool_conn there is
+    nothing to retry here. Connection errors surface on first use and are
+    retried by the client."""
+    global async_number_pool_conn
+    if (not async_number_pool_conn) or refresh:
+        async_number_pool_conn = create_async_redis_client()
+        info("Created async Redis number pool client")
+    return async_number_pool_conn
+
+
+async_redis_family_conns = {}
+
+
+def get_async_redis_family_conn(family, refresh=False):
+    """See get_redis_family_conn"""
+    url = get_redis_family_url(family)
+    if not url:
+        return get_async_number_pool_conn()
+    if (url not in async_redis_family_conns) or refresh:
+        async_redis_family_conns[url] = create_async_redis_client(url=url)
+        info(f"Created async Redis {family} client")
+    return async_redis_family_conns[url]
+
+
+async def close_async_number_pool_conn():
+    """Drop pooled connections, which are bound to the running event loop. The
+    clients reconnect on next use."""
+    if async_number_pool_conn:
+        await async_number_pool_conn.connection_pool.disconnect()
+    for conn in async_redis_family_conns.values():
+        await conn.connection_pool.disconnect()
+
+
+class AsyncNumberPoolAPI(NumberPoolAPIBase):
+    """Same semantics as NumberPoolAPI for leases, renewals, number updates and
+    user/route/static contexts, with every Redis call awaited. See NumberPoolAPI
+    for a description of the data structures and lease modes."""
+
+    def __init__(
+        self,
+        lease_mode=None,
+        context_format=None,
+        codec=None,
+        lock_scope=None,
+        key_layout=None,
+    ):
+        self._init_options(lease_mode, context_format, codec, lock_scope, key_layout)
+        self.conn = get_async_number_pool_conn()
+        self._connect_families()
+        self._register_scripts()
+        # The listener thread uses the sync client
+        pool_properties_cache.start_listener(get_number_pool_conn())
+
+    def _register_scripts(self):
+        self._lease_number_script = self.conn.register_script(LEASE_NUMBER_SCRIPT)
+        self._renew_number_script = self.conn.register_script(RENEW_NUMBER_SCRIPT)
+        self._confirm_renewal_script = self.conn.register_script(CONFIRM_RENEWAL_SCRIPT)
+        self._free_numbers_script = self.conn.register_script(FREE_NUMBERS_SCRIPT)
+
+    def _connect_families(self, refresh=False):
+        """See NumberPoolAPI._connect_families"""
+        self.route_conn = get_async_redis_family_conn(
+            RedisFamilies.ROUTES, refresh=refresh
+        )
+        self.user_context_conn = get_async_redis_family_conn(
+            RedisFamilies.USER_CONTEXTS, refresh=refresh
+        )
+        self.lease_callers_conn = get_async_redis_family_conn(
+            RedisFamilies.LEASE_CALLERS, refresh=refresh
+        )
+
+    async def refresh_conn(self):
+        old_conns = {self.conn, self.route_conn, self.user_context_conn}
+        old_conns.add(self.lease_callers_conn)
+        self.conn = get_async_number_pool_conn(refresh=True)
+        self._connect_families(refresh=True)
+        self._register_scripts()
+        new_conns = {self.conn, self.route_conn, self.user_context_conn}
+        new_conns.add(self.lease_callers_conn)
+        for old_conn in old_conns - new_conns:
+            await old_conn.close()
+
+    async def get_pool_properties(self, pool_id):
+        res = pool_properties_cache.get(pool_id)
+        if res is not None:
+            return res
+        generation = pool_properties_cache.generation
+        key = self._get_pool_properties_key(pool_id)
+        properties_json = await self.conn.get(key)
+        if properties_json:
+            res = json.loads(properties_json)
+            pool_properties_cache.set(pool_id, res, generation=generation)
+            return res
+        msg = f"Pool properties not found for pool {pool_id}"
+        rollbar.report_message(dict(msg=msg), "warning")
+        return {}
+
+    async def is_area_code_pool(self, pool_id):
+        return self._is_area_code_pool_properties(
+            await self.get_pool_properties(pool_id)
+        )
+
+    async def get_cache_expiration(self, pool_id):
+        return self._get_cache_expiration_from_properties(
+            pool_id, await self.get_pool_properties(pool_id)
+        )
+
+    async def get_renewal_throttle(self, pool_id):
+        return self._get_renewal_throttle_from_properties(
+            pool_id, await self.get_pool_properties(pool_id)
+        )
+
+    async def get_shard_count(self, pool_id):
+        return self._get_shard_count_from_properties(
+            pool_id, await self.get_pool_properties(pool_id)
+        )
+
+    async def _get_number_shard(self, pool_id, number):
+        return self._get_shard(number, await self.get_shard_count(pool_id))
+
+    async def _get_number_shard_count(self, pool_id):
+        """See NumberPoolAPI._get_number_shard_count"""
+        if not self._is_v2_key_layout() or pool_id is None:
+            return None
+        return await self.get_shard_count(pool_id)
+
+    async def get_pool_number_context(self, number, with_age=False):
+        res, _ = await self._read_number_context(number)
+        if res and with_age:
+            res["age"] = self._number_context_age(res)
+            res["expired"] = await self._number_context_expired(res)
+        dbg(f"{number}: {res}")
+        return res
+
+    async def set_number_context(self, number, context, stored_fields=None):
+        dbg(f"{number}: {context}")
+        shard_count = await self._get_number_shard_count(context["pool_id"])
+        pipeline = self.conn.pipeline()
+        self._queue_number_context(
+            pipeline,
+            number,
+            context,
+            stored_fields=stored_fields,
+            shard_count=shard_count,
+        )
+        await pipeline.execute()
+
+    async def _get_number_pool_id(self, number):
+        """See NumberPoolAPI._get_number_pool_id"""
+        if not self._is_v2_key_layout():
+            return None
+        pool_id = pool_properties_cache.get_number_pool_id(number)
+        if pool_id is None:
+            generation = pool_properties_cache.generation
+            pool_id = self._parse_number_pool_id(
+                await self.conn.hget(NUMBER_POOL_IDS_KEY, number)
+            )
+            pool_properties_cache.set_number_pool_id(
+                number, pool_id, generation=generation
+            )
+        return pool_id or None
+
+    async def _read_number_context(self, number):
+        """See NumberPoolAPI._read_number_context"""
+        pool_id = await self._get_number_pool_id(number)
+        if not self._has_number_keys(pool_id):
+            return None, None
+        shard_count = await self._get_number_shard_count(pool_id)
+        try:
+            return await self._read_number_context_as(
+                number, self.context_format, pool_id, shard_count
+            )
+        except ResponseError as e:
+            if not self._is_wrong_type_error(e):
+                raise
+        return await self._read_number_context_as(
+            number, self._get_other_context_format(), pool_id, shard_count
+        )
+
+    async def _read_number_context_as(
+        self, number, context_format, pool_id, shard_count
+    ):
+        """Read a number context stored in the given format, with its context
+        updates folded in, in one round trip"""
+        pipeline = self.conn.pipeline(transaction=False)
+        self._queue_number_context_read(
+            pipeline, number, context_format, pool_id, shard_count
+        )
+        res, updates = await pipeline.execute()
+        return self._parse_number_context(context_format, res, updates)
+
+    async def get_number_status(self, number, with_age=False):
+        res = await self.get_pool_number_context(number, with_age=with_age)
+        if not res:
+            return NumberStatus.FREE, None
+        if await self._number_context_expired(res):
+            return NumberStatus.EXPIRED, res
+        return NumberStatus.TAKEN, res
+
+    async def track_lease_caller(self, number, context, call_from):
+        pipeline = self.lease_callers_conn.pipeline()
+        self._queue_lease_caller(pipeline, number, context, call_from)
+        _, _, distinct_callers = await pipeline.execute()
+        return distinct_callers
+
+    async def set_cached_route_context(self, call_from, call_to, context):
+        if self._is_ignored_phone_user_id(call_from):
+            return
+        context = self._number_context_value(context)
+        key = self.get_cached_route_key(call_from, call_to)
+        await self.route_conn.set(
+            key, self.codec.dumps(context), ex=NUMBER_POOL_ROUTE_CACHE_EXPIRATION
+        )
+
+    async def get_cached_route_context(self, call_from, call_to):
+        if self._is_ignored_phone_user_id(call_from):
+            return None
+        key = self.get_cached_route_key(call_from, call_to)
+        res = await get_encoded(self.route_conn, key)
+        return self.codec.loads(res) if res else None
+
+    async def get_user_context(self, id_type, user_id):
+        if id_type == UserIDTypes.PHONE and self._is_ignored_phone_user_id(user_id):
+            return None
+        key = self.get_user_context_key(id_type, user_id)
+        res = await get_encoded(self.user_context_conn, key)
+        return self.codec.loads(res) if res else None
+
+    async def set_user_context(self, id_type, user_id, context):
+        if id_type == UserIDTypes.PHONE and self._is_ignored_phone_user_id(user_id):
+            return
+        key = self.get_user_context_key(id_type, user_id)
+        await self.user_context_conn.set(
+            key, self.codec.dumps(context), ex=NUMBER_POOL_USER_CONTEXT_EXPIRATION
+        )
+
+    async def update_user_context(self, id_type, user_id, context):
+        current_ctx = await self.get_user_context(id_type, user_id)
+        context = self._merge_user_context(current_ctx, context)
+        await self.set_user_context(id_type, user_id, context)
+        return context
+
+    async def remove_user_context(self, id_type, user_id):
+        if id_type == UserIDTypes.PHONE and self._is_ignored_phone_user_id(user_id):
+            return
+        key = self.get_user_context_key(id_type, user_id)
+        await self.user_context_conn.delete(key)
+
+    async def get_static_number_context(self, number):
+        key = self.get_static_number_key(number)
+        res = await get_encoded(self.conn, key)
+        return self.codec.loads(res) if res else None
+
+    async def set_static_number_context(self, number, context):
+        key = self.get_static_number_key(number)
+        await self.conn.set(key, self.codec.dumps(context))
+
+    async def get_number_attribution(self, number):
+        pool_id = await self._get_number_pool_id(number)
+        if not self._has_number_keys(pool_id):
+            return None
+        res = await self.conn.hgetall(
+            self._get_attribution_key(
+                number,
+                pool_id=pool_id,
+                shard_count=await self._get_number_shard_count(pool_id),
+            )
+        )
+        return self._decode_attribution_fields(res)
+
+    async def get_call_contexts(self, call_from, call_to):
+        """See NumberPoolAPI.get_call_contexts. Pipelines on different clients
+        run concurrently."""
+        pool_id = await self._get_number_pool_id(call_to)
+        reads = self._queue_call_context_reads(
+            call_from,
+            call_to,
+            pool_id=pool_id,
+            shard_count=await self._get_number_shard_count(pool_id),
+        )
+        values = await asyncio.gather(
+            *[pipeline.execute(raise_on_error=False) for pipeline, _ in reads]
+        )
+        contexts, reread = self._parse_call_contexts(
+            [(names, res) for (_, names), res in zip(reads, values)],
+            pool_id=pool_id,
+        )
+        if reread:
+            contexts["pool"], _ = await self._read_number_context(call_to)
+        if contexts["pool"] and not contexts["attribution"]:
+            contexts["attribution"] = self._get_context_attribution(contexts["pool"])
+        return contexts
+
+    async def write_call_contexts(
+        self, call_from, call_to, context, user_contexts=None
+    ):
+        """See NumberPoolAPI.write_call_contexts. Pipelines on different
+        clients run concurrently."""
+        pipelines, lease_callers_pipeline = self._queue_call_context_writes(
+            call_from, call_to, context, user_contexts=user_contexts
+        )
+        results = await asyncio.gather(*[pipeline.execute() for pipeline in pipelines])
+        return results[pipelines.index(lease_callers_pipeline)][-1]
+
+    async def lease_number(
+        self,
+        pool_id,
+        request_context,
+        target_number=None,
+        target_area_codes=None,
+        renew=False,
+    ):
+        number = await self._confirm_recent_renewal(
+            pool_id, request_context, target_number
+        )
+        if number:
+            return number
+        if self.lease_mode == NumberPoolLeaseModes.SCRIPT:
+            return await self._lease_number_with_script(
+                pool_id,
+                request_context,
+                target_number=target_number,
+                target_area_codes=target_area_codes,
+                renew=renew,
+            )
+        return await self._lease_number_with_lock(
+            pool_id,
+            request_context,
+            target_number=target_number,
+            target_area_codes=target_area_codes,
+            renew=renew,
+        )
+
+    async def _lease_number_with_lock(
+        self,
+        pool_id,
+        request_context,
+        target_number=None,
+        target_area_codes=None,
+        renew=False,
+    ):
+        request_context = request_context or {}
+        start = time.time()
+        number = None
+        from_sid = False
+        key_mismatch = False
+        sid_number_mismatch = False
+        request_sid = self._get_session_id(pool_id, request_context)
+
+        # Flag if this is a pool that tries to choose a tracking number to match
+        # the user's area code. Need to use special logic even if a target
+        # area code is not specified.
+        area_code_pool = await self.is_area_code_pool(pool_id)
+
+        dbg(f"{request_sid}: pool_id: {pool_id}, target number {target_number}")
+
+        if self.lock_scope == NumberPoolLockScopes.NUMBER:
+            number = await self._renew_session_number(
+                pool_id, request_context, target_number
+            )
+            if number:
+                dbg(
+                    f"{request_sid}: took {time.time() - start:0.3f}s, number: {number}"
+                )
+                return number
+
+        try:
+            async with self._get_pool_lock(pool_id):
+                # HACK: ensure we are targeting the session number for renewal if one
+                # exists. Roughly tries to enforce a single number per session.
+                sid_number = await self._get_session_number(pool_id, request_context)
+                if sid_number:
+                    if target_number and sid_number != target_number:
+                        self._warn_session_number_mismatch(
+                            pool_id, request_context, sid_number, target_number
+                        )
+                        sid_number_mismatch = True
+                    from_sid = True
+                    renew = True
+                    target_number = sid_number
+
+                if target_number:
+                    status, ctx = await self.get_number_status(
+                        target_number, with_age=True
+                    )
+                    if sid_number_mismatch:
+                        # Additional logging to debug this case
+                        warn(f"{request_sid}: target number {target_number} ctx: {ctx}")
+
+                    if status == NumberStatus.FREE:
+                        dbg(f"{request_sid}: target number {target_number} free")
+                        number = await self._lease_free_number(
+                            pool_id, target_number, request_context
+                        )
+                    elif status == NumberStatus.EXPIRED:
+                        dbg(f"{request_sid}: target number {target_number} expired")
+                        number = await self._lease_expired_number(
+                            pool_id, target_number, request_context
+                        )
+                    elif status == NumberStatus.TAKEN and renew:
+                        dbg(
+                            f"{request_sid}: target number {target_number} taken, "
+                            "renewal requested"
+                        )
+                        if request_context:
+                            self._merge_request_context(ctx, request_context)
+                        try:
+                            async with self._get_number_scope_lock(
+                                pool_id, target_number
+                            ):
+                                res = await self._renew_number(
+                                    pool_id,
+                                    target_number,
+                                    context=ctx,
+                                    from_sid=from_sid,
+                                )
+                            if res:
+                                number = target_number
+                        except NumberSessionKeyMismatch:
+                            # Let it go on to leasing a random number instead,
+                            # see NumberPoolAPI._lease_number_with_lock
+                            key_mismatch = True
+
+                if (not number) and (
+                    (not from_sid) or (key_mismatch and not sid_number_mismatch)
+                ):
+                    if area_code_pool:
+                        number = await self._lease_area_code_number(
+                            pool_id, request_context, target_area_codes
+                        )
+                    else:
+                        number = await self._lease_random_number(
+                            pool_id, request_context
+                        )
+        except LockError:
+            raise NumberPoolUnavailable(f"Could not acquire pool {pool_id} lock")
+
+        return self._check_leased_number(number, from_sid, start, locals())
+
+    async def _renew_session_number(self, pool_id, request_context, target_number):
+        """See NumberPoolAPI._renew_session_number"""
+        sid_number = await self._get_session_number(pool_id, request_context)
+        if (not sid_number) or (target_number and target_number != sid_number):
+            return None
+        try:
+            async with self._get_number_lock(pool_id, sid_number):
+                status, ctx = await self.get_number_status(sid_number)
+                if status != NumberStatus.TAKEN:
+                    return None
+                if request_context:
+                    self._merge_request_context(ctx, request_context)
+                try:
+                    await self._renew_number(
+                        pool_id, sid_number, context=ctx, from_sid=True
+                    )
+                except NumberSessionKeyMismatch:
+                    return None
+                return sid_number
+        except LockError:
+            raise NumberPoolUnavailable(
+                f"Could not acquire number {pool_id}/{sid_number} lock"
+            )
+
+    async def _lease_number_with_script(
+        self,
+        pool_id,
+        request_context,
+        target_number=None,
+        target_area_codes=None,
+        renew=False,
+    ):
+        request_context = request_context or {}
+        start = time.time()
+        number = None
+        from_sid = False
+        request_sid = self._get_session_id(pool_id, request_context)
+
+        area_codes = []
+        if await self.is_area_code_pool(pool_id):
+            area_codes = self._get_lease_area_codes(
+                pool_id, await self.get_pool_properties(pool_id), target_area_codes
+            )
+
+        dbg(f"{request_sid}: pool_id: {pool_id}, target number {target_number}")
+
+        for _ in range(LEASE_SCRIPT_MAX_TRIES):
+            res = await self._run_lease_script(
+                pool_id, request_context, target_number, renew, area_codes
+            )
+            self._check_lease_script_result(
+                pool_id, request_context, target_number, res
+            )
+            status, number, detail, from_sid, _ = res
+            from_sid = bool(from_sid)
+
+            if status == LeaseScriptStatus.RENEW:
+                if await self._commit_script_renewal(
+                    pool_id, number, detail, request_context, from_sid=from_sid
+                ):
+                    break
+                warn(
+                    f"{request_sid}: number {pool_id}/{number} changed, retrying lease"
+                )
+                number = None
+                continue
+
+            if status != LeaseScriptStatus.LEASED:
+                number = None
+            break
+        else:
+            raise self._get_lease_tries_error(pool_id)
+
+        return self._check_leased_number(number, from_sid, start, locals())
+
+    async def update_number(self, pool_id, number, request_context, merge=False):
+        start = time.time()
+        request_sid = self._get_session_id(pool_id, request_context)
+
+        dbg(
+            f"{request_sid}: pool_id: {pool_id}, number {number}, "
+            f"request_context: {request_context}, merge: {merge}"
+        )
+
+        try:
+            async with self._get_context_lock(pool_id, number):
+                ctx, stored_fields = await self._read_number_context(number)
+                if not ctx:
+                    warn(
+                        f"{request_sid}: number {number} has no context, can not update"
+                    )
+                    return {}
+
+                if not self._get_updated_context(
+                    pool_id,
+                    number,
+                    ctx,
+                    request_context,
+                    merge=merge,
+                    pool_props=await self.get_pool_properties(pool_id),
+                ):
+                    return ctx
+
+                await self.set_number_context(number, ctx, stored_fields=stored_fields)
+        except LockError:
+            raise NumberPoolUnavailable(f"Could not acquire pool {pool_id} lock")
+
+        dbg(f"{request_sid}: took {time.time() - start:0.3f}s, number: {number}")
+        return ctx
+
+    async def _get_session_number(self, pool_id, request_context):
+        """Look up the session's number in every shard, home shard first"""
+        pipeline = self.conn.pipeline(transaction=False)
+        if not self._queue_session_number_reads(
+            pipeline, pool_id, await self.get_pool_properties(pool_id), request_context
+        ):
+            return None
+        return next(filter(None, await pipeline.execute()), None)
+
+    async def _number_context_expired(self, context):
+        expiration = await self.get_cache_expiration(context["pool_id"])
+        if self._number_context_age(context) >= expiration:
+            return True
+        return False
+
+    async def _update_free_numbers(self, pool_id, op, numbers=None, shard=None):
+        """Update the free set and its area code index of a shard atomically"""
+        keys, args = self._get_free_numbers_params(
+            pool_id, op, numbers=numbers, shard=shard
+        )
+        return await self._free_numbers_script(keys=keys, args=args)
+
+    async def _pop_random_number(self, pool_id, shard=None):
+        """See NumberPoolAPI._pop_random_number"""
+        free_key = self._get_free_pool_name(pool_id, shard=shard)
+        while True:
+            number = await self.conn.srandmember(free_key)
+            if not number:
+                return None
+            if await self._update_free_numbers(
+                pool_id, FreeNumbersScriptOps.REMOVE, [number], shard=shard
+            ):
+                return number
+
+    async def _pop_free_number(self, pool_id, number):
+        return await self._update_free_numbers(
+            pool_id,
+            FreeNumbersScriptOps.REMOVE,
+            [number],
+            shard=await self._get_number_shard(pool_id, number),
+        )
+
+    async def _write_taken_number(
+        self, pool_id, number, context, sid=None, update=False, stored_fields=None
+    ):
+        shard = await self._get_number_shard(pool_id, number)
+        shard_count = await self._get_number_shard_count(pool_id)
+        pipeline = self.conn.pipeline()
+        self._queue_taken_number(
+            pipeline,
+            pool_id,
+            number,
+            context,
+            sid=sid,
+            update=update,
+            stored_fields=stored_fields,
+            shard=shard,
+            shard_count=shard_count,
+        )
+        return (await pipeline.execute())[0]
+
+    async def _get_least_recently_renewed(self, pool_id):
+        """Get the member with the earliest timestamp across all shards"""
+        pipeline = self.conn.pipeline(transaction=False)
+        self._queue_least_recently_renewed(
+            pipeline, pool_id, await self.get_shard_count(pool_id)
+        )
+        return self._parse_least_recently_renewed(await pipeline.execute())
+
+    # NOTE Everything below is expected to be called with a pool lock held!
+
+    async def _take_number(self, pool_id, number, request_context, update=False):
+        context = self._create_number_context(
+            pool_id, request_context, pool_props=await self.get_pool_properties(pool_id)
+        )
+        sid = self._get_session_id(pool_id, request_context)
+        res = await self._write_taken_number(
+            pool_id, number, context, sid=sid, update=update
+        )
+        raiseifnot(res, f"Failed to take number: {pool_id}/{number}")
+        return res
+
+    async def _renew_number(self, pool_id, number, context=None, from_sid=False):
+        """Expected to be called with a number that is 'taken'"""
+        dbg(f"Renewing number {pool_id}/{number}")
+
+        curr_context, stored_fields = await self._read_number_context(number)
+        raiseif(curr_context is None, "Trying to renew inactive number")
+        if not context:
+            warn(f"No context provided, using number {number} context")
+            context = curr_context
+
+        context = self._get_renewed_context(
+            pool_id,
+            number,
+            context,
+            curr_context,
+            pool_props=await self.get_pool_properties(pool_id),
+        )
+        sid = self._get_session_id(pool_id, context["request_context"])
+        # Ensure this SID is associated with this number
+        res = await self._write_taken_number(
+            pool_id,
+            number,
+            context,
+            sid=None if from_sid else sid,
+            update=True,
+            stored_fields=stored_fields,
+        )
+        raiseifnot(res, f"Failed to renew number: {pool_id}/{number}")
+        return res
+
+    async def _confirm_recent_renewal(self, pool_id, request_context, target_number):
+        """See NumberPoolAPI._confirm_recent_renewal"""
+        request_context = request_context or {}
+        if not self._get_session_id(pool_id, request_context):
+            return None
+        throttle = await self.get_renewal_throttle(pool_id)
+        if not throttle:
+            return None
+        interval = throttle * (await self.get_cache_expiration(pool_id))
+        pool_props = await self.get_pool_properties(pool_id)
+        session_number = None
+        if not target_number and self._confirm_needs_session_number(
+            self._get_shard_count_from_properties(pool_id, pool_props)
+        ):
+            session_number = await self._get_session_number(pool_id, request_context)
+            if not session_number:
+                return None
+        keys, args = self._get_confirm_renewal_params(
+            pool_id,
+            request_context,
+            target_number,
+            interval,
+            pool_props=pool_props,
+            session_number=session_number,
+        )
+        number = await self._confirm_renewal_script(keys=keys, args=args)
+        if number:
+            dbg(f"Confirmed recent renewal of {pool_id}/{number}")
+        return number or None
+
+    async def _run_lease_script(
+        self, pool_id, request_context, target_number, renew, area_codes
+    ):
+        """See NumberPoolAPI._run_lease_script"""
+        pool_props = await self.get_pool_properties(pool_id)
+        expiration = await self.get_cache_expiration(pool_id)
+        first_number = target_number
+        if (await self.get_shard_count(pool_id)) > 1 and not target_number:
+            first_number = await self._get_session_number(pool_id, request_context)
+        shards = self._get_lease_shards(
+            pool_id, pool_props, request_context, first_number
+        )
+        for pass_area_codes, allow_expired in self._get_lease_passes(
+            shards, area_codes
+        ):
+            pass_shards = shards
+            if allow_expired and len(shards) > 1:
+                pipeline = self.conn.pipeline(transaction=False)
+                self._queue_oldest_taken(pipeline, pool_id, shards, pass_area_codes)
+                pass_shards = self._get_expired_shards(
+                    shards,
+                    pass_area_codes,
+                    await pipeline.execute(),
+                    time.time() - expiration,
+                )
+            for shard in pass_shards:
+                declared_numbers = self._get_declared_lease_numbers(
+                    pool_id, shard, target_number
+                )
+                for _ in range(LEASE_SCRIPT_MAX_DECLARES):
+                    keys, args = self._get_lease_script_params(
+                        pool_id,
+                        request_context,
+                        target_number,
+                        renew,
+                        pass_area_codes,
+                        expiration,
+                        pool_props=pool_props,
+                        shard=shard,
+                        allow_expired=allow_expired,
+                        declared_numbers=declared_numbers,
+                    )
+                    res = await self._lease_number_script(keys=keys, args=args)
+                    if not self._declare_lease_number(res, declared_numbers):
+                        break
+                else:
+                    raise self._get_lease_tries_error(pool_id)
+                res = self._cache_lease_candidates(pool_id, shard, res)
+                target_number = None
+                status, from_sid = res[0], res[3]
+                if status != LeaseScriptStatus.EMPTY or from_sid:
+                    return res
+        return res
+
+    async def _commit_script_renewal(
+        self, pool_id, number, raw_context, request_context, from_sid=False
+    ):
+        """Write back a renewal of a number context read by the lease script if
+        the number has not changed in the meantime. Returns False if the renewal
+        lost a race and should be retried."""
+        dbg(f"Renewing number {pool_id}/{number}")
+        updates = None
+        if await self.get_renewal_throttle(pool_id):
+            updates = await self.conn.lrange(
+                self._get_context_updates_key(
+                    number,
+                    pool_id=pool_id,
+                    shard_count=await self._get_number_shard_count(pool_id),
+                ),
+                0,
+                -1,
+            )
+        keys, args = self._get_script_renewal_params(
+            pool_id,
+            number,
+            raw_context,
+            request_context,
+            from_sid=from_sid,
+            pool_props=await self.get_pool_properties(pool_id),
+            updates=updates,
+        )
+        return bool(await self._renew_number_script(keys=keys, args=args))
+
+    async def _lease_random_number(self, pool_id, request_context):
+        number = None
+        for shard in self._get_lease_shards(
+            pool_id, await self.get_pool_properties(pool_id), request_context, None
+        ):
+            number = await self._pop_random_number(pool_id, shard=shard)
+            if number:
+                break
+        if not number:
+            dbg("No free numbers found, checking expired...")
+            res = await self._get_least_recently_renewed(pool_id)
+            raiseifnot(res, "No least recently renewed number?")
+            target_number, _ = res
+            status, _ = await self.get_number_status(target_number)
+            if status == NumberStatus.EXPIRED:
+                return await self._lease_expired_number(
+                    pool_id, target_number, request_context
+                )
+            else:
+                return None
+
+        info(f"Leasing random number {pool_id}/{number}")
+        await self._take_number(pool_id, number, request_context)
+        return number
+
+    async def _lease_area_code_number(self, pool_id, request_context, area_codes):
+        pool_props = await self.get_pool_properties(pool_id)
+        fallback_area_code, area_codes = self._get_area_code_search(
+            pool_id, pool_props, area_codes
+        )
+
+        shards = self._get_lease_shards(pool_id, pool_props, request_context, None)
+        for area_code in area_codes:
+            dbg(f"Searching for number with area code {area_code} in {pool_id}")
+
+            for shard in shards:
+                number = await self.conn.srandmember(
+                    self._get_free_area_code_pool_name(pool_id, area_code, shard=shard)
+                )
+                if number:
+                    leased_number = await self._lease_free_number(
+                        pool_id, number, request_context
+                    )
+                    if leased_number:
+                        return leased_number
+
+            dbg(f"No free number found for area code {area_code}, checking expired...")
+
+            max_expired_tries = 3
+            cutoff = time.time() - await self.get_cache_expiration(pool_id)
+            pipeline = self.conn.pipeline(transaction=False)
+            self._queue_expired_area_code_candidates(
+                pipeline, pool_id, area_code, shards, cutoff, max_expired_tries
+            )
+            for number in self._parse_expired_area_code_candidates(
+                await pipeline.execute(), max_expired_tries
+            ):
+                status, _ = await self.get_number_status(number)
+                if status != NumberStatus.EXPIRED:
+                    dbg(
+                        f"Least recently renewed taken number {number} for "
+                        f"{area_code} is not expired. Stopping search!"
+                    )
+                    break
+
+                dbg(f"Found expired number {number} matching area code {area_code}")
+                leased_number = await self._lease_expired_number(
+                    pool_id, number, request_context
+                )
+                if leased_number:
+                    return leased_number
+
+                # This really shouldn't happen, but let it try a few times if needed
+                max_expired_tries -= 1
+                if max_expired_tries <= 0:
+                    warn(
+                        "Max tries checking expired numbers for area code "
+                        f"{area_code} in {pool_id}"
+                    )
+                    break
+
+            dbg(f"No free or expired number found for area code {area_code}")
+
+        # If we didn't find a number, try the fallback area code
+        if fallback_area_code not in area_codes:
+            warn(
+                f"Trying fallback area code {fallback_area_code}. "
+                f"Target was {area_codes}"
+            )
+            leased_number = await self._lease_area_code_number(
+                pool_id, request_context, [fallback_area_code]
+            )
+            if leased_number:
+                return leased_number
+
+        warn(f"No free number found with area code {area_code} in {pool_id}")
+        return None
+
+    async def _lease_free_number(self, pool_id, number, request_context):
+        info(f"Leasing free number: {pool_id}/{number}")
+        res = await self._pop_free_number(pool_id, number)
+        if not res:
+            raise NumberNotFound(f"could not find free number {pool_id}/{number}")
+        await self._take_number(pool_id, number, request_context)
+        return number
+
+    async def _lease_expired_number(self, pool_id, number, request_context):
+        """This will just take over an already-taken-but-expired number"""
+        info(f"Leasing expired number: {pool_id}/{number}")
+        async with self._get_number_scope_lock(pool_id, number):
+            if await self._pop_free_number(pool_id, number):
+                # Already returned to the free set by the expiry reaper
+                await self._take_number(pool_id, number, request_context)
+            else:
+                await self._take_number(pool_id, number, request_context, update=True)
+        return number
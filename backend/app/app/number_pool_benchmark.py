@@ -0,0 +1,107 @@
+"""Count Redis round trips and time per number pool operation.
+
+Leases, renews and resets a real pool, so only run it against a development
+Redis instance:
+
+    python -m app.number_pool_benchmark --pool-id 1 --iterations 100
+
+Round trips are counted at the connection level, so a pipeline or MULTI/EXEC
+counts once no matter how many commands it carries.
+"""
+
+import argparse
+from contextlib import contextmanager
+import time
+
+from redis.connection import Connection
+from tlbx import info
+
+from app.number_pool import NumberPoolAPI, NumberPoolLeaseModes, POOL_SESSION_KEY
+
+
+class RoundTripCounter:
+    def __init__(self):
+        self.count = 0
+
+    @contextmanager
+    def counting(self):
+        orig = Connection.send_packed_command
+        counter = self
+
+        def send_packed_command(self, *args, **kwargs):
+            counter.count += 1
+            return orig(self, *args, **kwargs)
+
+        Connection.send_packed_command = send_packed_command
+        try:
+            yield self
+        finally:
+            Connection.send_packed_command = orig
+
+
+def benchmark_pool(pool_api, pool_id, iterations):
+    """Return round trips and average milliseconds per lease, renew and reset"""
+    results = {}
+    counter = RoundTripCounter()
+
+    def measure(name, func):
+        counter.count = 0
+        start = time.perf_counter()
+        with counter.counting():
+            func()
+        elapsed = time.perf_counter() - start
+        prev = results.get(name, dict(round_trips=0, ms=0))
+        results[name] = dict(
+            round_trips=prev["round_trips"] + counter.count,
+            ms=prev["ms"] + elapsed * 1000,
+        )
+
+    # Warm the pool properties cache and script cache
+    pool_api._reset_pool(pool_id, preserve=False)
+    pool_api.lease_number(pool_id, {})
+
+    for i in range(iterations):
+        pool_api._reset_pool(pool_id, preserve=False)
+        request_context = {POOL_SESSION_KEY: f"benchmark-{i}"}
+        number = None
+
+        def lease():
+            nonlocal number
+            number = pool_api.lease_number(pool_id, request_context)
+
+        def renew():
+            pool_api.lease_number(
+                pool_id, request_context, target_number=number, renew=True
+            )
+
+        measure("lease", lease)
+        measure("renew", renew)
+        measure("reset", lambda: pool_api._reset_pool(pool_id, preserve=False))
+
+    return {
+        name: dict(
+            round_trips=res["round_trips"] / iterations, ms=res["ms"] / iterations
+        )
+        for name, res in results.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pool-id", type=int, required=True)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument(
+        "--lease-mode",
+        choices=[NumberPoolLeaseModes.SCRIPT, NumberPoolLeaseModes.LOCK],
+        default=None,
+    )
+    args = parser.parse_args()
+
+    pool_api = NumberPoolAPI(lease_mode=args.lease_mode)
+    results = benchmark_pool(pool_api, args.pool_id, args.iterations)
+    for name, res in results.items():
+        info(f"{name}: {res['round_trips']:.1f} round trips, {res['ms']:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
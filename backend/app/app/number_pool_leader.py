@@ -0,0 +1,102 @@
+"""Periodic number pool tasks that only one worker runs at a time.
+
+A NumberPoolLeaderTask runs every interval, as an asyncio task in the app
+lifespan with run or standalone with run_forever. Any number of app workers may
+run the same task. A leader lock in Redis is held across runs and renewed each
+interval, so a worker keeps the job until it stops or dies and its lock times
+out, and the other workers skip their runs until then.
+"""
+
+import asyncio
+import time
+
+import rollbar
+from redis.exceptions import LockError
+from starlette.concurrency import run_in_threadpool
+from tlbx import info, warn, error
+
+from app.core.config import settings
+from app.number_pool import NumberPoolAPI
+
+
+class NumberPoolLeaderTask:
+    """Subclasses set name, used in log messages, and lock_name, and implement
+    run_as_leader."""
+
+    name = None
+    lock_name = None
+
+    def __init__(self, interval, pool_api=None):
+        self.pool_api = pool_api or NumberPoolAPI()
+        self.interval = interval
+        self._leader_lock = None
+
+    def _get_leader_lock(self):
+        if not self._leader_lock:
+            # Not thread-local: runs may happen on different threadpool threads
+            self._leader_lock = self.pool_api.conn.lock(
+                self.lock_name,
+                timeout=self.interval * 3,
+                thread_local=False,
+            )
+        return self._leader_lock
+
+    def acquire_leadership(self):
+        lock = self._get_leader_lock()
+        try:
+            if lock.owned():
+                lock.reacquire()
+                return True
+        except LockError:
+            warn(f"Lost {self.name} leadership")
+        return lock.acquire(blocking=False)
+
+    def release_leadership(self):
+        lock = self._get_leader_lock()
+        try:
+            if lock.owned():
+                lock.release()
+        except LockError:
+            pass
+
+    def run_as_leader(self):
+        raise NotImplementedError
+
+    def run_once(self):
+        """Run the task if this worker is the leader. Returns the result of
+        run_as_leader, or None if not the leader."""
+        if not self.acquire_leadership():
+            return None
+        return self.run_as_leader()
+
+    async def run(self):
+        info(f"Starting {self.name}, interval {self.interval}s")
+        try:
+            while True:
+                try:
+                    await run_in_threadpool(self.run_once)
+                except Exception as e:
+                    error(f"{self.name.capitalize()} failed: {e}")
+                    rollbar.report_exc_info()
+                await asyncio.sleep(self.interval)
+        finally:
+            self.release_leadership()
+
+    def run_forever(self):
+        info(f"Starting {self.name}, interval {self.interval}s")
+        try:
+            while True:
+                try:
+                    self.run_once()
+                except Exception as e:
+                    error(f"{self.name.capitalize()} failed: {e}")
+                    rollbar.report_exc_info()
+                time.sleep(self.interval)
+        finally:
+            self.release_leadership()
+
+    @classmethod
+    def main(cls):
+        if settings.ROLLBAR_ENABLED:
+            rollbar.init(settings.ROLLBAR_KEY, environment=settings.ROLLBAR_ENV)
+        cls().run_forever()
@@ -0,0 +1,93 @@
+"""Move the number pool keyspace to another key layout.
+
+See NumberPoolKeyLayouts. Each pool is moved under its pool lock, but "script"
+mode leases don't take the pool lock, so stop serving number pool requests
+while the keyspace is migrated, then deploy with the new
+NUMBER_POOL_KEY_LAYOUT:
+
+    python -m app.number_pool_migrate --to v2 --dry-run
+    python -m app.number_pool_migrate --to v2
+
+The v2 layout tags keys with the pool and the shard of the number, using each
+pool's shard count, so only pools with more than one shard are spread across
+cluster slots.
+
+Only the number contexts, context updates, attribution snapshots and free/taken
+structures of active pools change names, and the number -> pool ID hash the v2
+layout looks contexts up with is written or dropped. Route, user, static, lease
+caller and pool property keys are left as they are, since they are untagged and
+only used with single-key commands in either layout.
+"""
+
+import argparse
+
+from tlbx import info, pp
+
+from app.number_pool import (
+    NUMBER_POOL_IDS_KEY,
+    NUMBER_POOL_KEY_LAYOUT_KEY,
+    NumberPoolAPI,
+    NumberPoolKeyLayouts,
+)
+
+# Pool lock hold timeout while a pool is moved
+MIGRATE_LOCK_TIMEOUT = 60
+
+
+def get_keyspace_layout(pool_api):
+    return pool_api.conn.get(NUMBER_POOL_KEY_LAYOUT_KEY) or NumberPoolKeyLayouts.V1
+
+
+def migrate_key_layout(key_layout, dry_run=False):
+    """Move every active pool to key_layout and mark the keyspace as being in
+    it. Returns the count of numbers moved per pool ID."""
+    pool_api = NumberPoolAPI(key_layout=key_layout)
+    curr_layout = get_keyspace_layout(pool_api)
+    if curr_layout == key_layout:
+        info(f"Keyspace is already in the {key_layout} key layout")
+        return {}
+    source = NumberPoolAPI(key_layout=curr_layout)
+
+    counts = {}
+    for pool in pool_api.get_pools_from_db():
+        pool_id = pool["id"]
+        curr_shard_count = int(
+            pool_api.conn.get(pool_api._get_pool_shards_key(pool_id)) or 1
+        )
+        if dry_run:
+            pipeline = pool_api.conn.pipeline(transaction=False)
+            source._queue_pool_numbers(pipeline, pool_id, curr_shard_count)
+            counts[pool_id] = len(set().union(*pipeline.execute()))
+            continue
+        with pool_api._get_pool_lock(pool_id, timeout=MIGRATE_LOCK_TIMEOUT):
+            numbers = pool_api._reshard_pool(
+                pool_id,
+                curr_shard_count,
+                pool_api.get_shard_count(pool_id),
+                source=source,
+            )
+            pool_api._rebuild_area_code_indexes(pool_id)
+        counts[pool_id] = len(numbers)
+        info(f"Moved {len(numbers)} numbers of pool {pool_id} to {key_layout}")
+
+    if not dry_run:
+        if key_layout != NumberPoolKeyLayouts.V2:
+            pool_api.conn.delete(NUMBER_POOL_IDS_KEY)
+        pool_api.conn.set(NUMBER_POOL_KEY_LAYOUT_KEY, key_layout)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--to",
+        choices=[NumberPoolKeyLayouts.V1, NumberPoolKeyLayouts.V2],
+        required=True,
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    pp(migrate_key_layout(args.to, dry_run=args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
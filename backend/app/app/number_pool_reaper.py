@@ -0,0 +1,68 @@
+"""Background reaper that returns expired numbers to their pool's free set.
+
+Without it expired numbers stay in the taken set until a lease happens to
+check the least recently renewed number, so the free set looks empty and pool
+stats under-report capacity. With it most leases are a plain pop from the free
+set.
+
+The reaper runs as an asyncio task in the app lifespan when
+NUMBER_POOL_REAPER_ENABLED is set, or standalone with:
+
+    python -m app.number_pool_reaper
+
+Any number of app workers may run it. A leader lock in Redis ensures only one
+of them sweeps the pools at a time.
+"""
+
+import time
+
+import rollbar
+from tlbx import info, error
+
+from app.core.config import settings
+from app.number_pool import NUMBER_POOL_REAPER_BATCH_SIZE
+from app.number_pool_leader import NumberPoolLeaderTask
+
+
+NUMBER_POOL_REAPER_LOCK_NAME = "Pool Reaper"
+
+
+class NumberPoolReaper(NumberPoolLeaderTask):
+    """Periodically sweep each pool's taken set for expired numbers"""
+
+    name = "number pool reaper"
+    lock_name = NUMBER_POOL_REAPER_LOCK_NAME
+
+    def __init__(
+        self,
+        pool_api=None,
+        interval=None,
+        batch_size=NUMBER_POOL_REAPER_BATCH_SIZE,
+    ):
+        super().__init__(
+            interval or settings.NUMBER_POOL_REAPER_INTERVAL, pool_api=pool_api
+        )
+        self.batch_size = batch_size
+
+    def run_as_leader(self):
+        """Reap expired numbers from all pools. Returns a dict of reaped counts
+        by pool ID."""
+        start = time.time()
+        counts = {}
+        for pool in self.pool_api.get_pools_from_db():
+            pool_id = pool["id"]
+            try:
+                counts[pool_id] = self.pool_api.reap_expired_numbers(
+                    pool_id, batch_size=self.batch_size
+                )
+            except Exception as e:
+                error(f"Failed to reap expired numbers from pool {pool_id}: {e}")
+                rollbar.report_exc_info()
+        reaped = sum(counts.values())
+        if reaped:
+            info(f"Reaped {reaped} expired numbers in {time.time() - start:.3f}s")
+        return counts
+
+
+if __name__ == "__main__":
+    NumberPoolReaper.main()
@@ -0,0 +1,720 @@
+"""Lua scripts used by NumberPoolAPI to lease and renew numbers atomically
+in a single round trip. The scripts mirror the lock-based path in
+NumberPoolAPI.lease_number and operate on the same data structures, so the
+two modes can be switched without migrating any data.
+
+Every free number is also indexed in a per-area-code free set, with a hash of
+per-area-code counts alongside it, and every taken number in a per-area-code
+taken sorted set scored by renewed_at. The scripts keep those indexes in sync
+with the free and taken structures.
+
+Number contexts are stored either as a JSON string or as a hash with pool_id,
+leased_at, renewed_at and request_context fields (see NumberContextFormats).
+The scripts read both and write whichever format the caller asks for.
+
+Renewals confirmed by CONFIRM_RENEWAL_SCRIPT append their request context to a
+per-number list of context updates instead of rewriting the context. The list
+is folded into the context the next time it is read and written, and deleted
+whenever the context is written.
+
+Sharded pools run the scripts once per shard, with the keys of that shard.
+
+Each number also has an attribution snapshot hash with its pool_id,
+leased_at, renewed_at and the sid, ip, user_agent and zip of its request
+context, so calls can be attributed without decoding the whole context. The
+scripts write it with the context from fields computed by the caller, and
+confirmed renewals update the request fields they carry.
+
+In the v2 key layout (see NumberPoolKeyLayouts) every key a script touches is
+passed in KEYS, so the scripts can run on Redis Cluster, where all keys of a
+pool shard share a hash tag. The keys of area codes and numbers are declared by
+the caller, with the area codes and numbers they belong to listed in ARGV. A
+script that finds it needs the keys of a number it was not given, such as a
+random free number, returns it so the caller can run it again with the number
+declared. The v1 layout can't run on Redis Cluster anyway, so there the lease
+and confirm scripts derive area code and number keys from key prefixes in ARGV
+instead and never need another run.
+"""
+
+# Shared helpers to look up the keys declared for area codes and numbers.
+# declare_keys maps each name in a JSON list to the key_count keys declared for
+# it, in order from KEYS[first_key]. It returns one map per key position and
+# the index of the next key. derive_keys makes a map derive the keys of names
+# not declared from a key prefix instead, for the v1 layout.
+_DECLARED_KEYS_FUNCTIONS = """
+local function declare_keys(names_json, first_key, key_count)
+    local maps = {}
+    for j = 1, key_count do
+        maps[j] = {}
+    end
+    local names = cjson.decode(names_json)
+    for i, name in ipairs(names) do
+        for j = 1, key_count do
+            maps[j][name] = KEYS[first_key + (i - 1) * key_count + j - 1]
+        end
+    end
+    return maps, first_key + #names * key_count
+end
+
+local function derive_keys(keys, prefix)
+    return setmetatable(keys, {
+        __index = function(_, name)
+            return prefix .. name
+        end,
+    })
+end
+
+local function declared_key(keys, name)
+    local key = keys[name]
+    if not key then
+        error("undeclared key for " .. name)
+    end
+    return key
+end
+"""
+
+# Shared helpers for the per-area-code free index. Scripts that include them
+# must define area_code_keys (per-area-code free sets by area code) and
+# area_code_counts_key first.
+_FREE_AREA_CODE_INDEX_FUNCTIONS = """
+local function index_free_number(number)
+    local area_code = string.sub(number, 1, 3)
+    if redis.call("SADD", declared_key(area_code_keys, area_code), number) == 1 then
+        redis.call("HINCRBY", area_code_counts_key, area_code, 1)
+    end
+end
+
+local function unindex_free_number(number)
+    local area_code = string.sub(number, 1, 3)
+    if redis.call("SREM", declared_key(area_code_keys, area_code), number) == 1 then
+        if redis.call("HINCRBY", area_code_counts_key, area_code, -1) <= 0 then
+            redis.call("HDEL", area_code_counts_key, area_code)
+        end
+    end
+end
+"""
+
+# KEYS[1] free set, KEYS[2] per-area-code free counts hash, KEYS[3...]
+# per-area-code free set of each declared area code
+#
+# ARGV[1] operation: add, remove or rebuild
+# ARGV[2] JSON list of the declared area codes, which must cover those of the
+# numbers added, removed or in the free set
+# ARGV[3...] numbers (add/remove only)
+#
+# Returns the number of numbers added/removed, or the size of the free set
+# after a rebuild of the area code index. A rebuild clears the free sets of
+# the declared area codes, and leaves those of any others as they are.
+FREE_NUMBERS_SCRIPT = (
+    """
+local free_key = KEYS[1]
+local area_code_counts_key = KEYS[2]
+local op = ARGV[1]
+"""
+    + _DECLARED_KEYS_FUNCTIONS
+    + """
+local area_code_keys = declare_keys(ARGV[2], 3, 1)[1]
+"""
+    + _FREE_AREA_CODE_INDEX_FUNCTIONS
+    + """
+-- Check the area codes of numbers[first...] are declared before any writes
+local function check_declared(numbers, first)
+    for i = first, #numbers do
+        declared_key(area_code_keys, string.sub(numbers[i], 1, 3))
+    end
+end
+
+if op == "add" then
+    check_declared(ARGV, 3)
+    local count = 0
+    for i = 3, #ARGV do
+        count = count + redis.call("SADD", free_key, ARGV[i])
+        index_free_number(ARGV[i])
+    end
+    return count
+elseif op == "remove" then
+    check_declared(ARGV, 3)
+    local count = 0
+    for i = 3, #ARGV do
+        count = count + redis.call("SREM", free_key, ARGV[i])
+        unindex_free_number(ARGV[i])
+    end
+    return count
+elseif op == "rebuild" then
+    local numbers = redis.call("SMEMBERS", free_key)
+    check_declared(numbers, 1)
+    for _, key in pairs(area_code_keys) do
+        redis.call("DEL", key)
+    end
+    redis.call("DEL", area_code_counts_key)
+    for _, number in ipairs(numbers) do
+        index_free_number(number)
+    end
+    return #numbers
+end
+return redis.error_reply("unknown free numbers operation: " .. op)
+"""
+)
+
+# Shared helpers to read a number context in either storage format.
+# read_context returns the decoded context and a raw string that identifies
+# its current value: the JSON itself, or for hashes a JSON array of "hash"
+# followed by the field values in NUMBER_CONTEXT_HASH_FIELDS order.
+_NUMBER_CONTEXT_FUNCTIONS = """
+local function read_context(key)
+    local key_type = redis.call("TYPE", key)["ok"]
+    if key_type == "string" then
+        local raw = redis.call("GET", key)
+        return cjson.decode(raw), raw
+    elseif key_type == "hash" then
+        local fields = redis.call(
+            "HMGET", key, "pool_id", "leased_at", "renewed_at", "request_context"
+        )
+        local ctx = {
+            pool_id = tonumber(fields[1]),
+            leased_at = tonumber(fields[2]),
+            renewed_at = tonumber(fields[3]),
+        }
+        if fields[4] then
+            ctx["request_context"] = cjson.decode(fields[4])
+        end
+        local raw = cjson.encode({"hash", fields[1], fields[2], fields[3], fields[4]})
+        return ctx, raw
+    end
+    return nil, nil
+end
+
+-- Requires session_key to be defined
+local function context_sid(ctx)
+    local request_context = ctx["request_context"]
+    if type(request_context) ~= "table" then
+        return ""
+    end
+    local value = request_context[session_key]
+    if type(value) == "string" then
+        return value
+    elseif type(value) == "number" then
+        return tostring(value)
+    end
+    return ""
+end
+
+local function read_renewed_at(key)
+    local key_type = redis.call("TYPE", key)["ok"]
+    if key_type == "hash" then
+        return tonumber(redis.call("HGET", key, "renewed_at"))
+    elseif key_type == "string" then
+        return tonumber(cjson.decode(redis.call("GET", key))["renewed_at"])
+    end
+    return nil
+end
+"""
+
+# KEYS[1] free set, KEYS[2] taken sorted set, KEYS[3] session -> number hash,
+# KEYS[4] per-area-code free counts hash, KEYS[5...] per-area-code free and
+# taken sets of each declared area code, then the context, context updates
+# and attribution snapshot keys of each declared number
+#
+# ARGV[1] session ID ("" if none)
+# ARGV[2] target number ("" if none), which must be declared
+# ARGV[3] renew flag (1/0)
+# ARGV[4] current time, used as the taken score for new leases
+# ARGV[5] pool cache expiration in seconds
+# ARGV[6] max renewal age in seconds
+# ARGV[7] request context session key name
+# ARGV[8] flag (1/0) for whether the request context carries a session key
+# ARGV[9] JSON context to store for a new lease, or just its request_context
+# field in the hash format
+# ARGV[10] context storage format ("json" or "hash")
+# ARGV[11] pool ID, stored as a field in the hash format
+# ARGV[12] flag (1/0) for whether expired numbers may be taken when no free
+# number is found, so sharded pools can try the free numbers of every shard
+# first. Targeted expired numbers are always taken.
+# ARGV[13] JSON list of attribution snapshot field/value pairs for a new lease
+# ARGV[14] JSON list of the declared area codes. Must cover the area codes to
+# try and those of the declared numbers.
+# ARGV[15] JSON list of the declared numbers
+# ARGV[16] max free numbers to return as candidates for the next lease
+# ARGV[17] JSON object of the free_area_code, taken_area_code, context,
+# context_updates and attribution key prefixes to derive the keys of area codes
+# and numbers from in the v1 layout, or "" if they are declared
+# ARGV[18...] area codes to try in order (area code pools only)
+#
+# Returns {status, number, detail, from_sid, sid_number_mismatch}, where
+# detail is how the number was leased for "leased", or the current raw
+# context for "renew" so the caller can merge it and commit the renewal
+# with RENEW_NUMBER_SCRIPT. Declared numbers are preferred when picking a free
+# or expired number, and leases of a free number also return random free
+# numbers of the same set for the caller to declare to its next lease. Before
+# any lease is written, the script returns "undeclared" with a number it needs
+# but was not given, the session's number or one it picked, for the caller to
+# declare on its next run, which never happens when keys are derived.
+LEASE_NUMBER_SCRIPT = (
+    """
+local free_key = KEYS[1]
+local taken_key = KEYS[2]
+local sid_hash_key = KEYS[3]
+local area_code_counts_key = KEYS[4]
+
+local sid = ARGV[1]
+local target = ARGV[2]
+local renew = ARGV[3] == "1"
+local now = tonumber(ARGV[4])
+local expiration = tonumber(ARGV[5])
+local max_renewal_age = tonumber(ARGV[6])
+local session_key = ARGV[7]
+local check_sid = ARGV[8] == "1"
+local new_context = ARGV[9]
+local context_format = ARGV[10]
+local pool_id = ARGV[11]
+local allow_expired = ARGV[12] == "1"
+local attribution_fields = cjson.decode(ARGV[13])
+local candidate_count = tonumber(ARGV[16])
+local area_codes = {}
+for i = 18, #ARGV do
+    area_codes[#area_codes + 1] = ARGV[i]
+end
+"""
+    + _DECLARED_KEYS_FUNCTIONS
+    + """
+local area_code_maps, next_key = declare_keys(ARGV[14], 5, 2)
+local area_code_keys, taken_area_code_keys = area_code_maps[1], area_code_maps[2]
+local number_maps = declare_keys(ARGV[15], next_key, 3)
+local context_keys = number_maps[1]
+local context_updates_keys = number_maps[2]
+local attribution_keys = number_maps[3]
+if ARGV[17] ~= "" then
+    local prefixes = cjson.decode(ARGV[17])
+    derive_keys(area_code_keys, prefixes["free_area_code"])
+    derive_keys(taken_area_code_keys, prefixes["taken_area_code"])
+    derive_keys(context_keys, prefixes["context"])
+    derive_keys(context_updates_keys, prefixes["context_updates"])
+    derive_keys(attribution_keys, prefixes["attribution"])
+end
+local declared_numbers = cjson.decode(ARGV[15])
+local candidates = {}
+"""
+    + _FREE_AREA_CODE_INDEX_FUNCTIONS
+    + _NUMBER_CONTEXT_FUNCTIONS
+    + """
+local function pop_free_number(number)
+    if redis.call("SREM", free_key, number) == 0 then
+        return false
+    end
+    unindex_free_number(number)
+    return true
+end
+
+local function get_status(number)
+    local ctx, raw = read_context(declared_key(context_keys, number))
+    if not ctx then
+        return "free", nil, nil
+    end
+    if math.floor(now - tonumber(ctx["renewed_at"])) >= expiration then
+        return "expired", ctx, raw
+    end
+    return "taken", ctx, raw
+end
+
+local function take(number)
+    local taken_area_code_key = declared_key(
+        taken_area_code_keys, string.sub(number, 1, 3)
+    )
+    local context_key = declared_key(context_keys, number)
+    redis.call("ZADD", taken_key, now, number)
+    redis.call("ZADD", taken_area_code_key, now, number)
+    if context_format == "hash" then
+        redis.call("DEL", context_key)
+        redis.call(
+            "HSET", context_key, "pool_id", pool_id, "leased_at", ARGV[4],
+            "renewed_at", ARGV[4], "request_context", new_context
+        )
+    else
+        redis.call("SET", context_key, new_context)
+    end
+    redis.call("DEL", attribution_keys[number])
+    redis.call("HSET", attribution_keys[number], unpack(attribution_fields))
+    redis.call("DEL", context_updates_keys[number])
+    if sid ~= "" then
+        redis.call("HSET", sid_hash_key, sid, number)
+    end
+end
+
+-- The declared number an area code key holds, if any. Free area code keys
+-- are sets and taken ones sorted sets.
+local function find_declared(area_code, key, sorted)
+    for _, number in ipairs(declared_numbers) do
+        if area_code == nil or string.sub(number, 1, 3) == area_code then
+            if sorted then
+                if redis.call("ZSCORE", key, number) then
+                    return number
+                end
+            elseif redis.call("SISMEMBER", key, number) == 1 then
+                return number
+            end
+        end
+    end
+    return nil
+end
+
+-- Take the oldest taken number if it is expired. Returns the number and how
+-- it was leased, or nil and an undeclared number to declare first.
+local function take_expired(number)
+    if not context_keys[number] then
+        return nil, number
+    end
+    if get_status(number) ~= "expired" then
+        return nil
+    end
+    take(number)
+    return number, "expired"
+end
+
+local function lease_random()
+    local number = find_declared(nil, free_key, false)
+        or redis.call("SRANDMEMBER", free_key)
+    if number then
+        if not context_keys[number] then
+            return nil, number
+        end
+        pop_free_number(number)
+        take(number)
+        candidates = redis.call("SRANDMEMBER", free_key, candidate_count)
+        return number, "random"
+    end
+    if not allow_expired then
+        return nil
+    end
+    local oldest = redis.call("ZRANGE", taken_key, 0, 0)
+    if #oldest == 0 then
+        return nil
+    end
+    return take_expired(oldest[1])
+end
+
+local function lease_area_code(area_code)
+    local area_code_key = declared_key(area_code_keys, area_code)
+    while true do
+        local number = find_declared(area_code, area_code_key, false)
+            or redis.call("SRANDMEMBER", area_code_key)
+        if not number then
+            break
+        end
+        if redis.call("SISMEMBER", free_key, number) == 1 then
+            if not context_keys[number] then
+                return nil, number
+            end
+            pop_free_number(number)
+            take(number)
+            candidates = redis.call("SRANDMEMBER", area_code_key, candidate_count)
+            return number, "free"
+        end
+        -- Stale index entry for a number that is no longer free
+        redis.call("SREM", area_code_key, number)
+    end
+    if not allow_expired then
+        return nil
+    end
+
+    -- Only the least recently renewed taken number for this area code is a
+    -- candidate, and only if its score is past the expiration cutoff.
+    local taken_area_code_key = declared_key(taken_area_code_keys, area_code)
+    local cutoff = now - expiration
+    while true do
+        local numbers = redis.call(
+            "ZRANGEBYSCORE", taken_area_code_key, "-inf", cutoff, "LIMIT", 0, 1
+        )
+        if #numbers == 0 then
+            return nil
+        end
+        if redis.call("ZSCORE", taken_key, numbers[1]) then
+            return take_expired(numbers[1])
+        end
+        -- Stale index entry for a number that is no longer taken
+        redis.call("ZREM", taken_area_code_key, numbers[1])
+    end
+end
+
+local from_sid = 0
+local sid_number_mismatch = 0
+if sid ~= "" then
+    local sid_number = redis.call("HGET", sid_hash_key, sid)
+    if sid_number then
+        if target ~= "" and target ~= sid_number then
+            sid_number_mismatch = 1
+        end
+        from_sid = 1
+        renew = true
+        target = sid_number
+    end
+end
+
+local key_mismatch = false
+if target ~= "" then
+    if not context_keys[target] then
+        return {"undeclared", target, false, from_sid, sid_number_mismatch}
+    end
+    local status, ctx, raw = get_status(target)
+    if status == "free" then
+        if not pop_free_number(target) then
+            return {"not_found", target, false, from_sid, sid_number_mismatch}
+        end
+        take(target)
+        return {"leased", target, "free", from_sid, sid_number_mismatch}
+    end
+
+    if status == "expired" and pop_free_number(target) then
+        -- Already returned to the free set by the expiry reaper
+        take(target)
+        return {"leased", target, "expired", from_sid, sid_number_mismatch}
+    end
+
+    local is_taken = redis.call("ZSCORE", taken_key, target)
+    if (status == "expired" or renew) and not is_taken then
+        return {"not_found", target, false, from_sid, sid_number_mismatch}
+    end
+
+    if status == "expired" then
+        take(target)
+        return {"leased", target, "expired", from_sid, sid_number_mismatch}
+    elseif renew then
+        if (not check_sid) or sid == context_sid(ctx) then
+            if (now - tonumber(ctx["leased_at"])) > max_renewal_age then
+                return {"max_renewal", target, false, from_sid, sid_number_mismatch}
+            end
+            return {"renew", target, raw, from_sid, sid_number_mismatch}
+        end
+        key_mismatch = true
+    end
+end
+
+if from_sid == 0 or (key_mismatch and sid_number_mismatch == 0) then
+    local number, how
+    if #area_codes > 0 then
+        for _, area_code in ipairs(area_codes) do
+            number, how = lease_area_code(area_code)
+            if number or how then
+                break
+            end
+        end
+    else
+        number, how = lease_random()
+    end
+    if number then
+        return {"leased", number, how, from_sid, sid_number_mismatch, candidates}
+    elseif how then
+        return {"undeclared", how, false, from_sid, sid_number_mismatch}
+    end
+end
+
+return {"empty", false, false, from_sid, sid_number_mismatch}
+"""
+)
+
+# KEYS[1] taken sorted set, KEYS[2] session -> number hash,
+# KEYS[3] per-area-code taken sorted set for the number, KEYS[4] context
+# updates list for the number, which the caller has folded into the context,
+# KEYS[5] number context, KEYS[6] attribution snapshot
+#
+# ARGV[1] number
+# ARGV[2] SHA1 of the raw context (see read_context) the renewal was computed
+# from
+# ARGV[3] renewed JSON context (json format)
+# ARGV[4] renewed_at
+# ARGV[5] session ID to map to the number ("" to skip)
+# ARGV[6] context storage format ("json" or "hash")
+# ARGV[7] JSON list of attribution snapshot field/value pairs
+# ARGV[8...] hash field/value pairs to write (hash format). Only the changed
+# fields if the context is already a hash, otherwise all of them.
+#
+# Returns 1 if the renewal was committed, or 0 if the number context changed
+# since it was read and the renewal must be retried.
+RENEW_NUMBER_SCRIPT = (
+    _NUMBER_CONTEXT_FUNCTIONS
+    + """
+local number = ARGV[1]
+local _, raw = read_context(KEYS[5])
+if (not raw) or redis.sha1hex(raw) ~= ARGV[2] then
+    return 0
+end
+if not redis.call("ZSCORE", KEYS[1], number) then
+    return 0
+end
+redis.call("ZADD", KEYS[1], "XX", ARGV[4], number)
+redis.call("ZADD", KEYS[3], ARGV[4], number)
+if ARGV[6] == "hash" then
+    if redis.call("TYPE", KEYS[5])["ok"] ~= "hash" then
+        redis.call("DEL", KEYS[5])
+    end
+    if #ARGV >= 9 then
+        redis.call("HSET", KEYS[5], unpack(ARGV, 8))
+    end
+else
+    redis.call("SET", KEYS[5], ARGV[3])
+end
+redis.call("DEL", KEYS[6])
+redis.call("HSET", KEYS[6], unpack(cjson.decode(ARGV[7])))
+redis.call("DEL", KEYS[4])
+if ARGV[5] ~= "" then
+    redis.call("HSET", KEYS[2], ARGV[5], number)
+end
+return 1
+"""
+)
+
+# KEYS[1] session -> number hash, KEYS[2] taken sorted set, KEYS[3] sorted set
+# of numbers with confirmed renewals, KEYS[4] number context, KEYS[5] context
+# updates list, KEYS[6] attribution snapshot. The number keys are only passed
+# in the v2 layout.
+#
+# ARGV[1] session ID
+# ARGV[2] number, the target number or else the session's number. May be ""
+# in the v1 layout to confirm the session's number.
+# ARGV[3] current time
+# ARGV[4] seconds since the last renewal within which renewals are confirmed
+# ARGV[5] request context session key name
+# ARGV[6] JSON request context to append to the context updates ("" if none)
+# ARGV[7] max context updates kept per number
+# ARGV[8] context updates expiration in seconds
+# ARGV[9] JSON list of the attribution snapshot field/value pairs set in the
+# request context
+# ARGV[10] JSON object of the context, context_updates and attribution key
+# prefixes to derive the number keys from in the v1 layout, or "" if passed
+#
+# Confirms a renewal without rewriting the number context if the session owns
+# the number and it was renewed less than ARGV[4] seconds ago. The request
+# context is appended to the number's context updates unless it repeats the
+# last one, and the number is then scored by the current time in KEYS[3]. Its
+# attribution fields are set on the number's snapshot if it has one. Returns
+# the number, or false if a full renewal is needed.
+CONFIRM_RENEWAL_SCRIPT = (
+    """
+local sid = ARGV[1]
+local number = ARGV[2]
+local now = tonumber(ARGV[3])
+local session_key = ARGV[5]
+local update = ARGV[6]
+"""
+    + _NUMBER_CONTEXT_FUNCTIONS
+    + """
+local sid_number = redis.call("HGET", KEYS[1], sid)
+if (not sid_number) or (number ~= "" and number ~= sid_number) then
+    return false
+end
+number = sid_number
+local context_key, updates_key, attribution_key = KEYS[4], KEYS[5], KEYS[6]
+if ARGV[10] ~= "" then
+    local prefixes = cjson.decode(ARGV[10])
+    context_key = prefixes["context"] .. number
+    updates_key = prefixes["context_updates"] .. number
+    attribution_key = prefixes["attribution"] .. number
+end
+local renewed_at = redis.call("ZSCORE", KEYS[2], number)
+if (not renewed_at) or (now - tonumber(renewed_at)) >= tonumber(ARGV[4]) then
+    return false
+end
+-- The session map is not cleared when a number is leased to another session
+local ctx = read_context(context_key)
+if (not ctx) or context_sid(ctx) ~= sid then
+    return false
+end
+if update ~= "" then
+    if redis.call("LINDEX", updates_key, -1) ~= update then
+        redis.call("RPUSH", updates_key, update)
+        redis.call("LTRIM", updates_key, -tonumber(ARGV[7]), -1)
+        redis.call("ZADD", KEYS[3], now, number)
+    end
+    redis.call("EXPIRE", updates_key, ARGV[8])
+end
+local attribution_fields = cjson.decode(ARGV[9])
+if #attribution_fields > 0 and redis.call("EXISTS", attribution_key) == 1 then
+    redis.call("HSET", attribution_key, unpack(attribution_fields))
+end
+return number
+"""
+)
+
+# KEYS[1] taken sorted set, KEYS[2...] per-area-code taken sorted set of each
+# declared area code
+#
+# ARGV[1] JSON list of the declared area codes, which must cover those of the
+# taken numbers
+#
+# Rebuilds the per-area-code taken index from the taken sorted set and returns
+# the number of taken numbers. The taken sets of all declared area codes are
+# cleared first.
+REBUILD_TAKEN_AREA_CODE_INDEX_SCRIPT = (
+    _DECLARED_KEYS_FUNCTIONS
+    + """
+local taken_area_code_keys = declare_keys(ARGV[1], 2, 1)[1]
+local taken = redis.call("ZRANGE", KEYS[1], 0, -1, "WITHSCORES")
+for i = 1, #taken, 2 do
+    declared_key(taken_area_code_keys, string.sub(taken[i], 1, 3))
+end
+for _, key in pairs(taken_area_code_keys) do
+    redis.call("DEL", key)
+end
+for i = 1, #taken, 2 do
+    local key = taken_area_code_keys[string.sub(taken[i], 1, 3)]
+    redis.call("ZADD", key, taken[i + 1], taken[i])
+end
+return #taken / 2
+"""
+)
+
+# KEYS[1] free set, KEYS[2] taken sorted set, KEYS[3] per-area-code free
+# counts hash, KEYS[4...] per-area-code free and taken sets of each declared
+# area code, then the number context key of each candidate number
+#
+# ARGV[1] current time
+# ARGV[2] pool cache expiration in seconds
+# ARGV[3] JSON list of the declared area codes, which must cover those of the
+# candidate numbers
+# ARGV[4...] candidate numbers, read by the caller from the taken sorted set
+#
+# Moves the candidates that are still expired back to the free set. Number
+# contexts are left in place so calls to a reaped number can still be
+# attributed until it is leased again. Returns the number reaped.
+REAP_EXPIRED_NUMBERS_SCRIPT = (
+    """
+local free_key = KEYS[1]
+local taken_key = KEYS[2]
+local area_code_counts_key = KEYS[3]
+local now = tonumber(ARGV[1])
+local expiration = tonumber(ARGV[2])
+"""
+    + _DECLARED_KEYS_FUNCTIONS
+    + """
+local area_code_maps, next_key = declare_keys(ARGV[3], 4, 2)
+local area_code_keys, taken_area_code_keys = area_code_maps[1], area_code_maps[2]
+"""
+    + _FREE_AREA_CODE_INDEX_FUNCTIONS
+    + _NUMBER_CONTEXT_FUNCTIONS
+    + """
+for i = 4, #ARGV do
+    declared_key(taken_area_code_keys, string.sub(ARGV[i], 1, 3))
+end
+local reaped = 0
+for i = 4, #ARGV do
+    local number = ARGV[i]
+    local context_key = KEYS[next_key + i - 4]
+    local taken_area_code_key = taken_area_code_keys[string.sub(number, 1, 3)]
+    local score = redis.call("ZSCORE", taken_key, number)
+    local renewed_at = read_renewed_at(context_key)
+    if (not score) or now - tonumber(score) < expiration then
+        -- Renewed or freed since the caller read the candidates
+    elseif renewed_at and math.floor(now - renewed_at) < expiration then
+        -- Context was renewed without updating the score
+        redis.call("ZADD", taken_key, renewed_at, number)
+        redis.call("ZADD", taken_area_code_key, renewed_at, number)
+    else
+        redis.call("ZREM", taken_key, number)
+        redis.call("ZREM", taken_area_code_key, number)
+        redis.call("SADD", free_key, number)
+        index_free_number(number)
+        reaped = reaped + 1
+    end
+end
+return reaped
+"""
+)
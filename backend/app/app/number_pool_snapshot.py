@@ -0,0 +1,65 @@
+"""Background task that snapshots number pool state to the database.
+
+Redis runs without persistence and may evict keys, so leased numbers, their
+contexts and session mappings would otherwise be lost on a restart and calls
+to those numbers could no longer be attributed. Each run writes the contexts
+of the numbers leased or renewed since the previous run to the
+pool_number_snapshots table, and drops rows older than the max renewal age.
+init_pools restores missing contexts from the table.
+
+The snapshotter runs as an asyncio task in the app lifespan when
+NUMBER_POOL_SNAPSHOT_ENABLED is set, or standalone with:
+
+    python -m app.number_pool_snapshot
+
+Any number of app workers may run it. A leader lock in Redis ensures only one
+of them writes snapshots at a time.
+"""
+
+import time
+
+import rollbar
+from tlbx import info, error
+
+from app.core.config import settings
+from app.number_pool import NUMBER_POOL_MAX_RENEWAL_AGE
+from app.number_pool_leader import NumberPoolLeaderTask
+
+
+NUMBER_POOL_SNAPSHOT_LOCK_NAME = "Pool Snapshot"
+
+
+class NumberPoolSnapshotter(NumberPoolLeaderTask):
+    """Periodically snapshot recently renewed numbers of each pool"""
+
+    name = "number pool snapshotter"
+    lock_name = NUMBER_POOL_SNAPSHOT_LOCK_NAME
+
+    def __init__(self, pool_api=None, interval=None):
+        super().__init__(
+            interval or settings.NUMBER_POOL_SNAPSHOT_INTERVAL, pool_api=pool_api
+        )
+
+    def run_as_leader(self):
+        """Snapshot all pools. Returns a dict of snapshotted counts by pool
+        ID."""
+        start = time.time()
+        counts = {}
+        for pool in self.pool_api.get_pools_from_db():
+            pool_id = pool["id"]
+            try:
+                counts[pool_id] = self.pool_api.snapshot_pool(pool_id)
+            except Exception as e:
+                error(f"Failed to snapshot pool {pool_id}: {e}")
+                rollbar.report_exc_info()
+        self.pool_api.delete_pool_snapshots_from_db(
+            time.time() - NUMBER_POOL_MAX_RENEWAL_AGE
+        )
+        total = sum(counts.values())
+        if total:
+            info(f"Snapshotted {total} numbers in {time.time() - start:.3f}s")
+        return counts
+
+
+if __name__ == "__main__":
+    NumberPoolSnapshotter.main()
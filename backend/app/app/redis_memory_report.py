@@ -0,0 +1,157 @@
+"""Report Redis key counts and memory use per data family.
+
+See RedisFamilies. Scans every Redis instance in use, so prefer running it
+against a replica or off-peak:
+
+    python -m app.redis_memory_report --sample 10
+
+With --sample N only every Nth key is measured with MEMORY USAGE and each
+family's total is extrapolated from the measured keys.
+"""
+
+import argparse
+
+from tlbx import info, warn
+
+from app.db.redis_session import RedisFamilies
+from app.geo import MAXMIND_GEOIP_CACHE_KEY_PREFIX
+from app.number_pool import get_redis_family_conn
+from app.schemas.zar import UserIDTypes
+from app.trestle import TRESTLE_CACHE_KEY_PREFIX
+
+SCAN_COUNT = 1000
+MEMORY_USAGE_BATCH_SIZE = 500
+FAMILIES = [
+    RedisFamilies.POOL,
+    RedisFamilies.ROUTES,
+    RedisFamilies.USER_CONTEXTS,
+    RedisFamilies.LEASE_CALLERS,
+    RedisFamilies.GEOIP,
+    RedisFamilies.TRESTLE,
+]
+USER_CONTEXT_KEY_PREFIXES = tuple(
+    f"{id_type}:" for id_type in [UserIDTypes.PHONE, UserIDTypes.EMAIL, UserIDTypes.SID]
+)
+
+
+def get_key_family(key):
+    """The data family a key belongs to, by its name"""
+    if isinstance(key, bytes):
+        key = key.decode("utf-8", "replace")
+    if key.startswith(MAXMIND_GEOIP_CACHE_KEY_PREFIX + ":"):
+        return RedisFamilies.GEOIP
+    if key.startswith(TRESTLE_CACHE_KEY_PREFIX + ":"):
+        return RedisFamilies.TRESTLE
+    if key.startswith("lease_callers:"):
+        return RedisFamilies.LEASE_CALLERS
+    if "->" in key:
+        return RedisFamilies.ROUTES
+    if key.startswith(USER_CONTEXT_KEY_PREFIXES):
+        return RedisFamilies.USER_CONTEXTS
+    return RedisFamilies.POOL
+
+
+def _measure_keys(conn, keys):
+    pipeline = conn.pipeline(transaction=False)
+    for key in keys:
+        pipeline.memory_usage(key)
+    # Keys may expire between the scan and the measurement
+    return [x or 0 for x in pipeline.execute()]
+
+
+def get_instance_report(conn, sample=1):
+    """Count and measure the keys of each family on one Redis instance"""
+    report = {}
+    batch = []
+
+    def flush():
+        for (family, _), size in zip(batch, _measure_keys(conn, [k for _, k in batch])):
+            report[family]["sampled_keys"] += 1
+            report[family]["sampled_bytes"] += size
+        batch.clear()
+
+    for i, key in enumerate(conn.scan_iter(count=SCAN_COUNT)):
+        family = get_key_family(key)
+        family_report = report.setdefault(
+            family, dict(keys=0, sampled_keys=0, sampled_bytes=0)
+        )
+        family_report["keys"] += 1
+        if i % sample == 0:
+            batch.append((family, key))
+            if len(batch) >= MEMORY_USAGE_BATCH_SIZE:
+                flush()
+    flush()
+
+    for family_report in report.values():
+        sampled = family_report["sampled_keys"]
+        family_report["bytes"] = (
+            int(family_report["sampled_bytes"] * family_report["keys"] / sampled)
+            if sampled
+            else 0
+        )
+    return report
+
+
+def get_memory_report(sample=1):
+    """Per-instance INFO memory stats and per-family key counts and bytes.
+    Families sharing an instance are scanned once."""
+    instances = {}
+    for family in FAMILIES:
+        conn = get_redis_family_conn(family)
+        instance = instances.setdefault(id(conn), dict(conn=conn, families=[]))
+        instance["families"].append(family)
+
+    res = []
+    for instance in instances.values():
+        conn = instance["conn"]
+        memory = conn.info("memory")
+        policy = conn.config_get("maxmemory-policy").get("maxmemory-policy", None)
+        families = get_instance_report(conn, sample=sample)
+        res.append(
+            dict(
+                families=instance["families"],
+                used_memory=memory.get("used_memory", None),
+                maxmemory=memory.get("maxmemory", None),
+                maxmemory_policy=policy,
+                keys={
+                    family: families.get(family, dict(keys=0, bytes=0))
+                    for family in instance["families"]
+                },
+            )
+        )
+        # Keys of other families left over from before a split
+        for family, family_report in families.items():
+            if family not in instance["families"] and family_report["keys"]:
+                res[-1]["keys"][family] = family_report
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sample", type=int, default=1, help="Measure every Nth key")
+    args = parser.parse_args()
+
+    for instance in get_memory_report(sample=max(1, args.sample)):
+        info(
+            f"Instance for {', '.join(instance['families'])}: "
+            f"used_memory={instance['used_memory']} "
+            f"maxmemory={instance['maxmemory']} "
+            f"maxmemory-policy={instance['maxmemory_policy']}"
+        )
+        for family, family_report in instance["keys"].items():
+            info(
+                f"    {family}: {family_report['keys']} keys, "
+                f"{family_report['bytes']} bytes"
+            )
+        if (
+            RedisFamilies.POOL in instance["families"]
+            and instance["maxmemory_policy"] != "noeviction"
+        ):
+            warn(
+                "The number pool instance may evict keys, its maxmemory-policy "
+                f"is {instance['maxmemory_policy']} instead of noeviction"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -80,6 +80,11 @@ class GetStaticNumberContextRequestParams(BaseModel):
     number: str
 
 
+class TrackCallResultRequestParams(BaseModel):
+    key: str
+    call_id: str
+
+
 class StaticNumberContext(BaseModel):
     number: str
     context: Dict[str, Any]
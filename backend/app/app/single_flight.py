@@ -0,0 +1,161 @@
+"""Coalesce concurrent lookups of the same key into one outbound call.
+
+Within a process, SingleFlight and AsyncSingleFlight make concurrent callers
+for a key share the result of the first one. Across processes, the caller that
+goes out marks the key as in flight in Redis with claim_in_flight, and callers
+in other processes that find the marker wait for the result to show up in the
+cache with wait_in_flight instead of making the same call. The marker expires
+on its own, so a process that dies mid-lookup only delays the others until
+then, and a caller that waits in vain does the lookup itself.
+"""
+
+import asyncio
+from concurrent.futures import Future
+from threading import Lock
+import time
+
+from tlbx import warn
+
+IN_FLIGHT_KEY_SUFFIX = "in_flight"
+IN_FLIGHT_POLL_INTERVAL = 0.025
+
+
+class SingleFlight:
+    """Run one call of fn per key at a time across threads. Callers that arrive
+    while it runs block on its result, or its exception."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key, None)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            res = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(res)
+            return res
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+class AsyncSingleFlight:
+    """See SingleFlight. The call runs as its own task, so it carries on for
+    the other callers if the one that started it is cancelled."""
+
+    def __init__(self):
+        self._calls = {}
+
+    def _done(self, key, task):
+        if self._calls.get(key, None) is task:
+            del self._calls[key]
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self._calls.get(key, None)
+        if not task:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+
+def get_in_flight_key(key):
+    return f"{key}:{IN_FLIGHT_KEY_SUFFIX}"
+
+
+def claim_in_flight(conn, key, ttl):
+    """Mark key as in flight for up to ttl seconds. Returns False if another
+    caller already has it in flight. If Redis is not available the caller
+    goes ahead as if it had the claim."""
+    if not conn:
+        return True
+
+    try:
+        return bool(conn.set(get_in_flight_key(key), 1, nx=True, px=int(ttl * 1000)))
+    except Exception as e:
+        warn(f"Could not claim in-flight marker for {key}: {str(e)}")
+        return True
+
+
+def release_in_flight(conn, key):
+    if not conn:
+        return
+
+    try:
+        conn.delete(get_in_flight_key(key))
+    except Exception as e:
+        warn(f"Could not release in-flight marker for {key}: {str(e)}")
+
+
+def wait_in_flight(conn, key, read_cache, miss, timeout):
+    """Poll read_cache until it returns something other than miss, the marker
+    of key is released, or timeout seconds pass. Returns miss if the caller
+    should do the lookup itself."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(IN_FLIGHT_POLL_INTERVAL)
+        res = read_cache()
+        if res is not miss:
+            return res
+        try:
+            if not conn.exists(get_in_flight_key(key)):
+                # The result may have been cached just before the release
+                return read_cache()
+        except Exception as e:
+            warn(f"Could not check in-flight marker for {key}: {str(e)}")
+            return miss
+    return miss
+
+
+async def claim_in_flight_async(conn, key, ttl):
+    """See claim_in_flight"""
+    if not conn:
+        return True
+
+    try:
+        return bool(
+            await conn.set(get_in_flight_key(key), 1, nx=True, px=int(ttl * 1000))
+        )
+    except Exception as e:
+        warn(f"Could not claim in-flight marker for {key}: {str(e)}")
+        return True
+
+
+async def release_in_flight_async(conn, key):
+    if not conn:
+        return
+
+    try:
+        await conn.delete(get_in_flight_key(key))
+    except Exception as e:
+        warn(f"Could not release in-flight marker for {key}: {str(e)}")
+
+
+async def wait_in_flight_async(conn, key, read_cache, miss, timeout):
+    """See wait_in_flight. read_cache is a coroutine function."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(IN_FLIGHT_POLL_INTERVAL)
+        res = await read_cache()
+        if res is not miss:
+            return res
+        try:
+            if not await conn.exists(get_in_flight_key(key)):
+                # The result may have been cached just before the release
+                return await read_cache()
+        except Exception as e:
+            warn(f"Could not check in-flight marker for {key}: {str(e)}")
+            return miss
+    return miss
@@ -578,7 +578,7 @@ def test_endpoint_number_pool_handles_pool_unavailable(
     client: TestClient, monkeypatch
 ) -> None:
     page(client)
-    monkeypatch.setattr(zar_endpoints, "pool_api", None)
+    monkeypatch.setattr(zar_endpoints, "async_pool_api", None)
 
     resp = client.post(
         f"{settings.API_V2_STR}/number_pool", json=SAMPLE_NUMBER_POOL_REQUEST
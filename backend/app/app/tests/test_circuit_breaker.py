@@ -0,0 +1,74 @@
+from app import circuit_breaker
+from app.circuit_breaker import CircuitBreaker, CircuitStates
+
+
+def test_circuit_breaker_opens_on_failures_and_probes(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(
+        "test_failures",
+        max_timeout=1.0,
+        min_timeout=0.1,
+        window_size=10,
+        min_calls=4,
+        open_seconds=30,
+        half_open_calls=2,
+    )
+
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_success(0.05)
+    assert breaker.allow()
+    breaker.record_failure(1.0)
+    assert breaker.state == CircuitStates.CLOSED
+    breaker.record_failure(1.0)
+    assert breaker.state == CircuitStates.OPEN
+    assert not breaker.allow()
+
+    # Half-open after open_seconds, with a limited number of probes
+    now[0] += 30
+    assert breaker.allow()
+    assert breaker.state == CircuitStates.HALF_OPEN
+    assert breaker.get_timeout() == 1.0
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure(1.0)
+    assert breaker.state == CircuitStates.OPEN
+
+    now[0] += 30
+    assert breaker.allow() and breaker.allow()
+    breaker.record_success(0.05)
+    breaker.record_success(0.05)
+    assert breaker.state == CircuitStates.CLOSED
+    assert breaker.get_stats()["calls"] == 0
+    assert breaker.get_stats()["opened_count"] == 2
+    assert "test_failures" in circuit_breaker.get_circuit_breaker_stats()
+
+
+def test_circuit_breaker_adaptive_timeout_and_slow_calls():
+    breaker = CircuitBreaker(
+        "test_latency",
+        max_timeout=1.0,
+        min_timeout=0.1,
+        window_size=10,
+        min_calls=4,
+    )
+    assert breaker.get_timeout() == 1.0
+    for latency in (0.2, 0.2, 0.2, 0.3):
+        breaker.record_success(latency)
+    assert round(breaker.get_timeout(), 2) == 0.45
+
+    for latency in (0.01, 0.01, 0.01, 0.01):
+        breaker.record_success(latency)
+    assert round(breaker.get_timeout(), 2) == 0.45
+    breaker.reset()
+    for _ in range(4):
+        breaker.record_success(0.01)
+    assert breaker.get_timeout() == 0.1
+
+    # Calls past half the max timeout count as slow
+    for _ in range(3):
+        breaker.record_success(0.6)
+    assert breaker.state == CircuitStates.CLOSED
+    breaker.record_success(0.6)
+    assert breaker.state == CircuitStates.OPEN
@@ -1,5 +1,6 @@
 import copy
 import json
+import threading
 import time
 from types import SimpleNamespace
 
@@ -9,6 +10,7 @@ from tlbx import info
 
 from app.api.api_v2.endpoints import zar as zar_endpoints
 from app.core.config import settings
+from app.db.redis_session import RedisFamilies
 from app import geo as geo_module
 
 
@@ -53,20 +55,66 @@ class FakeRedisConn:
         self.storage[key] = value
         self.expirations[key] = ttl_seconds
 
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.storage:
+            return None
+        self.storage[key] = value
+        return True
+
+    def delete(self, key):
+        self.storage.pop(key, None)
+
+    def exists(self, key):
+        return int(key in self.storage)
+
+    def execute_command(self, command, *args, **options):
+        # Cached values are read with GET and NEVER_DECODE, see get_encoded
+        return getattr(self, command.lower())(*args)
+
 
 class FakeGeoIPClient:
-    def __init__(self, response=None, error=None):
+    def __init__(self, response=None, error=None, delay=0):
         self.response = response
         self.error = error
+        self.delay = delay
         self.calls = 0
 
     def city(self, ip):
         self.calls += 1
+        time.sleep(self.delay)
         if self.error:
             raise self.error
         return self.response
 
 
+def test_get_maxmind_geoip_client_per_timeout(monkeypatch):
+    class FakeClient:
+        def __init__(self, account_id, license_key, host=None, timeout=None):
+            self.timeout = timeout
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(settings, "MAXMIND_GEOIP_ACCOUNT_ID", "account")
+    monkeypatch.setattr(settings, "MAXMIND_GEOIP_LICENSE_KEY", "key")
+    monkeypatch.setattr(geo_module.geoip2.webservice, "Client", FakeClient)
+    geo_module.close_maxmind_geoip()
+
+    # Adaptive timeouts are rounded up so clients are shared, not mutated
+    client = geo_module.get_maxmind_geoip_client(0.32)
+    assert client.timeout == 0.4
+    assert geo_module.get_maxmind_geoip_client(0.4) is client
+    default = geo_module.get_maxmind_geoip_client()
+    assert default.timeout == geo_module.MAXMIND_GEOIP_TIMEOUT
+    assert default is not client
+
+    geo_module.close_maxmind_geoip()
+    assert client.closed and default.closed
+    assert geo_module.get_maxmind_geoip_client(0.4) is not client
+    geo_module.close_maxmind_geoip()
+
+
 def test_get_area_codes_from_context_uses_geoip_without_source_requirement(
     monkeypatch,
 ):
@@ -186,8 +234,10 @@ def test_geoip_area_codes_from_ip_caches_minimal_area_codes_in_redis(monkeypatch
     )
     fake_client = FakeGeoIPClient(response=fake_response)
 
-    monkeypatch.setattr(geo_module, "get_number_pool_conn", lambda: fake_conn)
-    monkeypatch.setattr(geo_module, "get_maxmind_geoip_client", lambda: fake_client)
+    monkeypatch.setattr(geo_module, "get_redis_family_conn", lambda family: fake_conn)
+    monkeypatch.setattr(
+        geo_module, "get_maxmind_geoip_client", lambda timeout: fake_client
+    )
     monkeypatch.setattr(
         geo_module,
         "_rank_area_codes_for_geoip_location",
@@ -204,15 +254,17 @@ def test_geoip_area_codes_from_ip_caches_minimal_area_codes_in_redis(monkeypatch
     assert (
         fake_conn.expirations[cache_key] == geo_module.MAXMIND_GEOIP_CACHE_TTL_SECONDS
     )
-    assert fake_conn.storage[cache_key] == json.dumps(["401", "339"])
+    assert json.loads(fake_conn.storage[cache_key]) == ["401", "339"]
 
 
 def test_geoip_area_codes_from_ip_negative_caches_address_not_found(monkeypatch):
     fake_conn = FakeRedisConn()
     fake_client = FakeGeoIPClient(error=geoip2.errors.AddressNotFoundError("not found"))
 
-    monkeypatch.setattr(geo_module, "get_number_pool_conn", lambda: fake_conn)
-    monkeypatch.setattr(geo_module, "get_maxmind_geoip_client", lambda: fake_client)
+    monkeypatch.setattr(geo_module, "get_redis_family_conn", lambda family: fake_conn)
+    monkeypatch.setattr(
+        geo_module, "get_maxmind_geoip_client", lambda timeout: fake_client
+    )
 
     first_result = geo_module.geoip_area_codes_from_ip("8.8.8.8")
     second_result = geo_module.geoip_area_codes_from_ip("8.8.8.8")
@@ -224,6 +276,54 @@ def test_geoip_area_codes_from_ip_negative_caches_address_not_found(monkeypatch)
     assert fake_conn.storage[cache_key] == json.dumps([])
 
 
+def test_geoip_area_codes_from_ip_coalesces_concurrent_lookups(monkeypatch):
+    fake_conn = FakeRedisConn()
+    fake_response = SimpleNamespace(
+        country=SimpleNamespace(iso_code="US"),
+        subdivisions=SimpleNamespace(most_specific=SimpleNamespace(iso_code="RI")),
+        location=SimpleNamespace(latitude=41.82, longitude=-71.41),
+    )
+    fake_client = FakeGeoIPClient(response=fake_response, delay=0.05)
+
+    monkeypatch.setattr(geo_module, "get_redis_family_conn", lambda family: fake_conn)
+    monkeypatch.setattr(
+        geo_module, "get_maxmind_geoip_client", lambda timeout: fake_client
+    )
+    monkeypatch.setattr(
+        geo_module,
+        "_rank_area_codes_for_geoip_location",
+        lambda country, subdivision, lat, lon: ["401"],
+    )
+
+    results = []
+
+    def lookup(ip):
+        results.append(geo_module.geoip_area_codes_from_ip(ip))
+
+    threads = [threading.Thread(target=lookup, args=("8.8.8.8",)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [["401"]] * 3
+    assert fake_client.calls == 1
+
+    # Another worker has the lookup in flight and caches its result
+    cache_key = f"{geo_module.MAXMIND_GEOIP_CACHE_KEY_PREFIX}:8.8.4.4"
+    fake_conn.set(f"{cache_key}:in_flight", 1)
+
+    def fill_cache():
+        fake_conn.setex(cache_key, 60, json.dumps(["339"]))
+        fake_conn.delete(f"{cache_key}:in_flight")
+
+    timer = threading.Timer(0.05, fill_cache)
+    timer.start()
+    assert geo_module.geoip_area_codes_from_ip("8.8.4.4") == ["339"]
+    timer.join()
+    assert fake_client.calls == 1
+
+
 def test_rank_area_codes_for_geoip_location_returns_single_candidate_when_close(
     monkeypatch,
 ):
@@ -319,7 +419,7 @@ def test_live_geoip_area_codes_for_rhode_island_ip(client):
     if not zar_endpoints.pool_api:
         pytest.skip("Number pool is not available")
 
-    conn = geo_module.get_number_pool_conn()
+    conn = geo_module.get_redis_family_conn(RedisFamilies.GEOIP)
     if not conn:
         pytest.skip("Redis connection is not available")
 
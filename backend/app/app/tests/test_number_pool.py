@@ -1,16 +1,31 @@
+import base64
 import time
 
 import pytest
-from tlbx import st, pp
+import redis
+from tlbx import st, pp, json
 
+from app.core.config import settings
+from app.db.redis_codec import CODEC_MARKER, RedisCodec, dumps_json, get_encoded
+from app.db.redis_session import RedisFamilies
 from app.number_pool import (
     NUMBER_POOL_CACHE_EXPIRATION,
+    POOL_PROPERTIES_CHANNEL,
+    LeaseScriptStatus,
     NumberPoolAPI,
+    NumberPoolKeyLayouts,
+    NumberPoolLeaseModes,
     NumberMaxRenewalExceeded,
     NumberPoolEmpty,
     NumberNotFound,
     NumberStatus,
+    get_number_pool_conn,
+    pool_properties_cache,
 )
+from app.number_pool_benchmark import RoundTripCounter, benchmark_pool
+from app.number_pool_migrate import migrate_key_layout
+from app.number_pool_reaper import NumberPoolReaper
+from app.redis_memory_report import get_key_family, get_memory_report
 
 
 pool_api = NumberPoolAPI()
@@ -21,6 +36,28 @@ OTHER_POOL_ID = 2
 AREA_CODE_POOL_ID = 3
 
 
+def number_keys(pool_id=DEFAULT_POOL_ID):
+    """Keyword args for the context key names of numbers in pool_id"""
+    return dict(pool_id=pool_id, shard_count=pool_api._get_number_shard_count(pool_id))
+
+
+@pytest.fixture
+def set_pool_properties():
+    """Override properties of a pool in the properties cache for the test.
+    Returns the cached properties, which tests may change in place."""
+    pool_ids = set()
+
+    def set_properties(pool_id=DEFAULT_POOL_ID, **overrides):
+        properties = {**pool_api.get_pool_properties(pool_id), **overrides}
+        pool_properties_cache.set(pool_id, properties)
+        pool_ids.add(pool_id)
+        return properties
+
+    yield set_properties
+    for pool_id in pool_ids:
+        pool_properties_cache.invalidate(pool_id)
+
+
 def test_pool_lease_number():
     pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
     num = pool_api.lease_number(DEFAULT_POOL_ID, {})  # Should lease random number
@@ -81,24 +118,93 @@ def test_pool_take_expired_number():
     assert "foo" in ctx.get("request_context", None)
 
 
-def test_pool_cache_expiration_override(monkeypatch):
+def test_pool_cache_expiration_override(set_pool_properties):
     pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
     num = pool_api.lease_number(DEFAULT_POOL_ID, {})
     ctx = pool_api.get_pool_number_context(num)
     ctx["renewed_at"] = time.time() - NUMBER_POOL_CACHE_EXPIRATION - 1
     pool_api.set_number_context(num, ctx)
 
-    pool_properties = pool_api.get_pool_properties(DEFAULT_POOL_ID).copy()
-    pool_properties["cache_expiration"] = NUMBER_POOL_CACHE_EXPIRATION
-    monkeypatch.setitem(
-        pool_api._pool_properties_cache, DEFAULT_POOL_ID, pool_properties
-    )
+    pool_properties = set_pool_properties(cache_expiration=NUMBER_POOL_CACHE_EXPIRATION)
     assert pool_api.get_number_status(num)[0] == NumberStatus.EXPIRED
 
     pool_properties["cache_expiration"] = 2 * 60 * 60
     assert pool_api.get_number_status(num)[0] == NumberStatus.TAKEN
 
 
+def test_pool_visits_policy(set_pool_properties):
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    pool_properties = set_pool_properties(max_visits=2)
+
+    def visit(vid):
+        return dict(sid="1234", visits={vid: dict(url=f"http://x/{vid}", foo="bar")})
+
+    num = pool_api.lease_number(DEFAULT_POOL_ID, visit("1"))
+    for vid in ["2", "3", "1"]:
+        pool_api.lease_number(DEFAULT_POOL_ID, visit(vid), target_number=num)
+    visits = pool_api.get_pool_number_context(num)["request_context"]["visits"]
+    # Repeat visits count as the most recent
+    assert list(visits) == ["3", "1"]
+
+    pool_api.update_number(DEFAULT_POOL_ID, num, visit("4"), merge=True)
+    visits = pool_api.get_pool_number_context(num)["request_context"]["visits"]
+    assert list(visits) == ["1", "4"]
+
+    pool_properties.update(max_visits=0, max_visits_bytes=1, visits_summary=True)
+    pool_api.lease_number(DEFAULT_POOL_ID, visit("5"), target_number=num)
+    visits = pool_api.get_pool_number_context(num)["request_context"]["visits"]
+    # The most recent visit is always kept
+    assert visits == {"5": dict(url="http://x/5")}
+
+
+def wait_for(predicate, timeout=3):
+    start = time.time()
+    while time.time() - start < timeout:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_pool_properties_invalidation():
+    assert wait_for(lambda: pool_properties_cache.subscribed)
+    props = pool_api.get_pool_properties(DEFAULT_POOL_ID)
+    pool_properties_cache.set(DEFAULT_POOL_ID, dict(props, stale=True))
+    assert pool_api.get_pool_properties(DEFAULT_POOL_ID)["stale"]
+
+    # Another process updating the pool should invalidate our copy
+    pool_api.conn.publish(POOL_PROPERTIES_CHANNEL, DEFAULT_POOL_ID)
+    assert wait_for(lambda: DEFAULT_POOL_ID not in pool_properties_cache.properties)
+    assert "stale" not in pool_api.get_pool_properties(DEFAULT_POOL_ID)
+
+    # Cached until invalidated, without reading Redis again
+    pool_properties_cache.updated_at[DEFAULT_POOL_ID] = 0
+    pool_properties_cache.properties[DEFAULT_POOL_ID]["stale"] = True
+    assert pool_api.get_pool_properties(DEFAULT_POOL_ID)["stale"]
+    pool_api.set_pool_properties(DEFAULT_POOL_ID, dict(properties=json.dumps(props)))
+    assert pool_api.get_pool_properties(DEFAULT_POOL_ID) == props
+
+
+def test_pool_properties_invalidation_during_read(monkeypatch):
+    pool_properties_cache.invalidate(DEFAULT_POOL_ID)
+    conn = pool_api.conn
+
+    class InvalidatingConn:
+        def get(self, key):
+            res = conn.get(key)
+            # An invalidation arrives after the read, before it is cached
+            pool_properties_cache.invalidate(DEFAULT_POOL_ID)
+            return res
+
+    monkeypatch.setattr(pool_api, "conn", InvalidatingConn())
+    assert pool_api.get_pool_properties(DEFAULT_POOL_ID) is not None
+    assert DEFAULT_POOL_ID not in pool_properties_cache.properties
+
+    monkeypatch.setattr(pool_api, "conn", conn)
+    assert pool_api.get_pool_properties(DEFAULT_POOL_ID) is not None
+    assert DEFAULT_POOL_ID in pool_properties_cache.properties
+
+
 def test_pool_max_renewal_time():
     pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
     num = pool_api.lease_number(DEFAULT_POOL_ID, {})
@@ -132,6 +238,31 @@ def test_pool_reinit():
     assert len(taken) == 1
 
 
+def test_pool_reinit_skips_unchanged_pools(monkeypatch):
+    pool_api.init_pools()
+    reset = []
+    orig_reset_pool = pool_api._reset_pool
+
+    def reset_pool(pool_id, **kwargs):
+        reset.append(pool_id)
+        return orig_reset_pool(pool_id, **kwargs)
+
+    monkeypatch.setattr(pool_api, "_reset_pool", reset_pool)
+    pool_api.init_pools()
+    assert reset == []
+
+    pool_api.conn.delete(pool_api._get_pool_version_key(DEFAULT_POOL_ID))
+    pool_api.conn.delete(pool_api._get_free_pool_name(OTHER_POOL_ID))
+    pool_api.conn.delete(pool_api._get_taken_pool_name(OTHER_POOL_ID))
+    pool_api.init_pools()
+    assert sorted(reset) == [DEFAULT_POOL_ID, OTHER_POOL_ID]
+    assert pool_api._get_free_numbers(OTHER_POOL_ID)
+
+    reset.clear()
+    pool_api.init_pools(force=True)
+    assert len(reset) == len(pool_api.get_pools_from_db())
+
+
 def test_pool_get_stats():
     pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
     pool_api.lease_number(DEFAULT_POOL_ID, dict(foo="bar", baz="bar"))
@@ -139,6 +270,29 @@ def test_pool_get_stats():
     pp(stats)
 
 
+def test_pool_stats_expired_counts():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    num = pool_api.lease_number(DEFAULT_POOL_ID, {})
+    pool_api.lease_number(DEFAULT_POOL_ID, {})
+    pool_api._set_number_renewed_at(num, time.time() - 2e6)
+    stats = pool_api.get_all_pool_stats()
+    counts = [v for k, v in stats.items() if k.startswith(f"{DEFAULT_POOL_ID}/")][0]
+    assert counts["counts"]["taken"] == 2
+    assert counts["counts"]["expired"] == 1
+    assert counts["counts"]["free"] + 2 == counts["counts"]["total"]
+
+
+def test_pool_iter_number_contexts():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    nums = {pool_api.lease_number(DEFAULT_POOL_ID, {}) for _ in range(3)}
+    rows = list(pool_api.iter_number_contexts(pool_ids=[DEFAULT_POOL_ID], batch_size=2))
+    assert {number for _, number, _ in rows} == nums
+    for pool_id, number, ctx in rows:
+        assert pool_id == DEFAULT_POOL_ID
+        assert ctx["pool_id"] == DEFAULT_POOL_ID
+        assert ctx["expired"] is False
+
+
 def test_pool_renew_with_session_id():
     pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
 
@@ -159,6 +313,100 @@ def test_pool_renew_with_session_id():
     assert new_num != num
 
 
+def test_pool_renewal_throttle(set_pool_properties):
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    set_pool_properties(renewal_throttle=0.5)
+
+    def visit(vid):
+        return dict(sid="1234", latest_context=dict(url=vid), visits={vid: {}})
+
+    num = pool_api.lease_number(DEFAULT_POOL_ID, visit("1"))
+    taken_name = pool_api._get_taken_pool_name(DEFAULT_POOL_ID)
+    renewed_at = pool_api.conn.zscore(taken_name, num)
+    # Don't count loading the script on first use
+    pool_api.conn.script_load(pool_api._confirm_renewal_script.script)
+    counter = RoundTripCounter()
+    with counter.counting():
+        for vid in ["2", "2", "3"]:
+            assert pool_api.lease_number(DEFAULT_POOL_ID, visit(vid), num, renew=True)
+    # Confirmed in one round trip each without renewing
+    assert counter.count == 3
+    assert pool_api.conn.zscore(taken_name, num) == renewed_at
+    updates_key = pool_api._get_context_updates_key(num, **number_keys())
+    assert pool_api.conn.llen(updates_key) == 2
+    request_context = pool_api.get_pool_number_context(num)["request_context"]
+    assert request_context["latest_context"] == dict(url="3")
+    assert list(request_context["visits"]) == ["1", "2", "3"]
+    # Bulk reads fold the updates in too
+    contexts = {
+        number: ctx
+        for _, number, ctx in pool_api.iter_number_contexts(pool_ids=[DEFAULT_POOL_ID])
+    }
+    assert contexts[num]["request_context"]["latest_context"] == dict(url="3")
+    assert list(contexts[num]["request_context"]["visits"]) == ["1", "2", "3"]
+
+    # Other sessions still go through a full lease
+    other = pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="5678"), num, renew=True)
+    assert other != num
+
+    # Updates are folded into the context on the next full renewal
+    renewed_at -= NUMBER_POOL_CACHE_EXPIRATION / 2
+    pool_api.conn.zadd(taken_name, {num: renewed_at})
+    pool_api.lease_number(DEFAULT_POOL_ID, visit("4"), num, renew=True)
+    assert pool_api.conn.zscore(taken_name, num) > renewed_at
+    assert not pool_api.conn.exists(updates_key)
+    request_context = pool_api.get_pool_number_context(num)["request_context"]
+    assert list(request_context["visits"]) == ["1", "2", "3", "4"]
+
+
+def test_pool_number_attribution(monkeypatch, set_pool_properties):
+    monkeypatch.setattr(settings, "POOL_CONTEXT_ZIP_KEY", "zip")
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    set_pool_properties(renewal_throttle=0.5)
+
+    ctx = dict(sid="attr-sid", ip="1.2.3.4", user_agent="ua", visits={"1": {}})
+    num = pool_api.lease_number(DEFAULT_POOL_ID, ctx)
+    attribution = pool_api.get_number_attribution(num)
+    context = pool_api.get_pool_number_context(num)
+    assert attribution == dict(
+        pool_id=DEFAULT_POOL_ID,
+        leased_at=context["leased_at"],
+        renewed_at=context["renewed_at"],
+        sid="attr-sid",
+        ip="1.2.3.4",
+        user_agent="ua",
+        zip=None,
+    )
+
+    # Confirmed renewals update the request fields they carry
+    ctx = dict(sid="attr-sid", ip="5.6.7.8", latest_context=dict(zip="02903"))
+    assert pool_api.lease_number(DEFAULT_POOL_ID, ctx, num, renew=True) == num
+    attribution = pool_api.get_number_attribution(num)
+    assert attribution["ip"] == "5.6.7.8"
+    assert attribution["zip"] == "02903"
+    assert attribution["user_agent"] == "ua"
+    assert attribution == pool_api._get_context_attribution(
+        pool_api.get_pool_number_context(num)
+    )
+
+    # Full renewals rewrite the snapshot from the renewed context
+    shard = pool_api._get_shard(num, pool_api.get_shard_count(DEFAULT_POOL_ID))
+    taken_name = pool_api._get_taken_pool_name(DEFAULT_POOL_ID, shard=shard)
+    pool_api.conn.zadd(taken_name, {num: time.time() - NUMBER_POOL_CACHE_EXPIRATION})
+    ctx = dict(sid="attr-sid", user_agent="ua2")
+    assert pool_api.lease_number(DEFAULT_POOL_ID, ctx, num, renew=True) == num
+    context = pool_api.get_pool_number_context(num)
+    attribution = pool_api.get_number_attribution(num)
+    assert attribution["renewed_at"] == context["renewed_at"]
+    assert attribution["user_agent"] == "ua2"
+    assert attribution["zip"] == "02903"
+    assert attribution == pool_api._get_context_attribution(context)
+
+    pool_api._remove_numbers(DEFAULT_POOL_ID, [num])
+    assert pool_api.get_number_attribution(num) is None
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+
+
 def test_pool_session_number_map():
     pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
 
@@ -254,6 +502,64 @@ def test_pool_route_cache_ignores_anonymous_callers():
     assert pool_api.get_cached_route_context("266696687", "5551237777") is None
 
 
+def test_pool_codecs():
+    visits = {
+        str(i): dict(
+            url=f"https://www.example.com/products/item-{i}?utm_source=google"
+            f"&utm_medium=cpc&utm_campaign=spring-sale&gclid=Cj0KCQiA{i}x7",
+            referrer="https://www.google.com/",
+            timestamp=time.time() - 60 * i,
+            ip="203.0.113.42",
+            zip="02903",
+        )
+        for i in range(5)
+    }
+    context = dict(
+        pool_id=DEFAULT_POOL_ID,
+        leased_at=time.time(),
+        renewed_at=time.time(),
+        request_context=dict(
+            sid="2f1c9a7e-5b3d-4c8e-9f60-1a2b3c4d5e6f",
+            ip="203.0.113.42",
+            user_agent="Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) "
+            "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 "
+            "Safari/604.1",
+            zip="02903",
+            latest_context=visits["4"],
+            visits=visits,
+        ),
+    )
+    apis = [
+        NumberPoolAPI(codec=RedisCodec(serializer, compression, 100))
+        for serializer in ["json", "msgpack"]
+        for compression in ["none", "zlib", "zstd"]
+    ]
+    for api in apis:
+        api.set_cached_route_context("5551234444", "5551237777", context)
+        raw = get_encoded(
+            api.conn, api.get_cached_route_key("5551234444", "5551237777")
+        )
+        if api.codec.serializer == "json" and api.codec.compression == "none":
+            assert json.loads(raw) == context
+        else:
+            assert raw.startswith(CODEC_MARKER.encode("ascii"))
+            # Binary payloads are stored as is, smaller than the JSON
+            assert len(raw) < len(dumps_json(context))
+        # Values are readable whatever the configured codec
+        for other_api in apis:
+            res = other_api.get_cached_route_context("5551234444", "5551237777")
+            assert res == context
+
+        api.set_user_context("sid", "1234", dict(foo="bar"))
+        assert pool_api.get_user_context("sid", "1234") == dict(foo="bar")
+
+    with pytest.raises(ValueError):
+        pool_api.codec.loads(CODEC_MARKER + "9j-")
+    # Values written with a base85 payload stay readable
+    legacy = CODEC_MARKER + "1j-" + base64.b85encode(b'{"foo":"bar"}').decode()
+    assert pool_api.codec.loads(legacy) == dict(foo="bar")
+
+
 def test_pool_area_code():
     pool_api._reset_pool(AREA_CODE_POOL_ID, preserve=False)
     ctx = {}
@@ -294,3 +600,573 @@ def test_pool_area_code():
     )
     print("number:", num)
     assert num and num.startswith("781")
+
+
+def test_pool_lock_lease_mode():
+    lock_pool_api = NumberPoolAPI(lease_mode=NumberPoolLeaseModes.LOCK)
+    lock_pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+
+    ctx = dict(sid="1234", visits={1: dict(foo="bar")})
+    num = lock_pool_api.lease_number(DEFAULT_POOL_ID, ctx)
+    assert num
+
+    # Script and lock modes share the same data structures
+    ctx = dict(sid="1234", visits={2: dict(baz="bar")})
+    assert pool_api.lease_number(DEFAULT_POOL_ID, ctx) == num
+    ctx = dict(sid="1234", visits={3: dict(baz="bar")})
+    assert lock_pool_api.lease_number(DEFAULT_POOL_ID, ctx) == num
+    num_ctx = pool_api.get_pool_number_context(num)
+    assert len(num_ctx["request_context"]["visits"]) == 3
+
+
+def test_pool_number_lock_scope():
+    api = NumberPoolAPI(lease_mode="lock", lock_scope="number")
+    api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    num = api.lease_number(DEFAULT_POOL_ID, dict(sid="1234"))
+
+    pool_lock = api._get_pool_lock(DEFAULT_POOL_ID)
+    assert pool_lock.acquire()
+    try:
+        # Renewals and updates of the session's own number skip the pool lock
+        ctx = dict(sid="1234", foo="bar")
+        assert api.lease_number(DEFAULT_POOL_ID, ctx, target_number=num) == num
+        api.update_number(DEFAULT_POOL_ID, num, dict(sid="1234", baz="qux"), True)
+        request_context = api.get_pool_number_context(num)["request_context"]
+        assert request_context["foo"] == "bar"
+        assert request_context["baz"] == "qux"
+    finally:
+        pool_lock.release()
+
+    number_lock = api._get_number_lock(DEFAULT_POOL_ID, num)
+    assert number_lock.acquire()
+    try:
+        # Claiming numbers only needs the pool lock
+        assert api.lease_number(DEFAULT_POOL_ID, dict(sid="5678")) != num
+    finally:
+        number_lock.release()
+
+
+def test_pool_shards(set_pool_properties):
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    num = pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="1234"))
+    numbers = pool_api.get_pool_numbers_from_db(DEFAULT_POOL_ID)
+    pool_properties = set_pool_properties(shards=2)
+    try:
+        # Resetting moves the numbers and session mappings over to the shards
+        pool_api._reset_pool(DEFAULT_POOL_ID)
+        assert not pool_api.conn.exists(pool_api._get_free_pool_name(DEFAULT_POOL_ID))
+        free_name = pool_api._get_free_pool_name(DEFAULT_POOL_ID, shard=1)
+        assert free_name == f"Pool: {{{DEFAULT_POOL_ID}:1}} / Free"
+        assert pool_api._get_pool_numbers(DEFAULT_POOL_ID) == numbers
+        assert pool_api._get_taken_numbers(DEFAULT_POOL_ID) == {num}
+        assert pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="1234")) == num
+
+        # Leases fall back across shards until the pool is empty
+        leased = {num: "1234"}
+        for i in range(len(numbers) - 1):
+            leased[pool_api.lease_number(DEFAULT_POOL_ID, dict(sid=str(i)))] = str(i)
+        assert set(leased) == numbers
+
+        # Throttled renewals without a target find the session's number in
+        # its own shard rather than the session's home shard
+        number, sid = next(
+            (n, s)
+            for n, s in leased.items()
+            if pool_api._get_shard(n, 2) != pool_api._get_shard(s, 2)
+        )
+        pool_properties["renewal_throttle"] = 0.5
+        assert (
+            pool_api._confirm_recent_renewal(DEFAULT_POOL_ID, dict(sid=sid), None)
+            == number
+        )
+        del pool_properties["renewal_throttle"]
+        with pytest.raises(NumberPoolEmpty):
+            pool_api.lease_number(DEFAULT_POOL_ID, {})
+        stats = {k.split("/")[0]: v for k, v in pool_api.get_all_pool_stats().items()}
+        counts = stats[str(DEFAULT_POOL_ID)]["counts"]
+        assert counts["taken"] == counts["total"] == len(numbers)
+
+        # Expired numbers are taken over in any shard, and reaped from all
+        pool_api._set_number_renewed_at(num, time.time() - 2e6)
+        assert pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="5678")) == num
+        pool_api._set_number_renewed_at(num, time.time() - 2e6)
+        assert pool_api.reap_expired_numbers(DEFAULT_POOL_ID) == 1
+        assert pool_api._get_free_numbers(DEFAULT_POOL_ID) == {num}
+
+        # And back to a single shard
+        pool_properties["shards"] = 1
+        pool_api._reset_pool(DEFAULT_POOL_ID)
+        assert pool_api.conn.scard(pool_api._get_free_pool_name(DEFAULT_POOL_ID))
+        assert pool_api._get_pool_numbers(DEFAULT_POOL_ID) == numbers
+        assert pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="0")) in leased
+    finally:
+        pool_properties_cache.invalidate(DEFAULT_POOL_ID)
+        pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+
+
+def test_pool_key_layout_migration(monkeypatch):
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    num = pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="migrate"))
+    v2_api = NumberPoolAPI(key_layout=NumberPoolKeyLayouts.V2)
+    try:
+        counts = migrate_key_layout(NumberPoolKeyLayouts.V2)
+        assert counts[DEFAULT_POOL_ID] == len(
+            pool_api.get_pool_numbers_from_db(DEFAULT_POOL_ID)
+        )
+        assert not pool_api.conn.exists(num)
+        assert v2_api._get_number_pool_id(num) == DEFAULT_POOL_ID
+        # v2 keys are tagged with the pool and the number's shard in the pool
+        shard_count = v2_api.get_shard_count(DEFAULT_POOL_ID)
+        number_key = v2_api._get_number_key(
+            num, pool_id=DEFAULT_POOL_ID, shard_count=shard_count
+        )
+        shard = v2_api._get_shard(num, shard_count)
+        assert number_key == f"number:{{{DEFAULT_POOL_ID}:{shard}}}:{num}"
+        assert pool_api.conn.exists(number_key)
+        assert v2_api._get_free_pool_name(DEFAULT_POOL_ID).startswith("pool:{1:")
+        assert v2_api._get_free_pool_name(OTHER_POOL_ID).startswith("pool:{2:")
+        ctx = v2_api.get_pool_number_context(num)
+        assert ctx["request_context"]["sid"] == "migrate"
+        # The keyspace is no longer in the v1 layout
+        assert pool_api.init_pools() is None
+
+        assert v2_api.lease_number(DEFAULT_POOL_ID, dict(sid="migrate")) == num
+        other = v2_api.lease_number(DEFAULT_POOL_ID, dict(sid="migrate-2"))
+        assert other != num
+        assert v2_api._get_taken_numbers(DEFAULT_POOL_ID) == {num, other}
+        v2_api._reset_pool(DEFAULT_POOL_ID)
+        assert v2_api._get_taken_numbers(DEFAULT_POOL_ID) == {num, other}
+    finally:
+        migrate_key_layout(NumberPoolKeyLayouts.V1)
+        monkeypatch.undo()
+        pool_api._reset_pool(DEFAULT_POOL_ID)
+
+    assert pool_api.conn.exists(num)
+    assert pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="migrate-2")) == other
+    assert pool_api.init_pools() is not None
+
+
+def test_pool_context_formats():
+    json_api = NumberPoolAPI(lease_mode=pool_api.lease_mode, context_format="json")
+    hash_api = NumberPoolAPI(lease_mode=pool_api.lease_mode, context_format="hash")
+    json_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+
+    ctx = dict(sid="1234", visits={"1": dict(foo="bar")})
+    num = json_api.lease_number(DEFAULT_POOL_ID, ctx)
+    assert json_api.conn.type(num) == "string"
+    assert hash_api.get_pool_number_context(num)["request_context"] == ctx
+
+    # Renewing in the hash format converts the stored context
+    ctx = dict(sid="1234", visits={"2": dict(foo="baz")})
+    assert hash_api.lease_number(DEFAULT_POOL_ID, ctx, target_number=num, renew=True)
+    assert hash_api.conn.type(num) == "hash"
+    json_ctx = json_api.get_pool_number_context(num)
+    assert json_ctx == hash_api.get_pool_number_context(num)
+    assert set(json_ctx["request_context"]["visits"]) == {"1", "2"}
+    assert (
+        hash_api._get_number_contexts([num], pool_id=DEFAULT_POOL_ID)[num] == json_ctx
+    )
+    assert (
+        json_api._get_number_contexts([num], pool_id=DEFAULT_POOL_ID)[num] == json_ctx
+    )
+
+    # Renewals of hash contexts only write changed fields
+    hash_api.conn.hset(num, "untouched", "1")
+    renewed_at = json_ctx["renewed_at"]
+    hash_api.lease_number(DEFAULT_POOL_ID, dict(sid="1234"), target_number=num)
+    assert hash_api.conn.hget(num, "untouched") == "1"
+    assert hash_api.get_pool_number_context(num)["renewed_at"] > renewed_at
+
+    hash_api.update_number(DEFAULT_POOL_ID, num, dict(sid="1234", foo="bar"))
+    assert hash_api.conn.hget(num, "untouched") == "1"
+    assert hash_api.get_pool_number_context(num)["request_context"]["foo"] == "bar"
+
+    # New leases use the configured format
+    num2 = hash_api.lease_number(DEFAULT_POOL_ID, {})
+    assert hash_api.conn.type(num2) == "hash"
+    assert json_api.get_pool_number_context(num2)["pool_id"] == DEFAULT_POOL_ID
+    json_api.lease_number(DEFAULT_POOL_ID, {}, target_number=num2, renew=True)
+    assert json_api.conn.type(num2) == "string"
+
+
+def test_pool_script_declared_keys():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    ctx = dict(sid="declared")
+    num = pool_api.lease_number(DEFAULT_POOL_ID, ctx)
+    pool_props = pool_api.get_pool_properties(DEFAULT_POOL_ID)
+    shard = pool_api._get_lease_shards(DEFAULT_POOL_ID, pool_props, ctx, num)[0]
+
+    keys, args = pool_api._get_lease_script_params(
+        DEFAULT_POOL_ID,
+        ctx,
+        None,
+        True,
+        [],
+        pool_api.get_cache_expiration(DEFAULT_POOL_ID),
+        pool_props=pool_props,
+        shard=shard,
+    )
+    res = pool_api._lease_number_script(keys=keys, args=args)
+    if pool_api._is_v2_key_layout():
+        # The session's number is returned for the caller to declare
+        assert res[:2] == [LeaseScriptStatus.UNDECLARED, num]
+    else:
+        # v1 keys are derived by the script
+        assert res[:2] == [LeaseScriptStatus.RENEW, num]
+    assert pool_api.lease_number(DEFAULT_POOL_ID, ctx) == num
+
+    # Area codes of the numbers must be declared
+    keys, args = pool_api._get_free_numbers_params(
+        DEFAULT_POOL_ID, "add", numbers=[num], shard=shard
+    )
+    with pytest.raises(redis.exceptions.ResponseError):
+        pool_api._free_numbers_script(keys=keys[:2], args=[args[0], "[]", num])
+    assert not pool_api.conn.sismember(
+        pool_api._get_free_pool_name(DEFAULT_POOL_ID, shard=shard), num
+    )
+
+
+def test_pool_script_lease_round_trips():
+    script_api = NumberPoolAPI(lease_mode=NumberPoolLeaseModes.SCRIPT)
+    script_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    numbers = [
+        script_api.lease_number(DEFAULT_POOL_ID, dict(sid=f"trips-{i}"))
+        for i in range(len(script_api.get_pool_numbers_from_db(DEFAULT_POOL_ID)))
+    ]
+    # Don't count loading the scripts on first use
+    script_api.conn.script_load(script_api._lease_number_script.script)
+    script_api.conn.script_load(script_api._renew_number_script.script)
+    # The v2 layout runs the lease script again to declare the number's keys
+    extra = 1 if script_api._is_v2_key_layout() else 0
+
+    # Renewal of the session's number: the lease and the renewal commit
+    counter = RoundTripCounter()
+    with counter.counting():
+        num = script_api.lease_number(DEFAULT_POOL_ID, dict(sid="trips-0"))
+    assert num == numbers[0]
+    assert counter.count == 2 + extra
+
+    # Taking over the expired number of another session
+    expiration = script_api.get_cache_expiration(DEFAULT_POOL_ID)
+    script_api._set_number_renewed_at(numbers[1], time.time() - 2 * expiration)
+    counter = RoundTripCounter()
+    with counter.counting():
+        num = script_api.lease_number(DEFAULT_POOL_ID, dict(sid="expired"))
+    assert num == numbers[1]
+    assert counter.count == 1 + extra
+    script_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+
+
+def test_pool_script_renewal_conflict():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    ctx = dict(sid="1234", visits={1: dict(foo="bar")})
+    num = pool_api.lease_number(DEFAULT_POOL_ID, ctx)
+
+    ctx = dict(sid="1234", visits={2: dict(baz="bar")})
+    status, number, raw, from_sid, _ = pool_api._run_lease_script(
+        DEFAULT_POOL_ID, ctx, num, True, []
+    )
+    assert status == LeaseScriptStatus.RENEW
+    assert number == num
+
+    # Another writer renews the number before this renewal is committed
+    pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="1234", visits={3: {}}))
+    assert not pool_api._commit_script_renewal(
+        DEFAULT_POOL_ID, num, raw, ctx, from_sid=from_sid
+    )
+
+    # A full lease retries against the latest context
+    assert pool_api.lease_number(DEFAULT_POOL_ID, ctx) == num
+    num_ctx = pool_api.get_pool_number_context(num)
+    assert set(num_ctx["request_context"]["visits"]) == {"1", "2", "3"}
+
+
+def test_pool_free_area_code_index():
+    pool_api._reset_pool(AREA_CODE_POOL_ID, preserve=False)
+    free = pool_api._get_free_numbers(AREA_CODE_POOL_ID)
+    counts = pool_api.get_free_area_code_counts(AREA_CODE_POOL_ID)
+    assert sum(counts.values()) == len(free)
+    assert counts["401"] == 2
+
+    num = pool_api.lease_number(AREA_CODE_POOL_ID, {}, target_area_codes=["401"])
+    counts = pool_api.get_free_area_code_counts(AREA_CODE_POOL_ID)
+    assert counts["401"] == 1
+    assert num not in pool_api.conn.smembers(
+        pool_api._get_free_area_code_pool_name(AREA_CODE_POOL_ID, "401")
+    )
+
+    # Pools that predate the index get it built on reset
+    pool_api.conn.delete(
+        pool_api._get_free_area_code_pool_name(AREA_CODE_POOL_ID, "401"),
+        pool_api._get_free_area_code_counts_name(AREA_CODE_POOL_ID),
+    )
+    pool_api._reset_pool(AREA_CODE_POOL_ID, preserve=True)
+    assert pool_api.get_free_area_code_counts(AREA_CODE_POOL_ID) == counts
+
+
+def test_pool_taken_area_code_index():
+    pool_api._reset_pool(AREA_CODE_POOL_ID, preserve=False)
+    ctx = {}
+    num = pool_api.lease_number(AREA_CODE_POOL_ID, ctx, target_area_codes=["401"])
+    num2 = pool_api.lease_number(AREA_CODE_POOL_ID, ctx, target_area_codes=["401"])
+    taken_401 = pool_api._get_taken_area_code_pool_name(AREA_CODE_POOL_ID, "401")
+    assert set(pool_api.conn.zrange(taken_401, 0, -1)) == {num, num2}
+
+    # Not expired yet, so it falls back to the fallback area code
+    new_num = pool_api.lease_number(AREA_CODE_POOL_ID, ctx, target_area_codes=["401"])
+    assert new_num.startswith("878")
+
+    pool_api._set_number_renewed_at(num2, time.time() - 2e6)  # Should be expired...
+    new_num = pool_api.lease_number(
+        AREA_CODE_POOL_ID, dict(foo="bar"), target_area_codes=["401"]
+    )
+    assert new_num == num2  # Should take the expired number for the area code
+
+    # Pools that predate the index get it built on reset
+    scores = pool_api.conn.zrange(taken_401, 0, -1, withscores=True)
+    pool_api.conn.delete(taken_401)
+    pool_api._reset_pool(AREA_CODE_POOL_ID, preserve=True)
+    assert pool_api.conn.zrange(taken_401, 0, -1, withscores=True) == scores
+
+
+def test_pool_reap_expired_numbers():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    num = pool_api.lease_number(DEFAULT_POOL_ID, {})
+    num2 = pool_api.lease_number(DEFAULT_POOL_ID, {})
+    pool_api._set_number_renewed_at(num, time.time() - 2e6)  # Should be expired...
+
+    assert pool_api.reap_expired_numbers(DEFAULT_POOL_ID, batch_size=1) == 1
+    assert num in pool_api._get_free_numbers(DEFAULT_POOL_ID)
+    assert pool_api._get_taken_numbers(DEFAULT_POOL_ID) == {num2}
+    # Context is kept for call attribution until the number is leased again
+    assert pool_api.get_pool_number_context(num)
+
+    # Expired targets can still be leased after being reaped
+    new_num = pool_api.lease_number(DEFAULT_POOL_ID, {}, target_number=num)
+    assert new_num == num
+    assert pool_api.get_number_status(num)[0] == NumberStatus.TAKEN
+    assert num not in pool_api._get_free_numbers(DEFAULT_POOL_ID)
+
+
+@pytest.fixture
+def snapshot_rows(monkeypatch):
+    """Snapshot rows by (pool_id, number), standing in for the DB table"""
+    rows = {}
+
+    def write_pool_snapshots_to_db(cls, batch):
+        rows.update({(row["pool_id"], row["number"]): row for row in batch})
+
+    def get_pool_snapshots_from_db(cls, pool_id, renewed_since):
+        res = [
+            row
+            for (row_pool_id, _), row in rows.items()
+            if row_pool_id == pool_id and row["renewed_at"] >= renewed_since
+        ]
+        res.sort(key=lambda row: row["renewed_at"])
+        return [(row["number"], row["context"]) for row in res]
+
+    monkeypatch.setattr(
+        NumberPoolAPI,
+        "write_pool_snapshots_to_db",
+        classmethod(write_pool_snapshots_to_db),
+    )
+    monkeypatch.setattr(
+        NumberPoolAPI,
+        "get_pool_snapshots_from_db",
+        classmethod(get_pool_snapshots_from_db),
+    )
+    return rows
+
+
+def test_pool_snapshot_restore(snapshot_rows):
+    rows = snapshot_rows
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    pool_api.conn.delete(pool_api._get_pool_snapshot_key(DEFAULT_POOL_ID))
+    num = pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="snapshot", foo="bar"))
+    assert pool_api.snapshot_pool(DEFAULT_POOL_ID) == 1
+    assert rows[(DEFAULT_POOL_ID, num)]["sid"] == "snapshot"
+    # Only numbers renewed since the last snapshot are written again
+    pool_api._set_number_renewed_at(num, time.time() - 3600)
+    assert pool_api.snapshot_pool(DEFAULT_POOL_ID) == 0
+
+    # Lose the pool state, as on a Redis restart
+    pool_api.conn.delete(
+        pool_api._get_number_key(num, **number_keys()),
+        *pool_api._get_pool_structure_names(DEFAULT_POOL_ID),
+    )
+    pool_api._reset_pool(DEFAULT_POOL_ID)
+    assert num in pool_api._get_free_numbers(DEFAULT_POOL_ID)
+
+    assert pool_api.restore_pool_snapshot(DEFAULT_POOL_ID) == 1
+    assert pool_api._get_taken_numbers(DEFAULT_POOL_ID) == {num}
+    assert num not in pool_api._get_free_numbers(DEFAULT_POOL_ID)
+    ctx = pool_api.get_pool_number_context(num)
+    assert ctx["request_context"]["foo"] == "bar"
+    assert pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="snapshot")) == num
+    # Contexts still in Redis are left alone
+    assert pool_api.restore_pool_snapshot(DEFAULT_POOL_ID) == 0
+
+
+def test_pool_snapshot_confirmed_renewals(set_pool_properties, snapshot_rows):
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    set_pool_properties(renewal_throttle=0.5)
+    snapshot_key = pool_api._get_pool_snapshot_key(DEFAULT_POOL_ID)
+    num = pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="confirm", visits={"1": {}}))
+    # Leased before the last snapshot
+    taken_name = pool_api._get_taken_pool_name(
+        DEFAULT_POOL_ID, shard=pool_api._get_number_shard(DEFAULT_POOL_ID, num)
+    )
+    pool_api.conn.zadd(taken_name, {num: time.time() - 60})
+    pool_api.conn.set(snapshot_key, time.time() - 30)
+    assert pool_api.snapshot_pool(DEFAULT_POOL_ID) == 0
+
+    # A confirmed renewal doesn't change the taken score but is snapshotted
+    ctx = dict(sid="confirm", visits={"2": {}})
+    assert pool_api.lease_number(DEFAULT_POOL_ID, ctx, num, renew=True) == num
+    assert pool_api.conn.llen(pool_api._get_context_updates_key(num, **number_keys()))
+    assert pool_api.snapshot_pool(DEFAULT_POOL_ID) == 1
+    row = json.loads(snapshot_rows[(DEFAULT_POOL_ID, num)]["context"])
+    assert list(row["request_context"]["visits"]) == ["1", "2"]
+
+    # The appended request context survives a restore
+    pool_api.conn.delete(
+        pool_api._get_number_key(num, **number_keys()),
+        pool_api._get_context_updates_key(num, **number_keys()),
+        *pool_api._get_pool_structure_names(DEFAULT_POOL_ID),
+    )
+    pool_api._reset_pool(DEFAULT_POOL_ID)
+    assert pool_api.restore_pool_snapshot(DEFAULT_POOL_ID) == 1
+    ctx = pool_api.get_pool_number_context(num)
+    assert list(ctx["request_context"]["visits"]) == ["1", "2"]
+
+
+def test_pool_reaper_leader_lock():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    num = pool_api.lease_number(DEFAULT_POOL_ID, {})
+    pool_api._set_number_renewed_at(num, time.time() - 2e6)  # Should be expired...
+
+    reaper = NumberPoolReaper(pool_api=pool_api, interval=5)
+    other_reaper = NumberPoolReaper(pool_api=pool_api, interval=5)
+    try:
+        counts = reaper.run_once()
+        assert counts[DEFAULT_POOL_ID] == 1
+        assert other_reaper.run_once() is None  # Not the leader
+        assert reaper.run_once() is not None  # Still the leader
+    finally:
+        reaper.release_leadership()
+    assert other_reaper.run_once() is not None
+    other_reaper.release_leadership()
+
+
+def test_pool_conn_refresh(monkeypatch):
+    monkeypatch.setattr(settings, "REDIS_MAX_CONNECTIONS", 2)
+    conn = get_number_pool_conn(refresh=True)
+    try:
+        pool = conn.connection_pool
+        assert isinstance(pool, redis.BlockingConnectionPool)
+        assert pool.max_connections == 2
+        assert conn.ping()
+        api = NumberPoolAPI()
+        assert api.conn is conn
+        assert api.get_all_pool_stats()
+    finally:
+        monkeypatch.undo()
+        pool_api.refresh_conn()
+
+
+def test_pool_redis_families(monkeypatch):
+    # Database 1 of the number pool instance
+    host = f"{settings.REDIS_HOST}:{settings.REDIS_PORT}"
+    url = f"redis://:{settings.REDIS_PASSWORD}@{host}/1"
+    monkeypatch.setattr(settings, "REDIS_FAMILY_URLS", {RedisFamilies.ROUTES: url})
+    api = NumberPoolAPI()
+    assert api.route_conn is not api.conn
+    assert api.user_context_conn is api.conn
+
+    context = dict(
+        pool_id=DEFAULT_POOL_ID,
+        leased_at=time.time(),
+        renewed_at=time.time(),
+        request_context=dict(sid="1234"),
+    )
+    key = api.get_cached_route_key("5551230000", "5551237777")
+    try:
+        api.set_cached_route_context("5551230000", "5551237777", context)
+        assert api.route_conn.exists(key)
+        assert not api.conn.exists(key)
+        assert api.get_cached_route_context("5551230000", "5551237777")
+
+        assert get_key_family(key) == RedisFamilies.ROUTES
+        assert get_key_family("phone:5551230000") == RedisFamilies.USER_CONTEXTS
+        assert get_key_family("geoip:area_codes:1.2.3.4") == RedisFamilies.GEOIP
+        assert get_key_family("static:5551237777") == RedisFamilies.POOL
+
+        report = get_memory_report(sample=2)
+        assert len(report) == 2
+        routes = [x for x in report if RedisFamilies.ROUTES in x["families"]][0]
+        assert routes["keys"][RedisFamilies.ROUTES]["keys"] >= 1
+        assert routes["keys"][RedisFamilies.ROUTES]["bytes"] > 0
+    finally:
+        api.route_conn.delete(key)
+
+
+def test_pool_call_contexts():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    num = pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="call-sid"))
+    pool_api.set_user_context("phone", "5551230001", dict(zip="02903"))
+    pool_api.set_user_context("sid", "call-sid", dict(a=1))
+
+    counter = RoundTripCounter()
+    with counter.counting():
+        contexts = pool_api.get_call_contexts("5551230001", num)
+    assert counter.count == 1
+    # Untagged keys are in different cluster slots, so only single-key reads
+    for pipeline, _ in pool_api._queue_call_context_reads("5551230001", num):
+        for args, _ in pipeline.command_stack:
+            assert args[0] in ("GET", "HGETALL", "LRANGE")
+    assert contexts["pool"]["request_context"]["sid"] == "call-sid"
+    assert contexts["route"] is None
+    assert contexts["user"] == dict(zip="02903")
+    assert contexts["static"] is None
+
+    ctx = contexts["pool"]
+    sid_ctx = pool_api._merge_user_context(
+        pool_api.get_user_context("sid", "call-sid"), dict(b=2)
+    )
+    counter = RoundTripCounter()
+    with counter.counting():
+        distinct_callers = pool_api.write_call_contexts(
+            "5551230001", num, ctx, user_contexts=[("sid", "call-sid", sid_ctx)]
+        )
+    assert counter.count == 1
+    assert distinct_callers == 1
+    assert pool_api.get_user_context("sid", "call-sid") == dict(a=1, b=2)
+    assert pool_api.get_cached_route_context("5551230001", num) == ctx
+    assert pool_api.get_call_contexts("5551230001", num)["route"] == ctx
+
+    # The keys are in different cluster slots, so none share a command or MULTI
+    for pipeline, _ in pool_api._queue_call_context_reads("5551230001", num):
+        assert all(args[0] != "MGET" for args, _ in pipeline.command_stack)
+    pipelines, _ = pool_api._queue_call_context_writes("5551230001", num, ctx)
+    assert not any(pipeline.transaction for pipeline in pipelines)
+
+    # Anonymous callers have no route or phone user contexts
+    contexts = pool_api.get_call_contexts("anonymous", num)
+    assert contexts["pool"] == ctx
+    assert contexts["route"] is None and contexts["user"] is None
+    assert pool_api.write_call_contexts("anonymous", num, ctx) == 2
+    pool_api.remove_user_context("phone", "5551230001")
+    pool_api.remove_user_context("sid", "call-sid")
+
+
+def test_pool_batched_round_trips():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    results = benchmark_pool(pool_api, DEFAULT_POOL_ID, 2)
+    pp(results)
+    # Removing and re-adding numbers must not cost a round trip per number
+    assert (
+        results["reset"]["round_trips"]
+        < len(pool_api.get_pool_numbers_from_db(DEFAULT_POOL_ID)) + 5
+    )
+    if pool_api.lease_mode == NumberPoolLeaseModes.SCRIPT:
+        assert results["lease"]["round_trips"] == 1
@@ -0,0 +1,98 @@
+import asyncio
+
+from app.number_pool import NumberPoolAPI, NumberPoolLeaseModes, NumberStatus
+from app.number_pool_async import AsyncNumberPoolAPI, close_async_number_pool_conn
+
+
+pool_api = NumberPoolAPI()
+pool_api.init_pools()
+
+DEFAULT_POOL_ID = 1
+AREA_CODE_POOL_ID = 3
+
+
+def run(coro):
+    async def _run():
+        try:
+            return await coro
+        finally:
+            # Connections are bound to the event loop of each asyncio.run
+            await close_async_number_pool_conn()
+
+    return asyncio.run(_run())
+
+
+def test_async_pool_lease_number():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    async_pool_api = AsyncNumberPoolAPI()
+    num = run(async_pool_api.lease_number(DEFAULT_POOL_ID, {}))
+    assert num
+    new_num = run(
+        async_pool_api.lease_number(DEFAULT_POOL_ID, {}, target_number=num, renew=True)
+    )
+    assert num == new_num  # Should renew the number
+    status, _ = pool_api.get_number_status(num)
+    assert status == NumberStatus.TAKEN
+
+
+def test_async_pool_lock_lease_mode():
+    pool_api._reset_pool(AREA_CODE_POOL_ID, preserve=False)
+    async_pool_api = AsyncNumberPoolAPI(lease_mode=NumberPoolLeaseModes.LOCK)
+    ctx = dict(sid="async-lock-sid")
+    num = run(
+        async_pool_api.lease_number(AREA_CODE_POOL_ID, ctx, target_area_codes=["401"])
+    )
+    assert num.startswith("401")
+    # Session number is renewed instead of leasing another one
+    new_num = run(
+        async_pool_api.lease_number(AREA_CODE_POOL_ID, ctx, target_area_codes=["339"])
+    )
+    assert num == new_num
+
+    res = run(
+        async_pool_api.update_number(
+            AREA_CODE_POOL_ID, num, dict(sid="async-lock-sid", foo="bar"), merge=True
+        )
+    )
+    assert res["request_context"]["foo"] == "bar"
+    assert pool_api.get_pool_number_context(num)["request_context"]["foo"] == "bar"
+
+
+def test_async_pool_user_context():
+    async_pool_api = AsyncNumberPoolAPI()
+    run(async_pool_api.set_user_context("sid", "async-sid", dict(a=1)))
+    ctx = run(async_pool_api.update_user_context("sid", "async-sid", dict(b=2)))
+    assert ctx == dict(a=1, b=2)
+    assert pool_api.get_user_context("sid", "async-sid") == ctx
+    run(async_pool_api.remove_user_context("sid", "async-sid"))
+    assert run(async_pool_api.get_user_context("sid", "async-sid")) is None
+
+
+def test_async_pool_call_contexts():
+    pool_api._reset_pool(DEFAULT_POOL_ID, preserve=False)
+    async_pool_api = AsyncNumberPoolAPI()
+    num = pool_api.lease_number(DEFAULT_POOL_ID, dict(sid="async-call-sid"))
+    pool_api.set_static_number_context("5559990000", dict(campaign="static"))
+
+    contexts = run(async_pool_api.get_call_contexts("5551230002", num))
+    assert contexts["pool"]["request_context"]["sid"] == "async-call-sid"
+    assert contexts["route"] is None
+
+    ctx = contexts["pool"]
+    distinct_callers = run(
+        async_pool_api.write_call_contexts(
+            "5551230002",
+            num,
+            ctx,
+            user_contexts=[("sid", "async-call-sid", dict(a=1))],
+        )
+    )
+    assert distinct_callers == 1
+    contexts = run(async_pool_api.get_call_contexts("5551230002", num))
+    assert contexts["route"] == ctx
+    assert pool_api.get_user_context("sid", "async-call-sid") == dict(a=1)
+
+    contexts = run(async_pool_api.get_call_contexts("5551230002", "5559990000"))
+    assert contexts["pool"] is None
+    assert contexts["static"] == dict(campaign="static")
+    pool_api.remove_user_context("sid", "async-call-sid")
@@ -0,0 +1,106 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from app import track_call_queue
+from app.number_pool import NumberPoolResponseStatus
+from app.number_pool_async import (
+    close_async_number_pool_conn,
+    get_async_number_pool_conn,
+)
+from app.track_call_queue import (
+    TRACK_CALL_PENDING,
+    TRACK_CALL_STREAM,
+    TrackCallWorker,
+    enqueue_track_call,
+    get_track_call_result,
+    get_track_call_result_key,
+)
+
+
+def run(coro):
+    async def _run():
+        try:
+            return await coro
+        finally:
+            # Connections are bound to the event loop of each asyncio.run
+            await close_async_number_pool_conn()
+
+    return asyncio.run(_run())
+
+
+def test_track_call_queue(monkeypatch):
+    saved = []
+    failures = []
+
+    async def save_track_call(conn, call_id, call_from, call_to, ctx, from_route_cache):
+        if failures:
+            failures.pop()
+            raise Exception("Simulated database failure")
+        saved.append((call_id, ctx, from_route_cache))
+
+    class Connection:
+        async def fetch_one(self, query):
+            return None
+
+    class Database:
+        @asynccontextmanager
+        async def connection(self):
+            yield Connection()
+
+    monkeypatch.setattr(track_call_queue, "save_track_call", save_track_call)
+    monkeypatch.setattr(track_call_queue, "database", Database())
+
+    async def _test():
+        conn = get_async_number_pool_conn()
+        await conn.delete(TRACK_CALL_STREAM)
+        for call_id in ("queued-call", "queued-static-call"):
+            await conn.delete(get_track_call_result_key(call_id))
+
+        ctx = dict(request_context=dict(sid="queued-sid"), stir_validation="A")
+        await enqueue_track_call(
+            conn, "queued-call", "5551230000", "5550000001", ctx, from_route_cache=True
+        )
+        await enqueue_track_call(
+            conn,
+            "queued-static-call",
+            "5551230000",
+            "5550000002",
+            dict(static_context=dict(foo="bar")),
+            user_ctx=dict(zip="02903"),
+            record=False,
+        )
+        assert (
+            await get_track_call_result(conn, None, "queued-call") == TRACK_CALL_PENDING
+        )
+
+        worker = TrackCallWorker(redis_conn=conn, consumer="test", block_ms=10)
+        # A failed job stays pending to be retried
+        failures.append(True)
+        assert await worker.run_once() == 1
+        assert not saved
+        assert (
+            await get_track_call_result(conn, None, "queued-call") == TRACK_CALL_PENDING
+        )
+        pending = await conn.xpending(
+            TRACK_CALL_STREAM, track_call_queue.TRACK_CALL_GROUP
+        )
+        assert pending["pending"] == 1
+
+        monkeypatch.setattr(track_call_queue, "TRACK_CALL_JOB_CLAIM_IDLE_MS", 0)
+        assert await worker.run_once() == 1
+        assert saved == [("queued-call", ctx, True)]
+        pending = await conn.xpending(
+            TRACK_CALL_STREAM, track_call_queue.TRACK_CALL_GROUP
+        )
+        assert pending["pending"] == 0
+
+        res = await get_track_call_result(conn, None, "queued-call")
+        assert res["status"] == NumberPoolResponseStatus.SUCCESS
+        assert res["msg"]["request_context"]["sid"] == "queued-sid"
+        assert "stir_validation" not in res["msg"]
+
+        res = await get_track_call_result(conn, None, "queued-static-call")
+        assert res["msg"]["static_context"] == dict(foo="bar")
+        assert res["msg"]["user_context"] == dict(zip="02903")
+
+    run(_test())
@@ -1,8 +1,19 @@
+import asyncio
 import json
 
+import httpx
+import pytest
+
 from app import trestle
 
 
+@pytest.fixture(autouse=True)
+def reset_trestle_circuit_breaker():
+    trestle.TRESTLE_CIRCUIT_BREAKER.reset()
+    yield
+    trestle.TRESTLE_CIRCUIT_BREAKER.reset()
+
+
 class FakeCache:
     def __init__(self):
         self.storage = {}
@@ -15,6 +26,10 @@ class FakeCache:
         self.storage[key] = value
         self.expirations[key] = ex
 
+    def execute_command(self, command, *args, **options):
+        # Cached values are read with GET and NEVER_DECODE, see get_encoded
+        return getattr(self, command.lower())(*args)
+
 
 class FakeResponse:
     def raise_for_status(self):
@@ -118,6 +133,150 @@ def test_get_trestle_zip_uses_cached_normalized_result(monkeypatch):
     assert json.loads(cache.storage[cache_key]) == EXPECTED_TRESTLE_DATA
 
 
+class FakeAsyncCache(FakeCache):
+    async def get(self, key):
+        return super().get(key)
+
+    async def set(self, key, value, ex=None, nx=False, px=None):
+        if nx and key in self.storage:
+            return None
+        super().set(key, value, ex=ex or px)
+        return True
+
+    async def delete(self, key):
+        self.storage.pop(key, None)
+
+    async def exists(self, key):
+        return int(key in self.storage)
+
+
+def test_get_trestle_lookup_async_uses_pooled_client(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if request.url.params["phone"] == "14015550199":
+            return httpx.Response(503)
+        return httpx.Response(200, json=FakeResponse().json())
+
+    cache = FakeAsyncCache()
+
+    async def _test():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(trestle, "get_trestle_client", lambda: client)
+        try:
+            first = await trestle.get_trestle_enrichment_async(
+                "14015550100", "02903", "401", "secret", cache
+            )
+            second = await trestle.get_trestle_lookup_async(
+                "14015550100", "secret", cache
+            )
+            failed = await trestle.get_trestle_lookup_async(
+                "14015550199", "secret", cache
+            )
+        finally:
+            await client.aclose()
+        return first, second, failed
+
+    first, second, failed = asyncio.run(_test())
+    assert len(calls) == 2
+    assert calls[0].headers["x-api-key"] == "secret"
+    assert first["data"] == EXPECTED_TRESTLE_DATA
+    assert first["from_cache"] is False
+    assert first["trusted_zip"] == "02903"
+    assert first["trust_reason"] == "exact_from_zip"
+    assert second["from_cache"] is True
+    assert second["data"] == EXPECTED_TRESTLE_DATA
+    assert failed["status"] == "http_error"
+    assert f"{trestle.TRESTLE_CACHE_KEY_PREFIX}:14015550199" not in cache.storage
+
+
+def test_get_trestle_lookup_async_coalesces_concurrent_lookups(monkeypatch):
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json=FakeResponse().json())
+
+    cache = FakeAsyncCache()
+    cache_key = f"{trestle.TRESTLE_CACHE_KEY_PREFIX}:14015550100"
+
+    async def fill_cache():
+        # Another worker holding the marker caches the result
+        await asyncio.sleep(0.05)
+        await cache.set(cache_key, json.dumps(EXPECTED_TRESTLE_DATA))
+        await cache.delete(f"{cache_key}:in_flight")
+
+    async def _test():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(trestle, "get_trestle_client", lambda: client)
+        try:
+            coalesced = await asyncio.gather(
+                *[
+                    trestle.get_trestle_lookup_async("14015550101", "secret", cache)
+                    for _ in range(3)
+                ]
+            )
+            await cache.set(f"{cache_key}:in_flight", 1, nx=True)
+            waited, _ = await asyncio.gather(
+                trestle.get_trestle_lookup_async("14015550100", "secret", cache),
+                fill_cache(),
+            )
+        finally:
+            await client.aclose()
+        return coalesced, waited
+
+    coalesced, waited = asyncio.run(_test())
+    assert len(calls) == 1
+    assert all(res["data"] == EXPECTED_TRESTLE_DATA for res in coalesced)
+    assert f"{trestle.TRESTLE_CACHE_KEY_PREFIX}:14015550101:in_flight" not in (
+        cache.storage
+    )
+    assert waited["data"] == EXPECTED_TRESTLE_DATA
+    assert waited["from_cache"] is True
+
+
+def test_get_trestle_lookup_async_times_out(monkeypatch):
+    async def handler(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200, json=FakeResponse().json())
+
+    async def _test():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(trestle, "get_trestle_client", lambda: client)
+        try:
+            return await trestle.get_trestle_lookup_async(
+                "14015550100", "secret", timeout=0.01
+            )
+        finally:
+            await client.aclose()
+
+    res = asyncio.run(_test())
+    assert res["status"] == "timeout"
+    assert res["data"] is None
+
+
+def test_get_trestle_lookup_skips_requests_while_circuit_is_open(monkeypatch):
+    calls = []
+
+    def fake_get(url, headers, params, timeout):
+        calls.append(timeout)
+        raise trestle.requests.ConnectionError("connection refused")
+
+    monkeypatch.setattr(trestle.requests, "get", fake_get)
+    breaker = trestle.TRESTLE_CIRCUIT_BREAKER
+    for i in range(breaker.min_calls):
+        res = trestle.get_trestle_lookup(f"401555{i:04d}", "secret")
+        assert res["status"] == "request_error"
+
+    assert breaker.state == "open"
+    res = trestle.get_trestle_lookup("4015559999", "secret")
+    assert res["status"] == "circuit_open"
+    assert len(calls) == breaker.min_calls
+    assert all(timeout == trestle.TRESTLE_REQUEST_TIMEOUT for timeout in calls)
+
+
 def test_filter_trestle_response_keeps_only_allowed_fields():
     assert (
         trestle.filter_trestle_response(FakeResponse().json()) == EXPECTED_TRESTLE_DATA
@@ -0,0 +1,416 @@
+"""Deferred Trestle enrichment and persistence for /track_call.
+
+Without TRACK_CALL_QUEUE_ENABLED, track_call waits on the Trestle lookup and
+the call_enrichment and track_call writes before it responds. With it,
+track_call responds as soon as the number pool lookups are done and queues the
+rest as a job on a Redis stream. Workers in a consumer group drain the stream
+and store the final context of each call under its call_id, where
+/track_call_result can fetch it.
+
+The stream lives on the number pool instance, which must not evict keys. Jobs
+stay pending until a worker acks them, so the jobs of a worker that dies are
+claimed by another one after TRACK_CALL_JOB_CLAIM_IDLE_MS, and dropped after
+TRACK_CALL_JOB_MAX_DELIVERIES.
+
+Workers run as asyncio tasks in the app lifespan when TRACK_CALL_QUEUE_ENABLED
+is set, or standalone with:
+
+    python -m app.track_call_queue
+"""
+
+import asyncio
+import os
+import socket
+
+import rollbar
+from redis.exceptions import ResponseError
+from sqlalchemy import func, insert, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from tlbx import json, info, warn, error
+
+from app import models
+from app.core.config import settings
+from app.db.redis_session import RedisFamilies
+from app.db.session import database
+from app.number_pool import (
+    NumberPoolResponseMessages,
+    NumberPoolResponseStatus,
+)
+from app.number_pool_async import (
+    get_async_number_pool_conn,
+    get_async_redis_family_conn,
+)
+from app.trestle import close_trestle_client, get_trestle_enrichment_async
+from app.utils import rgetkey
+
+MINUTES = 60
+DAYS = 24 * 60 * MINUTES
+
+TRACK_CALL_STREAM = "track_call:jobs"
+TRACK_CALL_GROUP = "track_call_workers"
+# Approximate cap on the stream length. Entries are trimmed oldest first, so
+# keep it well above any backlog the workers could build up.
+TRACK_CALL_STREAM_MAXLEN = 100000
+TRACK_CALL_RESULT_KEY_PREFIX = "track_call:result"
+TRACK_CALL_RESULT_EXPIRATION = 2 * DAYS
+TRACK_CALL_WORKER_BATCH_SIZE = 10
+# Must stay below REDIS_SOCKET_TIMEOUT
+TRACK_CALL_WORKER_BLOCK_MS = 1000
+TRACK_CALL_JOB_CLAIM_IDLE_MS = 1 * MINUTES * 1000
+TRACK_CALL_JOB_MAX_DELIVERIES = 5
+TRACK_CALL_WORKER_RETRY_INTERVAL = 5
+TRACK_CALL_PENDING = "pending"
+
+
+async def save_call_enrichment(conn, call_id, call_from, call_to, from_zip, enrichment):
+    trestle_data = enrichment.get("data")
+    values = dict(
+        call_id=call_id,
+        call_from=call_from,
+        call_to=call_to,
+        status=enrichment["status"],
+        from_zip=from_zip,
+        trusted_zip=enrichment.get("trusted_zip"),
+        trust_reason=enrichment.get("trust_reason"),
+        properties=(json.dumps({"trestle": trestle_data}) if trestle_data else None),
+        latency_ms=enrichment.get("latency_ms"),
+        from_cache=bool(enrichment.get("from_cache", False)),
+    )
+    stmt = mysql_insert(models.CallEnrichment).values(**values)
+    stmt = stmt.on_duplicate_key_update(
+        call_from=values["call_from"],
+        call_to=values["call_to"],
+        status=values["status"],
+        from_zip=values["from_zip"],
+        trusted_zip=values["trusted_zip"],
+        trust_reason=values["trust_reason"],
+        properties=values["properties"],
+        latency_ms=values["latency_ms"],
+        from_cache=values["from_cache"],
+        updated_at=func.now(),
+    )
+    try:
+        await conn.execute(query=stmt)
+    except Exception as e:
+        warn(f"Failed to save call enrichment for {call_id}: {str(e)}")
+
+
+async def add_trestle_enrichment(
+    user_ctx,
+    ctx,
+    call_id,
+    call_from,
+    call_to,
+    from_zip,
+    user_area_code,
+    cache_conn,
+    conn,
+):
+    if not settings.TRESTLE_API_KEY:
+        return user_ctx
+
+    existing_user_ctx = user_ctx or (ctx or {}).get("user_context", {})
+    user_zip = None
+    if existing_user_ctx and settings.USER_CONTEXT_ZIP_KEY:
+        user_zip = rgetkey(existing_user_ctx, settings.USER_CONTEXT_ZIP_KEY, None)
+
+    latest_ctx = (ctx or {}).get("request_context", {}).get("latest_context", {})
+    pool_zip = None
+    if latest_ctx and settings.POOL_CONTEXT_ZIP_KEY:
+        pool_zip = rgetkey(latest_ctx, settings.POOL_CONTEXT_ZIP_KEY, None)
+
+    if user_zip or pool_zip:
+        return user_ctx
+
+    try:
+        enrichment = await get_trestle_enrichment_async(
+            call_from,
+            from_zip,
+            user_area_code,
+            settings.TRESTLE_API_KEY,
+            cache_conn,
+        )
+    except Exception as e:
+        warn(f"Trestle caller ZIP enrichment failed for {call_from}: {str(e)}")
+        enrichment = dict(
+            data=None,
+            status="internal_error",
+            trusted_zip=None,
+            trust_reason="not_applicable",
+            latency_ms=None,
+            from_cache=False,
+        )
+
+    await save_call_enrichment(conn, call_id, call_from, call_to, from_zip, enrichment)
+
+    trestle_data = enrichment.get("data")
+    trestle_zip = enrichment.get("trusted_zip")
+    if trestle_data:
+        ctx["trestle"] = trestle_data
+
+    if not (trestle_zip and settings.USER_CONTEXT_TRESTLE_ZIP_KEY):
+        return user_ctx
+
+    user_ctx = dict(user_ctx or {})
+    user_ctx[settings.USER_CONTEXT_TRESTLE_ZIP_KEY] = trestle_zip
+    return user_ctx
+
+
+async def save_track_call(conn, call_id, call_from, call_to, ctx, from_route_cache):
+    insert_stmt = insert(models.TrackCall).values(
+        call_id=call_id,
+        sid=ctx.get("request_context", {}).get("sid", None),
+        call_from=call_from,
+        call_to=call_to,
+        number_context=json.dumps(ctx),
+        from_route_cache=from_route_cache,
+    )
+    await conn.execute(query=insert_stmt)
+
+
+def get_track_call_response(ctx):
+    response_ctx = ctx.copy()
+    response_ctx.pop("stir_validation", None)
+    return dict(status=NumberPoolResponseStatus.SUCCESS, msg=response_ctx)
+
+
+def get_track_call_result_key(call_id):
+    return f"{TRACK_CALL_RESULT_KEY_PREFIX}:{call_id}"
+
+
+async def enqueue_track_call(
+    redis_conn,
+    call_id,
+    call_from,
+    call_to,
+    ctx,
+    user_ctx=None,
+    from_zip=None,
+    user_area_code=None,
+    from_route_cache=False,
+    record=True,
+):
+    """Queue the enrichment of a call, and its track_call record if record is
+    set. The result is pending until a worker stores the final context."""
+    job = dict(
+        call_id=call_id,
+        call_from=call_from,
+        call_to=call_to,
+        context=ctx,
+        user_context=user_ctx,
+        from_zip=from_zip,
+        user_area_code=user_area_code,
+        from_route_cache=from_route_cache,
+        record=record,
+    )
+    pipeline = redis_conn.pipeline()
+    pipeline.set(
+        get_track_call_result_key(call_id),
+        TRACK_CALL_PENDING,
+        ex=TRACK_CALL_RESULT_EXPIRATION,
+    )
+    pipeline.xadd(
+        TRACK_CALL_STREAM,
+        dict(job=json.dumps(job)),
+        maxlen=TRACK_CALL_STREAM_MAXLEN,
+        approximate=True,
+    )
+    await pipeline.execute()
+
+
+async def get_track_call_result(redis_conn, conn, call_id):
+    """Get the track_call response for a call, falling back to its track_call
+    record once the stored result has expired. Returns None if the call is
+    unknown, or TRACK_CALL_PENDING if its job has not been processed yet."""
+    res = await redis_conn.get(get_track_call_result_key(call_id))
+    if res == TRACK_CALL_PENDING:
+        return res
+    if res:
+        return json.loads(res)
+
+    query = (
+        select(models.TrackCall.number_context)
+        .where(models.TrackCall.call_id == call_id)
+        .order_by(models.TrackCall.id.desc())
+        .limit(1)
+    )
+    row = await conn.fetch_one(query=query)
+    if not (row and row[0]):
+        return None
+    return get_track_call_response(json.loads(row[0]))
+
+
+async def process_track_call(conn, job, retry=False):
+    """Enrich a queued call and save its track_call record. Returns the final
+    track_call response."""
+    ctx = job["context"]
+    user_ctx = await add_trestle_enrichment(
+        job["user_context"],
+        ctx,
+        job["call_id"],
+        job["call_from"],
+        job["call_to"],
+        job["from_zip"],
+        job["user_area_code"],
+        get_async_redis_family_conn(RedisFamilies.TRESTLE),
+        conn,
+    )
+    if user_ctx:
+        ctx["user_context"] = user_ctx
+    if not job["record"]:
+        return dict(status=NumberPoolResponseStatus.SUCCESS, msg=ctx)
+
+    if retry:
+        # The record may have been saved by a worker that died before acking
+        query = select(models.TrackCall.id).where(
+            models.TrackCall.call_id == job["call_id"]
+        )
+        if await conn.fetch_one(query=query):
+            return get_track_call_response(ctx)
+    await save_track_call(
+        conn,
+        job["call_id"],
+        job["call_from"],
+        job["call_to"],
+        ctx,
+        job["from_route_cache"],
+    )
+    return get_track_call_response(ctx)
+
+
+class TrackCallWorker:
+    """Drain the track_call job stream as one consumer of the worker group.
+
+    New jobs are read with a blocking XREADGROUP. Each run also claims jobs
+    left pending by other consumers for longer than the claim idle time.
+    """
+
+    def __init__(
+        self,
+        redis_conn=None,
+        consumer=None,
+        batch_size=TRACK_CALL_WORKER_BATCH_SIZE,
+        block_ms=TRACK_CALL_WORKER_BLOCK_MS,
+    ):
+        self.redis_conn = redis_conn or get_async_number_pool_conn()
+        self.consumer = consumer or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self._group_created = False
+
+    async def create_group(self):
+        if self._group_created:
+            return
+        try:
+            await self.redis_conn.xgroup_create(
+                TRACK_CALL_STREAM, TRACK_CALL_GROUP, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_created = True
+
+    async def _get_deliveries(self, entry_id):
+        pending = await self.redis_conn.xpending_range(
+            TRACK_CALL_STREAM,
+            TRACK_CALL_GROUP,
+            min=entry_id,
+            max=entry_id,
+            count=1,
+        )
+        return pending[0]["times_delivered"] if pending else 1
+
+    async def _store_result(self, call_id, res):
+        await self.redis_conn.set(
+            get_track_call_result_key(call_id),
+            json.dumps(res),
+            ex=TRACK_CALL_RESULT_EXPIRATION,
+        )
+
+    async def process_entry(self, entry_id, fields, claimed=False):
+        """Process one stream entry and ack it, unless it failed and may be
+        retried. Returns True if the job was processed."""
+        job = json.loads(fields["job"])
+        deliveries = await self._get_deliveries(entry_id) if claimed else 1
+        try:
+            async with database.connection() as conn:
+                res = await process_track_call(conn, job, retry=claimed)
+        except Exception as e:
+            error(f"Failed to process track_call job for {job['call_id']}: {e}")
+            rollbar.report_exc_info()
+            if deliveries < TRACK_CALL_JOB_MAX_DELIVERIES:
+                return False
+            warn(f"Dropping track_call job for {job['call_id']}")
+            res = dict(
+                status=NumberPoolResponseStatus.ERROR,
+                msg=NumberPoolResponseMessages.INTERNAL_ERROR,
+            )
+        await self._store_result(job["call_id"], res)
+        await self.redis_conn.xack(TRACK_CALL_STREAM, TRACK_CALL_GROUP, entry_id)
+        return True
+
+    async def run_once(self):
+        """Process claimed and new jobs. Returns the number processed."""
+        await self.create_group()
+        count = 0
+        claimed = await self.redis_conn.xautoclaim(
+            TRACK_CALL_STREAM,
+            TRACK_CALL_GROUP,
+            self.consumer,
+            TRACK_CALL_JOB_CLAIM_IDLE_MS,
+            count=self.batch_size,
+        )
+        for entry_id, fields in claimed[1]:
+            if fields:
+                count += await self.process_entry(entry_id, fields, claimed=True)
+
+        res = await self.redis_conn.xreadgroup(
+            TRACK_CALL_GROUP,
+            self.consumer,
+            {TRACK_CALL_STREAM: ">"},
+            count=self.batch_size,
+            block=self.block_ms,
+        )
+        for _, entries in res or []:
+            for entry_id, fields in entries:
+                count += await self.process_entry(entry_id, fields)
+        return count
+
+    async def run(self):
+        info(f"Starting track_call worker {self.consumer}")
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error(f"track_call worker failed: {e}")
+                rollbar.report_exc_info()
+                await asyncio.sleep(TRACK_CALL_WORKER_RETRY_INTERVAL)
+
+
+async def run_workers(count=None):
+    count = count or settings.TRACK_CALL_QUEUE_WORKERS
+    hostname = f"{socket.gethostname()}:{os.getpid()}"
+    await asyncio.gather(
+        *[TrackCallWorker(consumer=f"{hostname}:{i}").run() for i in range(count)]
+    )
+
+
+async def _main():
+    await database.connect()
+    try:
+        await run_workers()
+    finally:
+        await close_trestle_client()
+        await database.disconnect()
+
+
+def main():
+    if settings.ROLLBAR_ENABLED:
+        rollbar.init(settings.ROLLBAR_KEY, environment=settings.ROLLBAR_ENV)
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
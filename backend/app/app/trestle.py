@@ -1,22 +1,52 @@
-import json
+import asyncio
 import re
 import time
 
+import httpx
 import requests
 from tlbx import warn, st
 
+from app.circuit_breaker import CircuitBreaker
+from app.core.config import settings
+from app.db.redis_codec import get_encoded, redis_codec
 from app.geo import zip_to_area_code_distance, zip_to_zip_distance
+from app.single_flight import (
+    AsyncSingleFlight,
+    claim_in_flight_async,
+    release_in_flight_async,
+    wait_in_flight_async,
+)
 
 
 TRESTLE_API_URL = "https://api.trestleiq.com/3.1/caller_id"
-TRESTLE_REQUEST_TIMEOUT = 1.0
+# Default deadline for a whole lookup, including the wait for a pooled
+# connection with the async client
+TRESTLE_REQUEST_TIMEOUT = settings.TRESTLE_REQUEST_TIMEOUT
+# Floor of the adaptive timeout, see CircuitBreaker
+TRESTLE_MIN_TIMEOUT = min(0.2, TRESTLE_REQUEST_TIMEOUT)
+TRESTLE_KEEPALIVE_EXPIRY = 60
 TRESTLE_CACHE_TTL_SECONDS = 14 * 24 * 60 * 60
 TRESTLE_CACHE_KEY_PREFIX = "trestle:caller"
 TRESTLE_FROM_ZIP_DISTANCE_LIMIT_MILES = 25
 TRESTLE_AREA_CODE_DISTANCE_LIMIT_MILES = 50
 TRESTLE_AREA_CODE_ONLY_DISTANCE_LIMIT_MILES = 25
 
+# Lookup statuses that count against the circuit breaker
+TRESTLE_FAILURE_STATUSES = {
+    "timeout",
+    "http_error",
+    "request_error",
+    "invalid_response",
+}
+
 _CACHE_MISS = object()
+_TRESTLE_CLIENT = None
+_TRESTLE_LOOKUPS = AsyncSingleFlight()
+TRESTLE_CIRCUIT_BREAKER = CircuitBreaker(
+    "trestle",
+    max_timeout=TRESTLE_REQUEST_TIMEOUT,
+    min_timeout=TRESTLE_MIN_TIMEOUT,
+)
 
 TRESTLE_BELONGS_TO_KEYS = {
     "age_range",
@@ -80,15 +110,81 @@ def filter_trestle_response(data):
     return filtered or None
 
 
+def get_trestle_client():
+    """The shared async client. Lookups reuse its kept-alive connections, and
+    wait for one once TRESTLE_MAX_CONNECTIONS are in use."""
+    global _TRESTLE_CLIENT
+
+    if not _TRESTLE_CLIENT:
+        _TRESTLE_CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.TRESTLE_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.TRESTLE_MAX_CONNECTIONS,
+                keepalive_expiry=TRESTLE_KEEPALIVE_EXPIRY,
+            ),
+            timeout=TRESTLE_REQUEST_TIMEOUT,
+        )
+    return _TRESTLE_CLIENT
+
+
+async def close_trestle_client():
+    """Close the pooled connections, which are bound to the running event
+    loop. A new client is created on next use."""
+    global _TRESTLE_CLIENT
+
+    if _TRESTLE_CLIENT:
+        await _TRESTLE_CLIENT.aclose()
+        _TRESTLE_CLIENT = None
+
+
+def _normalize_phone_number(phone_number):
+    return "".join(ch for ch in str(phone_number) if ch.isdigit())
+
+
+def _get_trestle_cache_key(phone_number):
+    return f"{TRESTLE_CACHE_KEY_PREFIX}:{phone_number}"
+
+
+def _get_lookup_result(start, data, status, from_cache=False):
+    return dict(
+        data=data,
+        status=status,
+        latency_ms=round((time.perf_counter() - start) * 1000),
+        from_cache=from_cache,
+    )
+
+
+def _get_cached_lookup_result(start, cached_data):
+    return _get_lookup_result(
+        start, cached_data, "success" if cached_data else "no_result", from_cache=True
+    )
+
+
+def _parse_cached_trestle_data(value):
+    if value is None:
+        return _CACHE_MISS
+    return redis_codec.loads(value) or None
+
+
 def _get_cached_trestle_data(cache_conn, phone_number):
     if not cache_conn:
         return _CACHE_MISS
 
     try:
-        value = cache_conn.get(f"{TRESTLE_CACHE_KEY_PREFIX}:{phone_number}")
-        if value is None:
-            return _CACHE_MISS
-        return json.loads(value) or None
+        value = get_encoded(cache_conn, _get_trestle_cache_key(phone_number))
+        return _parse_cached_trestle_data(value)
+    except Exception as e:
+        warn(f"Failed to read Trestle caller cache: {str(e)}")
+        return _CACHE_MISS
+
+
+async def _get_cached_trestle_data_async(cache_conn, phone_number):
+    if not cache_conn:
+        return _CACHE_MISS
+
+    try:
+        value = await get_encoded(cache_conn, _get_trestle_cache_key(phone_number))
+        return _parse_cached_trestle_data(value)
     except Exception as e:
         warn(f"Failed to read Trestle caller cache: {str(e)}")
         return _CACHE_MISS
@@ -100,50 +196,61 @@ def _set_cached_trestle_data(cache_conn, phone_number, data):
 
     try:
         cache_conn.set(
-            f"{TRESTLE_CACHE_KEY_PREFIX}:{phone_number}",
-            json.dumps(data or {}),
+            _get_trestle_cache_key(phone_number),
+            redis_codec.dumps(data or {}),
             ex=TRESTLE_CACHE_TTL_SECONDS,
         )
     except Exception as e:
         warn(f"Failed to write Trestle caller cache: {str(e)}")
 
 
+async def _set_cached_trestle_data_async(cache_conn, phone_number, data):
+    if not cache_conn:
+        return
+
+    try:
+        await cache_conn.set(
+            _get_trestle_cache_key(phone_number),
+            redis_codec.dumps(data or {}),
+            ex=TRESTLE_CACHE_TTL_SECONDS,
+        )
+    except Exception as e:
+        warn(f"Failed to write Trestle caller cache: {str(e)}")
+
+
+def _record_trestle_lookup(request_start, status):
+    latency = time.perf_counter() - request_start
+    if status in TRESTLE_FAILURE_STATUSES:
+        TRESTLE_CIRCUIT_BREAKER.record_failure(latency)
+    else:
+        TRESTLE_CIRCUIT_BREAKER.record_success(latency)
+
+
 def get_trestle_lookup(phone_number, api_key, cache_conn=None):
     start = time.perf_counter()
-    phone_number = "".join(ch for ch in str(phone_number) if ch.isdigit())
+    phone_number = _normalize_phone_number(phone_number)
     if not phone_number or not api_key:
-        return dict(
-            data=None,
-            status="not_configured",
-            latency_ms=round((time.perf_counter() - start) * 1000),
-            from_cache=False,
-        )
+        return _get_lookup_result(start, None, "not_configured")
 
     cached_data = _get_cached_trestle_data(cache_conn, phone_number)
     if cached_data is not _CACHE_MISS:
-        return dict(
-            data=cached_data,
-            status="success" if cached_data else "no_result",
-            latency_ms=round((time.perf_counter() - start) * 1000),
-            from_cache=True,
-        )
+        return _get_cached_lookup_result(start, cached_data)
+
+    if not TRESTLE_CIRCUIT_BREAKER.allow():
+        return _get_lookup_result(start, None, "circuit_open")
 
+    request_start = time.perf_counter()
     try:
         response = requests.get(
             TRESTLE_API_URL,
             headers={"x-api-key": api_key},
             params={"phone": phone_number, "phone.country_hint": "US"},
-            timeout=TRESTLE_REQUEST_TIMEOUT,
+            timeout=TRESTLE_CIRCUIT_BREAKER.get_timeout(),
         )
         response.raise_for_status()
         response_data = response.json()
         if not isinstance(response_data, dict):
-            return dict(
-                data=None,
-                status="invalid_response",
-                latency_ms=round((time.perf_counter() - start) * 1000),
-                from_cache=False,
-            )
+            raise ValueError("Response is not an object")
         data = filter_trestle_response(response_data)
         _set_cached_trestle_data(cache_conn, phone_number, data)
         status = "success" if data else "no_result"
@@ -164,14 +271,112 @@ def get_trestle_lookup(phone_number, api_key, cache_conn=None):
         data = None
         status = "invalid_response"
 
-    return dict(
-        data=data,
-        status=status,
-        latency_ms=round((time.perf_counter() - start) * 1000),
-        from_cache=False,
+    _record_trestle_lookup(request_start, status)
+    return _get_lookup_result(start, data, status)
+
+
+async def get_trestle_lookup_async(
+    phone_number, api_key, cache_conn=None, timeout=None
+):
+    """See get_trestle_lookup. Uses the pooled client and an async Redis
+    cache_conn, and never blocks the event loop. The lookup is given up after
+    timeout seconds, the adaptive timeout of TRESTLE_CIRCUIT_BREAKER by
+    default."""
+    start = time.perf_counter()
+    phone_number = _normalize_phone_number(phone_number)
+    if not phone_number or not api_key:
+        return _get_lookup_result(start, None, "not_configured")
+
+    cached_data = await _get_cached_trestle_data_async(cache_conn, phone_number)
+    if cached_data is not _CACHE_MISS:
+        return _get_cached_lookup_result(start, cached_data)
+
+    # Concurrent lookups of the same caller, such as telephony retries of
+    # track_call, share one Trestle request
+    return await _TRESTLE_LOOKUPS.do(
+        phone_number,
+        _coalesced_trestle_lookup_async,
+        start,
+        phone_number,
+        api_key,
+        cache_conn,
+        timeout or TRESTLE_CIRCUIT_BREAKER.get_timeout(),
     )
 
 
+async def _coalesced_trestle_lookup_async(
+    start, phone_number, api_key, cache_conn, timeout
+):
+    cache_key = _get_trestle_cache_key(phone_number)
+    # The marker covers a request that runs to its timeout
+    claimed = await claim_in_flight_async(cache_conn, cache_key, 2 * timeout)
+    try:
+        if claimed:
+            # The result may have been cached since it was last read
+            cached_data = await _get_cached_trestle_data_async(cache_conn, phone_number)
+        else:
+            # Another worker is looking up this caller, wait for it to cache it
+            cached_data = await wait_in_flight_async(
+                cache_conn,
+                cache_key,
+                lambda: _get_cached_trestle_data_async(cache_conn, phone_number),
+                _CACHE_MISS,
+                timeout,
+            )
+        if cached_data is not _CACHE_MISS:
+            return _get_cached_lookup_result(start, cached_data)
+        return await _request_trestle_lookup_async(
+            start, phone_number, api_key, cache_conn, timeout
+        )
+    finally:
+        if claimed:
+            await release_in_flight_async(cache_conn, cache_key)
+
+
+async def _request_trestle_lookup_async(
+    start, phone_number, api_key, cache_conn, timeout
+):
+    if not TRESTLE_CIRCUIT_BREAKER.allow():
+        return _get_lookup_result(start, None, "circuit_open")
+
+    request_start = time.perf_counter()
+    try:
+        response = await asyncio.wait_for(
+            get_trestle_client().get(
+                TRESTLE_API_URL,
+                headers={"x-api-key": api_key},
+                params={"phone": phone_number, "phone.country_hint": "US"},
+            ),
+            timeout,
+        )
+        response.raise_for_status()
+        response_data = response.json()
+        if not isinstance(response_data, dict):
+            raise ValueError("Response is not an object")
+        data = filter_trestle_response(response_data)
+        await _set_cached_trestle_data_async(cache_conn, phone_number, data)
+        status = "success" if data else "no_result"
+    except (asyncio.TimeoutError, httpx.TimeoutException) as e:
+        warn(f"Trestle caller lookup timed out for {phone_number}: {str(e)}")
+        data = None
+        status = "timeout"
+    except httpx.HTTPStatusError as e:
+        warn(f"Trestle caller HTTP error for {phone_number}: {str(e)}")
+        data = None
+        status = "http_error"
+    except httpx.HTTPError as e:
+        warn(f"Trestle caller lookup failed for {phone_number}: {str(e)}")
+        data = None
+        status = "request_error"
+    except (ValueError, AttributeError) as e:
+        warn(f"Trestle caller response invalid for {phone_number}: {str(e)}")
+        data = None
+        status = "invalid_response"
+
+    _record_trestle_lookup(request_start, status)
+    return _get_lookup_result(start, data, status)
+
+
 def get_trestle_data(phone_number, api_key, cache_conn=None):
     lookup = get_trestle_lookup(phone_number, api_key, cache_conn=cache_conn)
     return lookup["data"]
@@ -240,10 +445,7 @@ def get_trusted_trestle_zip(
     return _get_trusted_trestle_zip(trestle_zip, from_zip, user_area_code)
 
 
-def get_trestle_enrichment(
-    phone_number, from_zip, user_area_code, api_key, cache_conn=None
-):
-    lookup = get_trestle_lookup(phone_number, api_key, cache_conn=cache_conn)
+def _get_trestle_enrichment(lookup, from_zip, user_area_code):
     data = lookup["data"]
     current_address = (data or {}).get("current_address") or {}
     trestle_zip = None
@@ -259,3 +461,20 @@ def get_trestle_enrichment(
         "trusted_zip": trusted_zip,
         "trust_reason": trust_reason,
     }
+
+
+def get_trestle_enrichment(
+    phone_number, from_zip, user_area_code, api_key, cache_conn=None
+):
+    lookup = get_trestle_lookup(phone_number, api_key, cache_conn=cache_conn)
+    return _get_trestle_enrichment(lookup, from_zip, user_area_code)
+
+
+async def get_trestle_enrichment_async(
+    phone_number, from_zip, user_area_code, api_key, cache_conn=None, timeout=None
+):
+    """See get_trestle_enrichment"""
+    lookup = await get_trestle_lookup_async(
+        phone_number, api_key, cache_conn=cache_conn, timeout=timeout
+    )
+    return _get_trestle_enrichment(lookup, from_zip, user_area_code)